@@ -1,13 +1,40 @@
+import types
+import importlib
+
 from hierarchical import *
 
 import utils
 import analyze
 import generate
+import database
+
+class _LazyModule(types.ModuleType):
+    """Placeholder for the submodule kabuki.<name> that imports it
+    when one of its attributes is accessed. Importing the submodule
+    replaces the placeholder.
+    """
+    def __init__(self, name):
+        types.ModuleType.__init__(self, 'kabuki.' + name)
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+# Optional features, only imported when used
+for _name in ('checkpoint', 'step_methods', 'tuning', 'optimize', 'variational',
+              'laplace', 'likelihoods', 'jobs'):
+    globals()[_name] = _LazyModule(_name)
+del _name
 
-try:
-    from IPython.core.debugger import Tracer; debug_here = Tracer()
-except:
+def debug_here():
+    """Start the IPython debugger in the calling frame (IPython is
+    only imported when this is called).
+    """
+    import sys
     try:
-        from IPython.Debugger import Tracer; debug_here = Tracer()
-    except:
-        def debug_here(): pass
+        from IPython.core.debugger import Tracer
+    except ImportError:
+        try:
+            from IPython.Debugger import Tracer
+        except ImportError:
+            return
+    Tracer().debugger.set_trace(sys._getframe().f_back)
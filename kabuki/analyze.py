@@ -2,15 +2,10 @@ from __future__ import division
 import numpy as np
 import pymc as pm
 import re
-from matplotlib.pylab import figure
-import matplotlib.pyplot as plt
 import sys, os
-import scipy as sc
 
-try:
-    import pandas as pd
-except:
-    print "Pandas not found, posterior predictive checks won't work."
+# matplotlib, pandas and scipy.stats are imported by the functions
+# that need them, so that importing kabuki stays fast.
 
 try:
     from collections import OrderedDict
@@ -86,6 +81,155 @@ def get_subj_nodes(model, startswith=None, i_subj=None):
         else:
             return subj
 
+# Quantiles of summary() and gen_stats()
+_QUANTILES = (2.5, 25, 50, 75, 97.5)
+
+def trace_stats(traces, batches=100, quantiles=_QUANTILES):
+    """Compute summary statistics of many traces at once.
+
+    :Arguments:
+        traces : numpy.ndarray
+            (samples x nodes) matrix of stacked traces.
+
+    :Optional:
+        batches : int
+            Number of batches of the MC error (see
+            pymc.database.base.batchsd()).
+        quantiles : tuple
+            Percentiles to compute.
+
+    :Returns:
+        OrderedDict mapping mean, std, <q>q for each quantile and
+        mc_err to arrays with one element per node. The MC error
+        is NaN if there are less than 2 samples.
+    """
+    traces = np.asarray(traces, dtype=float)
+    n = traces.shape[0]
+    stats = OrderedDict()
+    stats['mean'] = traces.mean(axis=0)
+    stats['std'] = traces.std(axis=0)
+    for q, values in zip(quantiles, np.percentile(traces, quantiles, axis=0)):
+        stats['%gq' % q] = values
+
+    # Standard deviation of the means of batches
+    if batches == 1:
+        stats['mc_err'] = stats['std'] / np.sqrt(n)
+    else:
+        # Short traces: at least one sample per batch
+        batches = min(batches, n)
+        if batches < 2:
+            stats['mc_err'] = np.nan * np.ones(traces.shape[1])
+        else:
+            size = n // batches
+            means = traces[:batches * size].reshape(batches, size, -1).mean(axis=1)
+            stats['mc_err'] = means.std(axis=0) / np.sqrt(batches)
+
+    return stats
+
+def _summary_nodes(model, mc):
+    """Return list of (param, tag, subj, node) of all nodes of model
+    traced by the sampler mc that are scalar: group, var (param
+    <name>_var), subj and offset (param <name>_offset) nodes in the
+    order of the parameters followed by all other traced nodes (e.g.
+    deviance) with their name as param. subj is -1 for nodes that do
+    not belong to a subject.
+    """
+    if mc is None:
+        raise ValueError("Model has not been sampled (or loaded with load_db()).")
+    traced = mc._variables_to_tally
+
+    nodes = []
+    for name, param in model.params_include.iteritems():
+        if param.is_bottom_node:
+            continue
+        for tag, node in param.group_nodes.iteritems():
+            nodes.append((name, tag, -1, node))
+        for tag, node in param.var_nodes.iteritems():
+            nodes.append((name + '_var', tag, -1, node))
+        for tag, subj_nodes in param.subj_nodes.iteritems():
+            for subj, node in enumerate(subj_nodes):
+                nodes.append((name, tag, subj, node))
+        for tag, offset_nodes in param.offset_nodes.iteritems():
+            for subj, node in enumerate(offset_nodes):
+                nodes.append((name + '_offset', tag, subj, node))
+
+    covered = set([node for name, tag, subj, node in nodes])
+    nodes += [(node.__name__, '', -1, node) for node in sorted(traced, key=lambda node: node.__name__)
+              if node not in covered]
+
+    return [(name, tag, subj, node) for name, tag, subj, node in nodes
+            if node in traced and np.ndim(node.value) == 0]
+
+def summary(model, start=0, batches=100, quantiles=_QUANTILES, chain=None, mc=None):
+    """Summarize the posterior of all group, var and subj nodes of a
+    sampled model.
+
+    The traces are stacked into one matrix and the statistics of all
+    nodes are computed at once (see trace_stats()).
+
+    :Arguments:
+        model : kabuki.Hierarchical
+            Sampled model (or loaded with load_db()).
+
+    :Optional:
+        start : int
+            Skip the first samples of each trace.
+        batches : int
+            Number of batches of the MC error.
+        quantiles : tuple
+            Percentiles to compute.
+        chain : int
+            Chain to summarize (None: all chains).
+        mc : pymc.MCMC
+            Sampler whose traces are summarized instead of model.mc,
+            e.g. model.approx_mc after fit_vi() or fit_laplace().
+
+    :Returns:
+        pandas.DataFrame indexed by param (<name>_var for var nodes),
+        tag and subj (-1 for group and var nodes) with columns node
+        (name of the node), mean, std, the quantiles and mc_err.
+    """
+    import pandas as pd
+
+    if mc is None or mc is model.mc:
+        # The nodes hold the traces of model.mc (lazy after load_db())
+        mc = model.mc
+        trace = lambda node: node.trace(chain=chain)
+    else:
+        trace = lambda node: mc.trace(node.__name__)(chain=chain)
+
+    nodes = _summary_nodes(model, mc)
+    traces = np.column_stack([np.asarray(trace(node), dtype=float).ravel()[start:]
+                              for name, tag, subj, node in nodes])
+    stats = trace_stats(traces, batches=batches, quantiles=quantiles)
+
+    index = pd.MultiIndex.from_tuples([(name, tag, subj) for name, tag, subj, node in nodes],
+                                      names=['param', 'tag', 'subj'])
+    frame = pd.DataFrame(stats, index=index)
+    frame.insert(0, 'node', [node.__name__ for name, tag, subj, node in nodes])
+    return frame
+
+# Columns of gen_stats() in summary() and the keys of MCMC.stats()
+_STATS_COLUMNS = ('mean', 'std', '2.5q', '25q', '50q', '75q', '97.5q', 'mc_err')
+
+def _stats_rows(stats):
+    """Return list of (name, values of _STATS_COLUMNS) of the output
+    of summary() or MCMC.stats() (scalar nodes only).
+    """
+    if not isinstance(stats, dict):
+        return zip(stats['node'], zip(*[stats[column].values for column in _STATS_COLUMNS]))
+
+    rows = []
+    for name in sorted(stats.keys()):
+        i_stats = stats[name]
+        if not np.isscalar(i_stats['mean']):
+            continue
+        rows.append((name, (i_stats['mean'], i_stats['standard deviation'],
+                            i_stats['quantiles'][2.5], i_stats['quantiles'][25],
+                            i_stats['quantiles'][50], i_stats['quantiles'][75],
+                            i_stats['quantiles'][97.5], i_stats['mc error'])))
+    return rows
+
 def print_stats(stats):
     print gen_stats(stats)
 
@@ -93,29 +237,18 @@ def gen_stats(stats):
     """
     print the model's stats in a pretty format
     Input:
-        stats - the output of MCMC.stats()
+        stats - the output of summary() or MCMC.stats()
     """
-    names = sorted(stats.keys())
-    len_name = max([len(x) for x in names])
+    rows = _stats_rows(stats)
+    len_name = max([len(name) for name, values in rows])
     f_names  = ['mean', 'std', '2.5q', '25q', '50q', '75q', '97.5', 'mc_err']
     len_f_names = 6
 
-    s = 'name'.center(len_name) + '  '
-    for name in f_names:
-        s += ' ' + name.center(len_f_names)
-    s += '\n'
-
-    for name in names:
-        i_stats = stats[name]
-        if not np.isscalar(i_stats['mean']):
-            continue
-        s += "%s: %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f\n" % \
-        (name.ljust(len_name), i_stats['mean'], i_stats['standard deviation'],
-         i_stats['quantiles'][2.5], i_stats['quantiles'][25],\
-         i_stats['quantiles'][50], i_stats['quantiles'][75], \
-         i_stats['quantiles'][97.5], i_stats['mc error'])
+    header = 'name'.center(len_name) + '  ' + ''.join([' ' + name.center(len_f_names) for name in f_names])
+    lines = ["%s: %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f %6.3f" % ((name.ljust(len_name),) + tuple(values))
+             for name, values in rows]
 
-    return s
+    return '\n'.join([header] + lines) + '\n'
 
 def print_group_stats(stats):
     print gen_group_stats(stats)
@@ -124,21 +257,19 @@ def gen_group_stats(stats):
     """
     print the model's group stats in a pretty format
     Input:
-        stats - the output of MCMC.stats()
+        stats - the output of summary() or MCMC.stats()
     """
+    if isinstance(stats, dict):
+        # Names of subj nodes end with the subject index
+        return gen_stats(dict((key, value) for key, value in stats.iteritems()
+                              if re.match('[0-9]', key[-1]) is None))
 
-    g_stats = {}
-    keys = [z for z in stats.keys() if re.match('[0-9]',z[-1]) is None]
-    keys.sort()
-    for key in keys:
-        g_stats[key] = stats[key]
-    s = gen_stats(g_stats)
-
-    return s
+    return gen_stats(stats[stats.index.get_level_values('subj') == -1])
 
 def plot_posteriors(nodes, bins=50):
+    import matplotlib.pyplot as plt
     from kabuki.utils import interpolate_trace
-    figure()
+    plt.figure()
     lb = min([min(node.trace()[:]) for node in nodes])
     ub = max([max(node.trace()[:]) for node in nodes])
     x_data = np.linspace(lb, ub, 300)
@@ -154,6 +285,7 @@ def plot_posteriors(nodes, bins=50):
 
 
 def group_plot(model, params_to_plot=(), n_bins=50, save_to=None):
+    import matplotlib.pyplot as plt
     if isinstance(model, pm.MCMC):
         nodes = model.stochastics
     else:
@@ -171,7 +303,7 @@ def group_plot(model, params_to_plot=(), n_bins=50, save_to=None):
 
             print "plotting %s" % group_node.__name__
             sys.stdout.flush()
-            figure()
+            plt.figure()
             lb = min([min(db.trace(x.__name__)[:]) for x in subj_nodes])
             lb = min(lb, min(g_node_trace))
             ub = max([max(db.trace(x.__name__)[:]) for x in subj_nodes])
@@ -366,7 +498,8 @@ def group_cond_diff(hm, node, cond1, cond2, threshold=0):
     pooled_var = 1. / sum(1. / (subj_diff_std**2))
     pooled_mean = sum(subj_diff_mean / (subj_diff_std**2)) * pooled_var
 
-    mass_under = sc.stats.norm.cdf(threshold,pooled_mean, np.sqrt(pooled_var))
+    from scipy.stats import norm
+    mass_under = norm.cdf(threshold,pooled_mean, np.sqrt(pooled_var))
 
     return pooled_mean, pooled_var, mass_under
 
@@ -435,6 +568,7 @@ def _evaluate_post_pred(sampled_stats, data_stats, evals=None):
     :Returns:
         pandas.DataFrame containing the eval results as columns.
     """
+    import pandas as pd
     from scipy.stats import scoreatpercentile, percentileofscore
     from itertools import product
 
@@ -525,6 +659,7 @@ def post_pred_check(model, samples=500, bins=100, stats=None, evals=None, plot=F
     :Returns:
         Hierarchical pandas.DataFrame with the different statistics.
     """
+    import pandas as pd
     print "Sampling..."
     results = []
 
@@ -655,6 +790,7 @@ def plot_posterior_predictive(model, value_range=None, samples=10, columns=3, bi
         This function changes the current value and logp of the nodes.
 
     """
+    import matplotlib.pyplot as plt
 
     if value_range is None:
         # Infer from data by finding the min and max from the nodes
@@ -0,0 +1,579 @@
+"""
+Benchmarks to compare the accuracy and speed of kabuki versions.
+
+Parameter recovery: datasets are simulated on a grid of subjects x
+trials x conditions (with generate.gen_rand_data() for a hierarchical
+normal model and qlearn.qlearn_generate() for QLearn), fit with map()
+and sample(), and for each fit the wall time, effective sample size
+(ESS) per second, peak memory and the error of the recovered subject
+parameters are recorded:
+
+    >>> results = recovery(subjs=(5, 20), trials=(20, 100), conditions=(1, 2))
+    >>> save(results, 'kabuki-0.2.json')
+
+or from the command line:
+
+    python -m kabuki.benchmark recovery --out kabuki-0.2.json
+
+(--no-map skips map()).
+
+Model construction: construction() builds models of model_factory()
+on a grid of subjects x conditions x parameters x trials and times
+each phase (model initialization, create_nodes(), mcmc(), a short
+sample() into a kabuki.database and load_db() into a new model, with
+and without lazy traces) and records the number of nodes and the peak
+memory:
+
+    >>> results = construction(subjs=(10, 100), conditions=(1, 4), params=(1, 4))
+    >>> save(results, 'kabuki-0.2-construction.json', benchmark='construction')
+
+    python -m kabuki.benchmark construction --out kabuki-0.2-construction.json
+
+Startup: startup() imports kabuki in fresh interpreters (as every
+worker process of a pool does) and records the import time on top of
+pymc and whether plotting, pandas or IPython modules were imported:
+
+    python -m kabuki.benchmark startup --out kabuki-0.2-startup.json
+
+Results of two versions can be compared with compare().
+
+Each case runs in a fresh interpreter (isolate=True) so that peak
+memory (maximum resident set size) is measured per case. A forked
+worker would inherit the peak memory of the parent.
+
+"""
+from __future__ import division
+
+import sys
+import json
+import shutil
+import tempfile
+import time
+import platform
+import resource
+import subprocess
+from itertools import product
+
+import numpy as np
+import scipy.stats
+import pymc as pm
+
+import kabuki
+from kabuki.hierarchical import Parameter
+from kabuki.generate import gen_rand_data
+
+__all__ = ['NormalModel', 'effective_sample_size', 'recovery', 'run_recovery_case',
+           'model_factory', 'construction', 'run_construction_case', 'startup',
+           'save', 'load', 'compare']
+
+
+normal_like = kabuki.utils.scipy_stochastic(scipy.stats.distributions.norm_gen, name='normal', longname='normal')
+
+class NormalModel(kabuki.Hierarchical):
+    """Hierarchical normal model of gen_rand_data() output with
+    normal_like (loc estimated, scale=1 known).
+    """
+    def get_params(self):
+        return [Parameter('loc', lower=-10, upper=10, init=0),
+                Parameter('like', is_bottom_node=True)]
+
+    def get_bottom_node(self, param, params):
+        return pm.Normal(param.full_name, mu=params['loc'], tau=1,
+                         value=param.data['data'], observed=True)
+
+def _simulate_normal(subjs, trials, conditions):
+    """Return model and dict mapping (param, tag, subj) to true value."""
+    params = dict(('c%i' % i, {'loc': float(i), 'scale': 1.}) for i in range(conditions))
+    data, subj_params = gen_rand_data(normal_like, params, samples=trials, subjs=subjs,
+                                      subj_noise=.5, exclude_params=('scale',))
+    if conditions == 1:
+        subj_params = {'c0': subj_params}
+        model = NormalModel(data)
+    else:
+        model = NormalModel(data, depends_on={'loc': ['condition']})
+
+    truth = {}
+    for condition, cond_params in subj_params.iteritems():
+        tag = '' if conditions == 1 else str((condition,))
+        for i, subj_param in enumerate(cond_params):
+            truth[('loc', tag, i)] = subj_param['loc']
+    return model, truth
+
+def _simulate_qlearn(subjs, trials, conditions):
+    from kabuki import qlearn
+    lrate = np.clip(np.random.normal(.3, .1, size=subjs), .01, .99)
+    inv_temp = np.clip(np.random.normal(5, 1, size=subjs), 1, 15)
+    data = qlearn.qlearn_generate(trials=trials, subjs=subjs, lrate=lrate, inv_temp=inv_temp)
+    truth = {}
+    for i in range(subjs):
+        truth[('lrate', '', i)] = lrate[i]
+        truth[('inv_temp', '', i)] = inv_temp[i]
+    return qlearn.QLearn(data), truth
+
+# Models of the benchmark: name -> simulate(subjs, trials, conditions)
+MODELS = {'normal': _simulate_normal,
+          'qlearn': _simulate_qlearn}
+
+
+def effective_sample_size(trace):
+    """Return the effective sample size of a 1d trace (Geyer's initial
+    positive sequence estimator of the autocorrelation time).
+    """
+    x = np.asarray(trace, dtype=float)
+    n = len(x)
+    if n < 4 or np.var(x) == 0:
+        return float(n)
+    x = x - np.mean(x)
+    # Autocorrelation via FFT
+    size = 2**int(np.ceil(np.log2(2 * n)))
+    f = np.fft.rfft(x, size)
+    acf = np.fft.irfft(f * np.conjugate(f))[:n]
+    acf /= acf[0]
+    # Sum of pairs of autocorrelations while positive
+    pairs = acf[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    negative = np.flatnonzero(pairs <= 0)
+    m = negative[0] if len(negative) else len(pairs)
+    tau = -1 + 2 * np.sum(pairs[:m])
+    return n / max(tau, 1. / n)
+
+def _subj_nodes(model, truth):
+    return dict((key, model.params_include[key[0]].subj_nodes[key[1]][key[2]]) for key in truth)
+
+def _rmse(estimates, truth, prefix):
+    """Return dict mapping prefix_rmse_<param> to the root mean
+    squared error of the subject parameters.
+    """
+    errors = {}
+    for key, value in truth.iteritems():
+        errors.setdefault(key[0], []).append(estimates[key] - value)
+    return dict(('%s_rmse_%s' % (prefix, name), float(np.sqrt(np.mean(np.square(error)))))
+                for name, error in errors.iteritems())
+
+def _peak_memory():
+    """Peak resident set size of this process in MB."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on Mac OS X
+    if sys.platform == 'darwin':
+        return maxrss / 2**20
+    return maxrss / 2**10
+
+def run_recovery_case(case):
+    """Simulate and fit one dataset.
+
+    :Arguments:
+        case : dict
+            Keys model, subjs, trials, conditions, seed, samples,
+            burn and map_method.
+
+    :Returns:
+        dict of case and results.
+    """
+    np.random.seed(case['seed'])
+    result = dict(case)
+    model, truth = MODELS[case['model']](case['subjs'], case['trials'], case['conditions'])
+
+    start = time.time()
+    model.create_nodes()
+    result['build_time'] = time.time() - start
+
+    if case['map_method'] is not None:
+        start = time.time()
+        model.map(runs=1, method=case['map_method'])
+        result['map_time'] = time.time() - start
+        nodes = _subj_nodes(model, truth)
+        result.update(_rmse(dict((key, float(node.value)) for key, node in nodes.iteritems()), truth, 'map'))
+
+    if case['samples']:
+        start = time.time()
+        model.sample(case['samples'], burn=case['burn'], progress_bar=False)
+        result['sample_time'] = time.time() - start
+        nodes = _subj_nodes(model, truth)
+        traces = dict((key, model.mc.trace(node.__name__)[:]) for key, node in nodes.iteritems())
+        result.update(_rmse(dict((key, float(np.mean(trace))) for key, trace in traces.iteritems()), truth, 'sample'))
+        ess = np.array([effective_sample_size(trace) for trace in traces.itervalues()])
+        result['ess_min'] = float(np.min(ess))
+        result['ess_median'] = float(np.median(ess))
+        result['ess_per_sec'] = float(np.min(ess) / result['sample_time'])
+
+    result['peak_memory'] = _peak_memory()
+    return result
+
+_CASE_SCRIPT = """
+import sys, json
+import kabuki.benchmark
+case = json.loads(sys.stdin.read())
+result = kabuki.benchmark.%s(case)
+print json.dumps(result)
+"""
+
+def _run_isolated(func, case):
+    """Run func(case) in a fresh interpreter and return its result."""
+    process = subprocess.Popen([sys.executable, '-c', _CASE_SCRIPT % func.__name__],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate(json.dumps(case))
+    if process.returncode != 0:
+        raise RuntimeError("Benchmark case %s failed:\n%s" % (case, error))
+    # Models print to stdout, the result is on the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+def recovery(models=('normal', 'qlearn'), subjs=(5, 20), trials=(20, 100), conditions=(1, 2),
+             samples=2000, burn=500, map_method='gradient', seed=31337, isolate=True, verbose=1):
+    """Run the parameter recovery benchmark on a grid of datasets.
+
+    :Optional:
+        models : tuple
+            Names of models in MODELS.
+        subjs, trials, conditions : tuple
+            Grid of numbers of subjects, trials (per subject and
+            condition) and conditions. Models without conditions
+            (qlearn) only run with conditions=1.
+        samples, burn : int
+            Arguments of sample() (no sampling if samples=0).
+        map_method : str
+            Method of map() (None to skip).
+        seed : int
+            Random seed of each dataset.
+        isolate : bool
+            Run each case in a fresh interpreter to measure its peak
+            memory.
+
+    :Returns:
+        list of dicts with the case and the results (see
+        run_recovery_case()), in MB and seconds.
+    """
+    results = []
+    for model, n_subjs, n_trials, n_conditions in product(models, subjs, trials, conditions):
+        if model == 'qlearn' and n_conditions != 1:
+            continue
+        case = {'model': model, 'subjs': n_subjs, 'trials': n_trials, 'conditions': n_conditions,
+                'seed': seed, 'samples': samples, 'burn': burn, 'map_method': map_method}
+        if isolate:
+            result = _run_isolated(run_recovery_case, case)
+        else:
+            result = run_recovery_case(case)
+        if verbose > 0:
+            print "%(model)s subjs=%(subjs)i trials=%(trials)i conditions=%(conditions)i: " % result + \
+                ", ".join(["%s=%.3g" % (key, result[key]) for key in sorted(result)
+                           if key not in case])
+        results.append(result)
+
+    return results
+
+
+def model_factory(num_params=1, create_group_node=True, create_subj_nodes=True):
+    """Return a Hierarchical subclass with num_params parameters
+    test0, test1, ... (like class_factory of the tests, but
+    deterministic) and a normal bottom node on the score column
+    centered at test0.
+    """
+    params = [Parameter('test%i' % i, lower=1, upper=10, init=5,
+                        create_group_node=create_group_node,
+                        create_subj_nodes=create_subj_nodes)
+              for i in range(num_params)]
+    params.append(Parameter('observed', is_bottom_node=True))
+
+    class Synthetic(kabuki.Hierarchical):
+        def get_params(self):
+            return params
+
+        def get_bottom_node(self, param, params):
+            return pm.Normal(param.full_name, mu=params['test0'], tau=1,
+                             value=param.data['score'], observed=True)
+
+    return Synthetic
+
+def _synthetic_data(subjs, conditions, trials):
+    """Return data with columns subj_idx, condition and score."""
+    size = subjs * conditions * trials
+    data = np.empty(size, dtype=[('subj_idx', np.int32), ('condition', 'S20'), ('score', np.float64)])
+    data['subj_idx'] = np.repeat(np.arange(subjs), conditions * trials)
+    data['condition'] = np.tile(np.repeat(['c%i' % i for i in range(conditions)], trials), subjs)
+    data['score'] = np.random.normal(5, 1, size=size)
+    return data
+
+def run_construction_case(case):
+    """Build, set up and reload one model of model_factory().
+
+    :Arguments:
+        case : dict
+            Keys subjs, conditions, params, trials, depends_on
+            (bool: all parameters depend on the condition), seed
+            and samples.
+
+    :Returns:
+        dict of case and results: times of the phases (init_time,
+        create_nodes_time, mcmc_time, sample_time, load_db_time and
+        load_db_lazy_time),
+        node counts (nodes, stochastics, deterministics, observed)
+        and peak_memory and its increase during create_nodes()
+        (create_nodes_memory).
+    """
+    np.random.seed(case['seed'])
+    result = dict(case)
+    data = _synthetic_data(case['subjs'], case['conditions'], case['trials'])
+    model_class = model_factory(case['params'])
+    if case['depends_on'] and case['conditions'] > 1:
+        depends_on = dict(('test%i' % i, ['condition']) for i in range(case['params']))
+    else:
+        depends_on = {}
+
+    start = time.time()
+    model = model_class(data, depends_on=depends_on)
+    result['init_time'] = time.time() - start
+
+    memory = _peak_memory()
+    start = time.time()
+    model.create_nodes()
+    result['create_nodes_time'] = time.time() - start
+    result['create_nodes_memory'] = _peak_memory() - memory
+
+    dbname = tempfile.mkdtemp(prefix='kabuki-benchmark-')
+    try:
+        start = time.time()
+        mc = model.mcmc(db=kabuki.database, dbname=dbname)
+        result['mcmc_time'] = time.time() - start
+        result['nodes'] = len(mc.variables)
+        result['stochastics'] = len(mc.stochastics)
+        result['deterministics'] = len(mc.deterministics)
+        result['observed'] = len(mc.observed_stochastics)
+
+        start = time.time()
+        model.sample(case['samples'], progress_bar=False)
+        result['sample_time'] = time.time() - start
+        mc.db.close()
+
+        start = time.time()
+        model_class(data, depends_on=depends_on).load_db(dbname, lazy=False)
+        result['load_db_time'] = time.time() - start
+
+        start = time.time()
+        model_class(data, depends_on=depends_on).load_db(dbname, lazy=True)
+        result['load_db_lazy_time'] = time.time() - start
+    finally:
+        shutil.rmtree(dbname, ignore_errors=True)
+
+    result['peak_memory'] = _peak_memory()
+    return result
+
+def construction(subjs=(10, 100), conditions=(1, 4), params=(1, 4), trials=(10, 100),
+                 depends_on=True, samples=100, seed=31337, isolate=True, verbose=1):
+    """Run the model construction benchmark on a grid of models.
+
+    :Optional:
+        subjs, conditions, params, trials : tuple
+            Grid of numbers of subjects, conditions, parameters of
+            model_factory() and trials (per subject and condition).
+        depends_on : bool
+            All parameters depend on the condition (one group
+            node and subject node per condition).
+        samples : int
+            Length of the chain stored in and loaded from the
+            database.
+        seed : int
+            Random seed of each dataset.
+        isolate : bool
+            Run each case in a fresh interpreter to measure its peak
+            memory.
+
+    :Returns:
+        list of dicts with the case and the results (see
+        run_construction_case()), in MB and seconds.
+    """
+    results = []
+    for n_subjs, n_conditions, n_params, n_trials in product(subjs, conditions, params, trials):
+        case = {'subjs': n_subjs, 'conditions': n_conditions, 'params': n_params,
+                'trials': n_trials, 'depends_on': depends_on, 'seed': seed, 'samples': samples}
+        if isolate:
+            result = _run_isolated(run_construction_case, case)
+        else:
+            result = run_construction_case(case)
+        if verbose > 0:
+            print "subjs=%(subjs)i conditions=%(conditions)i params=%(params)i trials=%(trials)i: " % result + \
+                ", ".join(["%s=%.3g" % (key, result[key]) for key in sorted(result)
+                           if key not in case])
+        results.append(result)
+
+    return results
+
+# Modules a headless worker that only builds and samples models
+# should not need to import (pymc may import some of them itself)
+_HEAVY_MODULES = ('matplotlib', 'pandas', 'IPython')
+
+_STARTUP_SCRIPT = """
+import sys, time, json
+import numpy, pymc
+before = set(sys.modules)
+start = time.time()
+import %s
+import_time = time.time() - start
+new = [name for name in set(sys.modules) - before if sys.modules[name] is not None]
+print json.dumps({'import_time': import_time, 'modules': sorted(new)})
+"""
+
+def startup(modules=('kabuki',), repeat=5, verbose=1):
+    """Measure the time to import modules in a fresh interpreter.
+
+    :Optional:
+        modules : tuple
+            Modules to import (one case each).
+        repeat : int
+            Number of interpreters started per module, the median
+            is reported.
+
+    :Returns:
+        list of dicts with module and the results: import_time
+        (seconds on top of numpy and pymc), process_time (seconds
+        to start an interpreter and import the module), imported
+        (number of newly imported modules) and heavy_imports
+        (number of _HEAVY_MODULES packages among them, listed in
+        heavy_modules).
+    """
+    results = []
+    for module in modules:
+        import_times, process_times = [], []
+        for i in range(repeat):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, '-c', _STARTUP_SCRIPT % module])
+            process_times.append(time.time() - start)
+            measured = json.loads(output.strip().splitlines()[-1])
+            import_times.append(measured['import_time'])
+        heavy = sorted(set([name.split('.')[0] for name in measured['modules']
+                            if name.split('.')[0] in _HEAVY_MODULES]))
+        result = {'module': module, 'repeat': repeat,
+                  'import_time': float(np.median(import_times)),
+                  'process_time': float(np.median(process_times)),
+                  'imported': len(measured['modules']),
+                  'heavy_imports': len(heavy),
+                  'heavy_modules': ' '.join(heavy)}
+        if verbose > 0:
+            print "%(module)s: import_time=%(import_time).3g, process_time=%(process_time).3g, " \
+                "imported=%(imported)i, heavy_modules=%(heavy_modules)s" % result
+        results.append(result)
+
+    return results
+
+def _environment():
+    return {'kabuki': getattr(kabuki, '__version__', None),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'pymc': pm.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+def save(results, fname, benchmark='recovery'):
+    """Write results with a description of the environment to a JSON file."""
+    with open(fname, 'w') as fd:
+        json.dump({'benchmark': benchmark, 'environment': _environment(), 'results': results},
+                  fd, indent=1, sort_keys=True)
+
+def load(fname):
+    """Return results written by save()."""
+    with open(fname) as fd:
+        return json.load(fd)['results']
+
+# Keys identifying a case of each benchmark (all others are results)
+_CASE_KEYS = {'recovery': ('model', 'subjs', 'trials', 'conditions', 'seed', 'samples', 'burn', 'map_method'),
+              'construction': ('subjs', 'conditions', 'params', 'trials', 'depends_on', 'seed', 'samples'),
+              'startup': ('module', 'repeat')}
+
+def compare(old, new, tolerance=.2, benchmark='recovery'):
+    """Compare results of two runs (e.g. of two kabuki versions).
+
+    :Arguments:
+        old, new : list
+            Results of recovery(), construction() or startup() (or
+            load()).
+
+    :Optional:
+        tolerance : float
+            Relative increase of a time, memory, error or node count
+            (or decrease of ESS per second) reported as regression.
+        benchmark : str
+            'recovery', 'construction' or 'startup'.
+
+    :Returns:
+        list of (case, key, old value, new value) of regressions.
+    """
+    case_keys = _CASE_KEYS[benchmark]
+
+    def case_key(result):
+        return tuple([result.get(key) for key in case_keys])
+
+    old = dict((case_key(result), result) for result in old)
+    regressions = []
+    for result in new:
+        key = case_key(result)
+        if key not in old:
+            continue
+        for name, value in result.iteritems():
+            if name in case_keys or name not in old[key] or isinstance(value, basestring):
+                continue
+            old_value = old[key][name]
+            higher_is_better = name.startswith('ess')
+            if higher_is_better:
+                worse = value < old_value * (1 - tolerance)
+            else:
+                worse = value > old_value * (1 + tolerance)
+            if worse:
+                regressions.append((dict(zip(case_keys, key)), name, old_value, value))
+
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='kabuki benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    rec = subparsers.add_parser('recovery', help='parameter recovery')
+    rec.add_argument('--models', nargs='+', default=['normal', 'qlearn'])
+    rec.add_argument('--subjs', nargs='+', type=int, default=[5, 20])
+    rec.add_argument('--trials', nargs='+', type=int, default=[20, 100])
+    rec.add_argument('--conditions', nargs='+', type=int, default=[1, 2])
+    rec.add_argument('--samples', type=int, default=2000)
+    rec.add_argument('--burn', type=int, default=500)
+    rec.add_argument('--map-method', default='gradient')
+    rec.add_argument('--no-map', dest='map_method', action='store_const', const=None,
+                     help='skip map()')
+    rec.add_argument('--out', help='JSON file to write results to')
+    rec.add_argument('--compare', help='JSON file of earlier results')
+
+    con = subparsers.add_parser('construction', help='model construction')
+    con.add_argument('--subjs', nargs='+', type=int, default=[10, 100])
+    con.add_argument('--conditions', nargs='+', type=int, default=[1, 4])
+    con.add_argument('--params', nargs='+', type=int, default=[1, 4])
+    con.add_argument('--trials', nargs='+', type=int, default=[10, 100])
+    con.add_argument('--no-depends-on', dest='depends_on', action='store_false')
+    con.add_argument('--samples', type=int, default=100)
+    con.add_argument('--out', help='JSON file to write results to')
+    con.add_argument('--compare', help='JSON file of earlier results')
+
+    sta = subparsers.add_parser('startup', help='import time')
+    sta.add_argument('--modules', nargs='+', default=['kabuki'])
+    sta.add_argument('--repeat', type=int, default=5)
+    sta.add_argument('--out', help='JSON file to write results to')
+    sta.add_argument('--compare', help='JSON file of earlier results')
+
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'recovery':
+        results = recovery(models=args.models, subjs=args.subjs, trials=args.trials,
+                           conditions=args.conditions, samples=args.samples, burn=args.burn,
+                           map_method=args.map_method)
+    elif args.benchmark == 'construction':
+        results = construction(subjs=args.subjs, conditions=args.conditions, params=args.params,
+                               trials=args.trials, depends_on=args.depends_on, samples=args.samples)
+    elif args.benchmark == 'startup':
+        results = startup(modules=args.modules, repeat=args.repeat)
+
+    if args.out:
+        save(results, args.out, benchmark=args.benchmark)
+    if args.compare:
+        for case, name, old_value, new_value in compare(load(args.compare), results, benchmark=args.benchmark):
+            print "Regression in %s: %s %.3g -> %.3g" % (case, name, old_value, new_value)
+
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""
+Checkpointing of long MCMC runs.
+
+A checkpoint stores everything needed to continue sampling where a
+pymc.MCMC sampler left off:
+    * the sampler state (iteration count, burn, thin, tuning flags),
+    * the values of all stochastics,
+    * the state of all step methods (e.g. adaptive scale factors,
+      AdaptiveMetropolis covariances and acceptance counts),
+    * the state of a kabuki.tuning.TuningScheduler attached to it,
+    * the state of the numpy random number generator and
+    * the traces tallied so far. Databases of kabuki.database keep
+      their samples on disk so only the trace length is stored.
+      For RAM based backends (ram, pickle, txt) the samples tallied
+      since the previous checkpoint are appended to <checkpoint>.traces.
+
+Checkpoints are written atomically, so a job that gets killed while
+writing leaves the previous checkpoint intact.
+
+If the sampler tunes its step methods at the iteration following a
+checkpoint, the tuning is done before the checkpoint is written, so
+that the checkpoint contains the tuned state and the resumed sampler
+does not tune again.
+
+Usage:
+
+    >>> model.sample(100000, burn=50000, checkpoint='fit.ckpt')
+    >>> # ...job gets pre-empted, then in a new process:
+    >>> model = MyModel(data)
+    >>> model.resume('fit.ckpt')
+
+:Note:
+    pymc keeps the step methods in a set, so the order in which they
+    are called differs between processes. A resumed chain is
+    therefore statistically equivalent to, but not identical with,
+    an uninterrupted one.
+
+"""
+from __future__ import division
+
+import os
+from copy import deepcopy
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import numpy as np
+import pymc as pm
+
+import kabuki
+
+# Sampler attributes needed to continue the sampling loop in
+# addition to pymc.MCMC._state.
+_SAMPLER_ATTRS = ['_cur_trace_index', 'max_trace_length', '_n_tally', '_tuning', '_tuned_count',
+                  '_save_interval', '_stop_tuning_after', 'verbose', '_checkpoint_tuned_at']
+
+
+def step_method_key(sm):
+    """Return a key identifying step method sm across processes.
+
+    pymc.StepMethod._id depends on the (hash based) ordering of the
+    stochastics of a block.
+    """
+    return (sm.__class__.__name__, tuple(sorted([s.__name__ for s in sm.stochastics])))
+
+
+def get_step_method_state(sm):
+    """Return a copy of the state of step method sm.
+
+    In addition to pymc.StepMethod.current_state() the chain mean of
+    AdaptiveMetropolis and the position of each stochastic in the
+    block are stored, so that the state can be transferred to a step
+    method that orders the stochastics differently.
+    """
+    state = deepcopy(sm.current_state())
+    if hasattr(sm, '_slices'):
+        state['_slices'] = dict((s.__name__, sl) for s, sl in sm._slices.iteritems())
+        if hasattr(sm, 'chain_mean'):
+            state['chain_mean'] = np.array(sm.chain_mean)
+    return state
+
+
+def set_step_method_state(sm, state):
+    """Set state (see get_step_method_state()) of step method sm.
+
+    :Returns:
+        bool: False if the state does not fit sm.
+    """
+    state = deepcopy(state)
+    slices = state.pop('_slices', None)
+
+    if slices is not None and hasattr(sm, '_slices'):
+        # Permute the dimensions of block states to the ordering of sm
+        if sorted(slices.keys()) != sorted([s.__name__ for s in sm._slices]):
+            return False
+        perm = np.empty(sm.dim, dtype=np.int)
+        for s, sl in sm._slices.iteritems():
+            perm[sl] = np.arange(sm.dim)[slices[s.__name__]]
+
+        state['C'] = np.asarray(state['C'])[perm][:, perm]
+        # Any square root of C works as proposal_sd, so permuting
+        # the rows is sufficient.
+        state['proposal_sd'] = np.asarray(state['proposal_sd'])[perm]
+        state['_proposal_deviate'] = np.asarray(state['_proposal_deviate'])[perm]
+        state['_trace'] = [np.asarray(row)[perm] for row in state['_trace']]
+        if 'chain_mean' in state:
+            state['chain_mean'] = np.asmatrix(np.ravel(state['chain_mean'])[perm])
+
+    sm.__dict__.update(state)
+    return True
+
+
+def get_state(mc):
+    """Return the complete state of a sampling pymc.MCMC instance
+    (for RAM based backends without the samples, see save()).
+
+    :Arguments:
+        mc <pymc.MCMC>: Sampler (has to have called sample()).
+    """
+    state = mc.get_state()
+    state['step_methods'] = dict((step_method_key(sm), get_step_method_state(sm))
+                                 for sm in mc.step_methods)
+    for attr in _SAMPLER_ATTRS:
+        if hasattr(mc, attr):
+            state['sampler'][attr] = getattr(mc, attr)
+
+    if mc.status == 'running':
+        # Called from within the sampling loop after the iteration
+        # has been completed but before the counter is incremented.
+        state['sampler']['_current_iter'] = mc._current_iter + 1
+
+    scheduler = getattr(mc, '_tuning_scheduler', None)
+    if scheduler is not None:
+        state['tuning_scheduler'] = scheduler.get_state()
+
+    state['rng'] = np.random.get_state()
+
+    chain = mc.db.chains - 1
+    state['chain'] = chain
+    if isinstance(mc.db, kabuki.database.Database):
+        mc.db.commit()
+        state['trace_length'] = mc.db._lengths[chain]
+    else:
+        state['trace_length'] = min(mc._cur_trace_index, mc.max_trace_length)
+        for name in mc.db.trace_names[chain]:
+            trace = mc.db._traces[name]
+            if isinstance(trace, pm.database.ram.Trace):
+                # Preallocated length of the chain
+                state['allocated_length'] = len(trace._trace[chain])
+
+    return state
+
+
+def _traces_fname(fname):
+    return fname + '.traces'
+
+def _append_traces(mc, fname, start, length):
+    """Append samples start to length of the RAM traces of mc to the
+    trace file of checkpoint fname (truncated if start is 0).
+    """
+    chain = mc.db.chains - 1
+    traces = {}
+    for name in mc.db.trace_names[chain]:
+        traces[name] = np.array(mc.db._traces[name].gettrace(chain=chain, slicing=slice(start, length)))
+    with open(_traces_fname(fname), 'wb' if start == 0 else 'ab') as fd:
+        pickle.dump((start, traces), fd, protocol=pickle.HIGHEST_PROTOCOL)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+def _load_traces(fname, length):
+    """Return dict of the first length samples of the traces appended
+    to the trace file of checkpoint fname.
+    """
+    traces = {}
+    with open(_traces_fname(fname), 'rb') as fd:
+        while True:
+            try:
+                start, chunk = pickle.load(fd)
+            except EOFError:
+                break
+            for name, values in chunk.iteritems():
+                # Chunks appended after the last checkpoint of a run
+                # that got killed are overwritten by later chunks.
+                if name in traces:
+                    values = np.concatenate([traces[name][:start], values])
+                traces[name] = values
+    return dict((name, values[:length]) for name, values in traces.iteritems())
+
+
+def save(mc, fname, trace_start=0):
+    """Write checkpoint of mc to fname.
+
+    :Optional:
+        trace_start <int>: Number of samples of RAM based traces that
+            were already written by an earlier save() of the same run.
+
+    :Returns:
+        The saved state.
+    """
+    state = get_state(mc)
+    if 'allocated_length' in state:
+        _append_traces(mc, fname, trace_start, state['trace_length'])
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as fd:
+        pickle.dump(state, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname, fname)
+    return state
+
+
+def load(fname):
+    """Return the state stored in checkpoint fname (with the samples
+    of RAM based traces in state['traces']).
+    """
+    with open(fname, 'rb') as fd:
+        state = pickle.load(fd)
+    if 'allocated_length' in state:
+        state['traces'] = _load_traces(fname, state['trace_length'])
+    return state
+
+
+def attach(mc, fname, trace_start=0):
+    """Write a checkpoint to fname whenever mc saves its state.
+
+    pymc.MCMC saves its state every save_interval iterations (see
+    pymc.MCMC.sample()) and once sampling is finished. If the next
+    iteration tunes the step methods, they are tuned before the
+    checkpoint is written (and not again by the sampling loop).
+
+    :Optional:
+        trace_start <int>: Number of samples of RAM based traces
+            already in the trace file (when resuming).
+    """
+    save_state = mc.save_state
+    tune = mc.tune
+    written = [trace_start]
+    tuned_at = [getattr(mc, '_checkpoint_tuned_at', None)]
+
+    def tune_once():
+        if mc._current_iter == tuned_at[0]:
+            # Tuned before the last checkpoint
+            return
+        tune()
+
+    def save_checkpoint():
+        save_state()
+        next_iter = mc._current_iter + 1
+        if mc.status == 'running' and next_iter < mc._iter and mc._tuning \
+           and not next_iter % mc._tune_interval:
+            tune()
+            tuned_at[0] = next_iter
+        mc._checkpoint_tuned_at = tuned_at[0]
+        state = save(mc, fname, trace_start=written[0])
+        written[0] = state['trace_length']
+
+    mc.tune = tune_once
+    mc.save_state = save_checkpoint
+
+
+def _restore_traces(mc, state):
+    """Reopen the chain of the checkpoint so that new samples get appended."""
+    length = state['trace_length']
+    db = mc.db
+    db.connect_model(mc)
+
+    if isinstance(db, kabuki.database.Database):
+        if db.chains <= state['chain']:
+            raise ValueError("Database %s does not contain the chain of the checkpoint." % db.dbname)
+        db.reopen_chain(state['chain'], length, mc._funs_to_tally)
+    else:
+        if 'allocated_length' not in state:
+            raise ValueError("Resuming is only supported for kabuki.database and RAM based backends.")
+        db._initialize(mc._funs_to_tally, state['allocated_length'])
+        chain = db.chains - 1
+        for name, values in state['traces'].iteritems():
+            trace = db._traces.get(name)
+            if not isinstance(trace, pm.database.ram.Trace):
+                raise ValueError("Resuming is only supported for kabuki.database and RAM based backends.")
+            trace._trace[chain][:length] = values
+            trace._index[chain] = length
+
+    # Put traces on objects
+    for v in mc._variables_to_tally:
+        v.trace = db._traces[v.__name__]
+
+
+def restore(mc, fname):
+    """Restore state of mc from checkpoint fname.
+
+    mc has to be created from the same model as the sampler the
+    checkpoint was written from.
+
+    :Returns:
+        The restored state.
+    """
+    state = load(fname)
+
+    mc.assign_step_methods()
+    mc.__dict__.update(state['sampler'])
+
+    for node in mc.stochastics:
+        try:
+            node.value = state['stochastics'][node.__name__]
+        except KeyError:
+            raise KeyError("Node %s not found in checkpoint %s." % (node.__name__, fname))
+
+    for sm in mc.step_methods:
+        sm_state = state['step_methods'].get(step_method_key(sm))
+        if sm_state is not None:
+            set_step_method_state(sm, sm_state)
+
+    if 'tuning_scheduler' in state:
+        scheduler = kabuki.tuning.TuningScheduler(mc)
+        scheduler.set_state(state['tuning_scheduler'])
+        scheduler.attach()
+
+    _restore_traces(mc, state)
+
+    # Last, so that setting up the model does not consume random numbers
+    np.random.set_state(state['rng'])
+
+    return state
+
+
+def resume(mc, fname, checkpoint=None):
+    """Restore mc from checkpoint fname and continue sampling.
+
+    :Arguments:
+        mc <pymc.MCMC>: Sampler of the same model.
+        fname <str>: Checkpoint file.
+
+    :Optional:
+        checkpoint <str>: Keep writing checkpoints to this file
+            (default: fname).
+    """
+    state = restore(mc, fname)
+    if checkpoint is None or checkpoint == fname:
+        attach(mc, fname, trace_start=state['trace_length'])
+    else:
+        if 'traces' in state:
+            # Start the trace file of the new checkpoint with all samples
+            _append_traces(mc, checkpoint, 0, state['trace_length'])
+        attach(mc, checkpoint, trace_start=state['trace_length'])
+
+    mc.pbar = None
+    mc._loop()
+    mc._finalize()
+
+    return mc
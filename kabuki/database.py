@@ -0,0 +1,529 @@
+"""
+Chunked trace database backend for pymc.
+
+Samples are buffered in memory and appended to disk in chunks of
+``chunk_size`` rows. Scalar traces of the same dtype can be stored
+together as columns of one block (``block_size`` > 1) which keeps the
+number of files manageable for models with tens of thousands of
+nodes. Uncompressed blocks are memory-mapped on read, so opening a
+multi-GB database is instantaneous and individual samples can be
+accessed without reading the whole trace. Compressed blocks
+(``compress=True``) are stored as one zlib-compressed file per chunk
+and only the chunks that are touched get decompressed.
+
+Usage:
+
+    >>> model.mcmc(db=kabuki.database, dbname='traces', block_size=100)
+    >>> model.sample(10000, burn=5000)
+
+    >>> model = MyModel(data)
+    >>> model.load_db('traces', db_loader=kabuki.database.load)
+
+The module also provides LazyTrace, a proxy that reads the trace of
+a node from any pymc database only when it is touched and keeps the
+result in a memory-bounded TraceCache (see Hierarchical.load_db(lazy=True)).
+
+Layout of the database directory:
+    meta.json : chunk size, compression, block layout and chain lengths.
+    state.pkl : sampler and step method state (see pymc.Sampler.get_state).
+    c<chain>_b<block>.dat : raw samples of block in chain (uncompressed).
+    c<chain>_b<block>_<chunk>.z : compressed chunk of block in chain.
+
+"""
+from __future__ import division
+
+import os
+import json
+import zlib
+import shutil
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+import numpy as np
+from pymc.database import base
+
+__all__ = ['Trace', 'Database', 'load', 'TraceCache', 'LazyTrace']
+
+
+class Trace(base.Trace):
+    """Chunked Trace
+
+    Values are tallied by the owning Database which writes complete
+    rows of all blocks at once. The Trace only knows where its column
+    is stored and reads it back on request.
+    """
+
+    def _initialize(self, chain, length):
+        # If this db was loaded from the disk, it may not have its
+        # tallied step methods' getfuncs yet.
+        if self._getfunc is None:
+            self._getfunc = self.db.model._funs_to_tally[self.name]
+
+    def tally(self, chain):
+        """Tallying is done for all traces at once by Database.tally()."""
+        pass
+
+    def _column(self, chain):
+        """Return the (possibly memory-mapped) samples of chain."""
+        block, col = self.db._columns[self.name]
+        values = self.db._read_block(chain, block)
+        if col is not None:
+            values = values[:, col]
+        return values
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """Return the trace.
+
+        :Arguments:
+            burn <int=0>: The number of transient steps to skip.
+            thin <int=1>: Keep one in thin.
+            chain <int=-1>: The index of the chain to fetch. If None, return all chains.
+            slicing <slice>: A slice, overriding burn and thin assignement.
+        """
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        if chain is not None:
+            chain = range(self.db.chains)[chain]
+            return np.asarray(self._column(chain)[slicing])
+        else:
+            return np.concatenate([self._column(c) for c in range(self.db.chains)])[slicing]
+
+    __call__ = gettrace
+
+    def __getitem__(self, index):
+        chain = self._chain
+        if chain is None:
+            return self.gettrace(chain=None)[index]
+
+        chain = range(self.db.chains)[chain]
+        if isinstance(index, (int, long, np.integer)) and self.db.compress:
+            # Only decompress the chunk containing the sample
+            block, col = self.db._columns[self.name]
+            row = self.db._read_row(chain, block, index)
+            return row if col is None else row[col]
+
+        return np.asarray(self._column(chain)[index])
+
+    def length(self, chain=-1):
+        """Return the length of the trace.
+
+        :Arguments:
+            chain <int=-1>: The chain index. If None, returns the combined
+                length of all chains.
+        """
+        if chain is not None:
+            return self.db._lengths[range(self.db.chains)[chain]]
+        else:
+            return sum(self.db._lengths)
+
+
+class Database(base.Database):
+    """Chunked, optionally compressed, memory-mapped database.
+
+    :Arguments:
+        dbname <str>: Directory the traces are stored in.
+
+    :Optional:
+        dbmode <str='a'>: Use 'a' to append chains to an existing
+            database and 'w' to overwrite it.
+        chunk_size <int=1000>: Number of samples buffered in memory
+            before they get written to disk.
+        compress <bool=False>: Compress chunks with zlib. Compressed
+            traces can not be memory-mapped.
+        complevel <int=4>: zlib compression level.
+        block_size <int=1>: Number of scalar traces stored as columns
+            of one array. 1 stores each node separately.
+    """
+
+    def __init__(self, dbname, dbmode='a', chunk_size=1000, compress=False,
+                 complevel=4, block_size=1):
+        self.__name__ = 'chunked'
+        self.__Trace__ = Trace
+        self.dbname = dbname
+        self.trace_names = []   # A list of sequences of names of the objects to tally.
+        self._traces = {} # A dictionary of the Trace objects.
+        self.chains = 0
+
+        self.chunk_size = int(chunk_size)
+        self.compress = bool(compress)
+        self.complevel = complevel
+        self.block_size = max(int(block_size), 1)
+
+        # Layout: list of blocks and mapping of trace name to (block, column)
+        self._blocks = []
+        self._columns = {}
+        # Per chain bookkeeping
+        self._lengths = []
+        self._chunks = []
+        self._buffers = {}
+        self._filled = {}
+        self._cache = {}
+
+        if dbmode == 'w' and os.path.exists(dbname):
+            shutil.rmtree(dbname)
+
+        if os.path.exists(self._path('meta.json')):
+            self._read_meta()
+        elif not os.path.isdir(dbname):
+            os.makedirs(dbname)
+
+    def _path(self, fname):
+        return os.path.join(self.dbname, fname)
+
+    def _block_fname(self, chain, block, chunk=None):
+        if chunk is None:
+            return self._path('c%i_b%i.dat' % (chain, block))
+        else:
+            return self._path('c%i_b%i_%i.z' % (chain, block, chunk))
+
+    def _add_to_layout(self, funs_to_tally):
+        """Assign traces that have no storage location yet to blocks."""
+        new_names = sorted([name for name in funs_to_tally if name not in self._columns])
+        open_blocks = {}
+        for name in new_names:
+            value = np.asarray(funs_to_tally[name]())
+            if value.dtype == object:
+                raise TypeError("Trace %s has object dtype and can not be stored." % name)
+            dtype = value.dtype.str
+
+            if value.shape != () or self.block_size == 1:
+                # Arrays and unblocked scalars get their own block
+                self._blocks.append({'dtype': dtype, 'shape': list(value.shape), 'names': [name]})
+                self._columns[name] = (len(self._blocks) - 1, None)
+                continue
+
+            block = open_blocks.get(dtype)
+            if block is None or len(self._blocks[block]['names']) == self.block_size:
+                self._blocks.append({'dtype': dtype, 'shape': [0], 'names': []})
+                block = open_blocks[dtype] = len(self._blocks) - 1
+            col = len(self._blocks[block]['names'])
+            self._blocks[block]['names'].append(name)
+            self._blocks[block]['shape'] = [col + 1]
+            self._columns[name] = (block, col)
+
+    def _row_shape(self, block):
+        return tuple(self._blocks[block]['shape'])
+
+    def _initialize(self, funs_to_tally, length=None):
+        """Create traces and buffers for a new chain."""
+        self._add_to_layout(funs_to_tally)
+
+        chain = self.chains
+        # Remove leftovers of an earlier run that never made it into meta.json
+        for block in range(len(self._blocks)):
+            if os.path.exists(self._block_fname(chain, block)):
+                os.remove(self._block_fname(chain, block))
+
+        self._lengths.append(0)
+        self._chunks.append([])
+        self._open_chain(chain, funs_to_tally)
+
+        base.Database._initialize(self, funs_to_tally, length)
+        self._write_meta()
+
+    def _open_chain(self, chain, funs_to_tally):
+        """Set up buffers to tally funs_to_tally into chain."""
+        self._filled[chain] = 0
+        self._buffers[chain] = [np.zeros((self.chunk_size,) + self._row_shape(b),
+                                         dtype=self._blocks[b]['dtype'])
+                                for b in range(len(self._blocks))]
+        # Track which traces are tallied in this chain; others are left at zero
+        self._tallied = [(name, self._columns[name]) for name in funs_to_tally
+                         if name in self._columns]
+
+    def reopen_chain(self, chain, length, funs_to_tally):
+        """Continue tallying into an existing chain.
+
+        Samples after length are discarded, so that a chain can be
+        continued from an earlier state of the sampler (see
+        kabuki.checkpoint).
+
+        :Arguments:
+            chain <int>: Index of the chain.
+            length <int>: Number of samples to keep.
+            funs_to_tally <dict>: Name-function pairs of the tallied objects.
+        """
+        chain = range(self.chains)[chain]
+        self._trim(chain, length)
+
+        for name, fun in funs_to_tally.iteritems():
+            if name in self._traces:
+                self._traces[name]._getfunc = fun
+        self._open_chain(chain, funs_to_tally)
+        self._write_meta()
+
+    def tally(self, chain=-1):
+        """Append the current value of all tallyable objects."""
+        chain = range(self.chains)[chain]
+        buffers = self._buffers[chain]
+        row = self._filled[chain]
+        for name, (block, col) in self._tallied:
+            value = self._traces[name]._getfunc()
+            if col is None:
+                buffers[block][row] = value
+            else:
+                buffers[block][row, col] = value
+
+        self._filled[chain] += 1
+        self._lengths[chain] += 1
+        if self._filled[chain] == self.chunk_size:
+            self._flush(chain)
+
+    def _flush(self, chain):
+        """Write buffered rows of chain to disk."""
+        filled = self._filled.get(chain, 0)
+        if filled == 0:
+            return
+
+        for block, buffer in enumerate(self._buffers[chain]):
+            rows = buffer[:filled]
+            if self.compress:
+                fname = self._block_fname(chain, block, len(self._chunks[chain]))
+                with open(fname, 'wb') as fd:
+                    fd.write(zlib.compress(rows.tobytes(), self.complevel))
+            else:
+                with open(self._block_fname(chain, block), 'ab') as fd:
+                    fd.write(rows.tobytes())
+
+        self._chunks[chain].append(filled)
+        self._filled[chain] = 0
+        self._clear_cache(chain)
+
+    def _clear_cache(self, chain):
+        for key in self._cache.keys():
+            if key[0] == chain:
+                del self._cache[key]
+
+    def _read_chunk(self, chain, block, chunk):
+        """Decompress and return one chunk of block."""
+        with open(self._block_fname(chain, block, chunk), 'rb') as fd:
+            raw = zlib.decompress(fd.read())
+        return np.frombuffer(raw, dtype=self._blocks[block]['dtype']).reshape((-1,) + self._row_shape(block))
+
+    def _read_block(self, chain, block):
+        """Return all samples of block in chain as array of shape (samples,) + row shape."""
+        self._flush(chain)
+
+        key = (chain, block)
+        if key in self._cache:
+            return self._cache[key]
+
+        length = self._lengths[chain]
+        dtype = np.dtype(self._blocks[block]['dtype'])
+        shape = (length,) + self._row_shape(block)
+        if length == 0:
+            values = np.empty(shape, dtype=dtype)
+        elif self.compress:
+            values = np.concatenate([self._read_chunk(chain, block, chunk)
+                                     for chunk in range(len(self._chunks[chain]))])[:length]
+            # Only keep the last decompressed block around
+            self._cache.clear()
+        else:
+            values = np.memmap(self._block_fname(chain, block), dtype=dtype, mode='r', shape=shape)
+
+        self._cache[key] = values
+        return values
+
+    def _read_row(self, chain, block, index):
+        """Return sample index of block without decompressing the whole trace."""
+        self._flush(chain)
+        index = range(self._lengths[chain])[index]
+        offsets = np.cumsum(self._chunks[chain])
+        chunk = np.searchsorted(offsets, index, side='right')
+        start = offsets[chunk] - self._chunks[chain][chunk]
+        return self._read_chunk(chain, block, chunk)[index - start]
+
+    def _trim(self, chain, length):
+        """Discard the samples of chain after length on disk."""
+        self._flush(chain)
+        length = min(length, self._lengths[chain])
+
+        if self.compress:
+            # Keep complete chunks, rewrite a partially kept one and
+            # remove the rest
+            offsets = np.cumsum(self._chunks[chain])
+            keep = np.searchsorted(offsets, length, side='right')
+            partial = length - (offsets[keep-1] if keep else 0)
+            n_chunks = len(self._chunks[chain])
+            self._chunks[chain] = self._chunks[chain][:keep]
+            for block in range(len(self._blocks)):
+                if partial:
+                    rows = self._read_chunk(chain, block, keep)[:partial]
+                    with open(self._block_fname(chain, block, keep), 'wb') as fd:
+                        fd.write(zlib.compress(rows.tobytes(), self.complevel))
+                for chunk in range(keep + bool(partial), n_chunks):
+                    if os.path.exists(self._block_fname(chain, block, chunk)):
+                        os.remove(self._block_fname(chain, block, chunk))
+            if partial:
+                self._chunks[chain].append(int(partial))
+        else:
+            for block in range(len(self._blocks)):
+                row_bytes = np.dtype(self._blocks[block]['dtype']).itemsize * int(np.prod(self._row_shape(block)))
+                with open(self._block_fname(chain, block), 'ab') as fd:
+                    fd.truncate(length * row_bytes)
+            self._chunks[chain] = [length] if length else []
+
+        self._lengths[chain] = length
+        self._clear_cache(chain)
+
+    def truncate(self, index, chain=-1):
+        """Truncate chain at index, discarding the later samples on
+        disk.
+        """
+        chain = range(self.chains)[chain]
+        self._trim(chain, index)
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {'chunk_size': self.chunk_size,
+                'compress': self.compress,
+                'block_size': self.block_size,
+                'blocks': self._blocks,
+                'columns': self._columns,
+                'lengths': self._lengths,
+                'chunks': self._chunks,
+                'trace_names': self.trace_names}
+        with open(self._path('meta.json'), 'w') as fd:
+            json.dump(meta, fd)
+
+    def _read_meta(self):
+        with open(self._path('meta.json')) as fd:
+            meta = json.load(fd)
+
+        self.chunk_size = meta['chunk_size']
+        self.compress = meta['compress']
+        self.block_size = meta['block_size']
+        self._blocks = meta['blocks']
+        self._lengths = meta['lengths']
+        self._chunks = meta['chunks']
+        self.trace_names = meta['trace_names']
+        self.chains = len(self._lengths)
+        for desc in self._blocks:
+            desc['dtype'] = str(desc['dtype'])
+
+        for name, (block, col) in meta['columns'].iteritems():
+            name = str(name)
+            self._columns[name] = (block, col)
+            self._traces[name] = Trace(name=name, db=self)
+
+        if os.path.exists(self._path('state.pkl')):
+            with open(self._path('state.pkl'), 'rb') as fd:
+                self._state_ = pickle.load(fd)
+
+    def commit(self):
+        """Flush buffered samples, layout and sampler state to disk."""
+        for chain in range(self.chains):
+            self._flush(chain)
+        self._write_meta()
+
+        if hasattr(self, '_state_'):
+            with open(self._path('state.pkl'), 'wb') as fd:
+                pickle.dump(self._state_, fd, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.commit()
+        self._cache.clear()
+
+
+def load(dbname):
+    """Load an existing chunked database.
+
+    Return a Database instance.
+    """
+    if not os.path.exists(os.path.join(dbname, 'meta.json')):
+        raise IOError("No chunked database found at %s." % dbname)
+
+    db = Database(dbname, dbmode='a')
+    if not hasattr(db, '_state_'):
+        db._state_ = {}
+
+    return db
+
+
+class TraceCache(object):
+    """Least recently used cache of trace arrays bounded by memory.
+
+    :Optional:
+        max_bytes <int=2**28>: Maximum number of bytes kept in the
+            cache. The most recently used trace is always kept.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays = OrderedDict()
+
+    def get(self, key, loader):
+        """Return array stored under key, calling loader() if it is missing."""
+        try:
+            values = self._arrays.pop(key)
+        except KeyError:
+            values = np.asarray(loader())
+            self.nbytes += values.nbytes
+        self._arrays[key] = values
+
+        while self.nbytes > self.max_bytes and len(self._arrays) > 1:
+            evicted = self._arrays.popitem(last=False)[1]
+            self.nbytes -= evicted.nbytes
+
+        return values
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._arrays)
+
+
+class LazyTrace(object):
+    """Proxy for the trace of a node stored in a pymc database.
+
+    Nothing is read until the trace is called or indexed. The samples
+    of a chain are then loaded once and kept in cache.
+
+    :Arguments:
+        db <pymc.database.base.Database>: Database holding the trace.
+        name <str>: Name of the node.
+        cache <TraceCache>: Cache shared between traces.
+    """
+
+    def __init__(self, db, name, cache):
+        self.db = db
+        self.name = name
+        self.cache = cache
+        self._chain = -1
+
+    def _values(self, chain):
+        if chain is not None:
+            chain = range(self.db.chains)[chain]
+        return self.cache.get((self.name, chain),
+                              lambda: self.db.trace(self.name, chain=chain)(chain=chain))
+
+    def gettrace(self, burn=0, thin=1, chain=-1, slicing=None):
+        """Return the trace (see pymc.database.base.Trace.gettrace)."""
+        if slicing is None:
+            slicing = slice(burn, None, thin)
+        return self._values(chain)[slicing]
+
+    __call__ = gettrace
+
+    def __getitem__(self, index):
+        return self._values(self._chain)[index]
+
+    def __len__(self):
+        return self.length(self._chain)
+
+    def length(self, chain=-1):
+        return self.db.trace(self.name, chain=chain).length(chain)
+
+    def stats(self, *args, **kwargs):
+        return self.db.trace(self.name).stats(*args, **kwargs)
@@ -31,7 +31,47 @@ def _add_noise(params, noise=.1, exclude_params=()):
 
     return params
 
-def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_params=(), column_name='data'):
+def _add_noise_vectorized(params, size, noise=.1, exclude_params=()):
+    """Draw parameters of size subjects around params (see _add_noise()).
+
+        :Returns:
+            params : dict
+                Parameter names and arrays of length size.
+
+    """
+    subj_params = {}
+    for param, value in params.iteritems():
+        if param not in exclude_params:
+            subj_params[param] = np.random.normal(loc=value, scale=noise, size=size)
+        else:
+            subj_params[param] = np.ones(size) * value
+
+    return subj_params
+
+def _create_data(subjs, conditions, samples, column_name, dtype, filename=None, chunk_subjs=1000):
+    """Return the data array of gen_rand_data(), ordered by subject,
+    condition and sample, with subj_idx and condition filled in, or a
+    memory-mapped .npy file if filename is given.
+    """
+    data_dtype = [('subj_idx', np.int32), ('condition', 'S20'), (column_name, dtype)]
+    size = subjs * len(conditions) * samples
+    if filename is None:
+        data = np.empty(size, dtype=data_dtype)
+    else:
+        data = np.lib.format.open_memmap(filename, mode='w+', dtype=data_dtype, shape=(size,))
+
+    rows = len(conditions) * samples
+    subj_conditions = np.repeat(np.array(conditions, dtype='S20'), samples)
+    for chunk_start in range(0, subjs, chunk_subjs):
+        chunk_stop = min(chunk_start + chunk_subjs, subjs)
+        block = slice(chunk_start * rows, chunk_stop * rows)
+        data['subj_idx'][block] = np.repeat(np.arange(chunk_start, chunk_stop), rows)
+        data['condition'][block] = np.tile(subj_conditions, chunk_stop - chunk_start)
+
+    return data
+
+def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_params=(), column_name='data',
+                  vectorized=False, filename=None, chunk_subjs=1000):
     """Generate a random dataset using a user-defined random distribution.
 
     :Arguments:
@@ -59,6 +99,19 @@ def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_para
             Do not add noise to these parameters.
         column_name : str <default='data'>
             What to name the data column.
+        vectorized : bool <default=False>
+            Draw the parameters of all subjects at once and sample
+            each condition with one call of dist.rv.random() with
+            parameter arrays (the distribution has to support
+            broadcasting). Much faster for many subjects, but the
+            random numbers are drawn in a different order.
+        filename : str <default=None>
+            Stream the data into a memory-mapped .npy file (see
+            numpy.load(mmap_mode='r')), chunk_subjs subjects at a
+            time, so that datasets larger than the memory can be
+            generated. Implies vectorized.
+        chunk_subjs : int <default=1000>
+            Number of subjects generated at once if vectorized.
 
     :Returns:
         data : numpy structured array
@@ -69,8 +122,6 @@ def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_para
             and no dict if there is only 1 condition.
 
     """
-    from itertools import product
-
     # Check if only dict of params was passed, i.e. no conditions
     if not isinstance(params[params.keys()[0]], dict):
         params = {'none': params}
@@ -78,22 +129,48 @@ def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_para
     subj_params = {}
 
     dtype = np.dtype(dist.dtype)
-
-    idx = list(product(range(subjs), params.keys(), range(samples)))
-    data = np.array(idx, dtype=[('subj_idx', np.int32), ('condition', 'S20'), (column_name, dtype)])
-
-    for condition, param in params.iteritems():
-        subj_params[condition] = []
-        for subj_idx in range(subjs):
-            if subjs > 1:
-                # Sample subject parameters from a normal around the specified parameters
-                subj_param = _add_noise(param, noise=subj_noise, exclude_params=exclude_params)
-            else:
-                subj_param = param
-            subj_params[condition].append(subj_param)
-            samples_from_dist = dist.rv.random(size=samples, **subj_param)
-            idx = (data['subj_idx'] == subj_idx) & (data['condition'] == condition)
-            data[column_name][idx] = np.array(samples_from_dist, dtype=dtype)
+    conditions = params.keys()
+
+    data = _create_data(subjs, conditions, samples, column_name, dtype,
+                        filename=filename, chunk_subjs=chunk_subjs)
+    # (subjects x conditions x samples) view of the samples
+    values = data[column_name].reshape(subjs, len(conditions), samples)
+
+    if vectorized or filename is not None:
+        for condition in conditions:
+            subj_params[condition] = []
+        for chunk_start in range(0, subjs, chunk_subjs):
+            chunk = slice(chunk_start, min(chunk_start + chunk_subjs, subjs))
+            size = chunk.stop - chunk.start
+            for condition_idx, condition in enumerate(conditions):
+                if subjs > 1:
+                    chunk_params = _add_noise_vectorized(params[condition], size, noise=subj_noise,
+                                                         exclude_params=exclude_params)
+                else:
+                    chunk_params = dict((key, np.array([value])) for key, value in params[condition].iteritems())
+                values[chunk, condition_idx, :] = dist.rv.random(size=(size, samples),
+                    **dict((key, value[:, np.newaxis]) for key, value in chunk_params.iteritems()))
+                subj_params[condition].extend([dict((key, value[i]) for key, value in chunk_params.iteritems())
+                                               for i in range(size)])
+        if subjs == 1:
+            for condition in conditions:
+                subj_params[condition] = [params[condition]]
+    else:
+        for condition_idx, condition in enumerate(conditions):
+            param = params[condition]
+            subj_params[condition] = []
+            for subj_idx in range(subjs):
+                if subjs > 1:
+                    # Sample subject parameters from a normal around the specified parameters
+                    subj_param = _add_noise(param, noise=subj_noise, exclude_params=exclude_params)
+                else:
+                    subj_param = param
+                subj_params[condition].append(subj_param)
+                samples_from_dist = dist.rv.random(size=samples, **subj_param)
+                values[subj_idx, condition_idx, :] = np.array(samples_from_dist, dtype=dtype)
+
+    if filename is not None:
+        data.flush()
 
     # Remove list around subj_params if there is only 1 subject
     if subjs == 1:
@@ -105,4 +182,3 @@ def gen_rand_data(dist, params, samples=50, subjs=1, subj_noise=.1, exclude_para
         subj_params = subj_params[subj_params.keys()[0]]
 
     return data, subj_params
-
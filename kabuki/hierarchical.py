@@ -12,10 +12,10 @@ except ImportError:
 
 import pymc as pm
 import warnings
+import os
 
 import kabuki
 from copy import copy, deepcopy
-from matplotlib.mlab import rec_drop_fields
 
 
 class Parameter(object):
@@ -38,12 +38,18 @@ class Parameter(object):
         default <float>: Default value if optional=True.
         verbose <int=0>: Verbosity.
         var_type <string>: type of the var node, can be one of ['std', 'precision', 'sample_size']
+        non_centered <bool=False>: Create subj nodes as deterministic
+            group + var * offset with a standard normal offset node
+            per subject (see get_subj_offset_node()). Avoids the funnel
+            between var and subj nodes when subjects have few trials.
+            Note, that lower and upper are not enforced on the subj
+            nodes in this case.
     """
 
     def __init__(self, name, create_group_node=True, create_subj_nodes=True,
                  is_bottom_node=False, lower=None, upper=None, init=None,
                  vars=None, default=None, optional=False, var_lower=1e-3,
-                 var_upper=10, var_type='std', verbose=0):
+                 var_upper=10, var_type='std', non_centered=False, verbose=0):
         self.name = name
         self.create_group_node = create_group_node
         self.create_subj_nodes = create_subj_nodes
@@ -58,6 +64,7 @@ class Parameter(object):
         self.var_lower = var_lower
         self.var_upper = var_upper
         self.var_type = var_type
+        self.non_centered = non_centered
 
         if self.optional and self.default is None:
             raise ValueError("Optional parameters have to have a default value.")
@@ -69,6 +76,7 @@ class Parameter(object):
         self.group_nodes = OrderedDict()
         self.var_nodes = OrderedDict()
         self.subj_nodes = OrderedDict()
+        self.offset_nodes = OrderedDict()
         self.bottom_nodes = OrderedDict()
 
         # Pointers that get overwritten
@@ -158,6 +166,18 @@ class Hierarchical(object):
         replace_params : list of Parameters
             User defined parameters to replace the default ones.
 
+        sufficient_stats : bool
+            Compute the likelihood of supported bottom nodes (e.g.
+            Normal, Bernoulli, Binomial, Poisson) from sufficient
+            statistics of their data instead of all trials (see
+            kabuki.likelihoods).
+
+        compress : bool
+            Evaluate the likelihood of bottom nodes only at the
+            unique values of their data, weighted by their counts
+            (see kabuki.likelihoods). Much faster for discrete data
+            with many identical observations.
+
     :Note:
         This class must be inherited. The child class must provide
         the following functions:
@@ -175,12 +195,16 @@ class Hierarchical(object):
     """
 
     def __init__(self, data, is_group_model=None, depends_on=None, trace_subjs=True,
-                 plot_subjs=False, plot_var=False, include=(), replace_params=None):
+                 plot_subjs=False, plot_var=False, include=(), replace_params=None,
+                 sufficient_stats=False, compress=False):
         # Init
         self.include = set(include)
+        self.sufficient_stats = sufficient_stats
+        self.compress = compress
 
         self.nodes = {}
         self.mc = None
+        self.approx_mc = None
         self.trace_subjs = trace_subjs
         self.plot_subjs = plot_subjs
         self.plot_var = plot_var
@@ -342,7 +366,7 @@ class Hierarchical(object):
 
             return [(data, params, dep_name, dep_name_str)]
 
-    def create_nodes(self, max_retries=8):
+    def create_nodes(self, max_retries=8, group_only=False):
         """Set group level distributions. One distribution for each
         parameter.
 
@@ -350,6 +374,11 @@ class Hierarchical(object):
             max_retries : int
                 How often to retry when model creation
                 failed (due to bad starting values).
+            group_only : bool
+                Only create group and var nodes but no subject
+                and bottom nodes. The resulting model can be used
+                to look at group parameters of a loaded database
+                but can not be sampled.
 
         """
         def _create():
@@ -359,9 +388,12 @@ class Hierarchical(object):
                     continue
                 # Check if parameter depends on data
                 if name in self.depends_on.keys():
-                    self._set_dependent_param(param)
+                    self._set_dependent_param(param, group_only=group_only)
                 else:
-                    self._set_independet_param(param)
+                    self._set_independet_param(param, group_only=group_only)
+
+            if group_only:
+                return
 
             # Init bottom nodes
             for param in self.params_include.itervalues():
@@ -404,6 +436,7 @@ class Hierarchical(object):
         self.group_nodes = {}
         self.var_nodes = {}
         self.subj_nodes = {}
+        self.offset_nodes = {}
         self.bottom_nodes = {}
 
         for name, param in self.params_include.iteritems():
@@ -416,6 +449,9 @@ class Hierarchical(object):
             for tag, node in param.var_nodes.iteritems():
                 self.nodes[name+tag+'_var'] = node
                 self.var_nodes[name+tag] = node
+            for tag, node in param.offset_nodes.iteritems():
+                self.nodes[name+tag+'_offset'] = node
+                self.offset_nodes[name+tag] = node
             for tag, node in param.bottom_nodes.iteritems():
                 self.nodes[name+tag+'_bottom'] = node
                 self.bottom_nodes[name+tag] = node
@@ -431,9 +467,14 @@ class Hierarchical(object):
                 How many runs to make with different starting values
             warn_crit: float
                 How far must the two best fitting values be apart in order to print a warning message
+            method : str
+                Optimizer of pymc.MAP.fit() or 'gradient' for L-BFGS in
+                unconstrained space with analytical or local finite
+                difference gradients (see kabuki.optimize). Scales to
+                thousands of parameters.
 
         :Returns:
-            pymc.MAP object of model.
+            pymc.MAP (or kabuki.optimize.GradientMAP) object of model.
 
         :Note:
             Forwards additional keyword arguments to pymc.MAP().
@@ -450,8 +491,12 @@ class Hierarchical(object):
             if (i > 0) or (not self.nodes):
                 self.create_nodes()
 
-            m = pm.MAP(self.nodes)
-            m.fit(method, **kwargs)
+            if method == 'gradient':
+                m = kabuki.optimize.GradientMAP(self.nodes, bounds=self._get_node_bounds())
+                m.fit(**kwargs)
+            else:
+                m = pm.MAP(self.nodes)
+                m.fit(method, **kwargs)
             print m.logp
             maps.append(m)
 
@@ -470,9 +515,9 @@ class Hierarchical(object):
         for name, node in max_map._dict_container.iteritems():
             if isinstance(node, pm.ArrayContainer):
                 for i,subj_node in enumerate(node):
-                    if isinstance(node, pm.Node) and not subj_node.observed:
+                    if isinstance(subj_node, pm.Stochastic) and not subj_node.observed:
                         self.nodes[name][i].value = subj_node.value
-            elif isinstance(node, pm.Node) and not node.observed:
+            elif isinstance(node, pm.Stochastic) and not node.observed:
                 self.nodes[name].value = node.value
 
         return max_map
@@ -481,25 +526,260 @@ class Hierarchical(object):
         """
         Returns pymc.MCMC object of model.
 
+        :Optional:
+            blocked : bool
+                Sample the parameters of each subject and each
+                group/var pair jointly with AdaptiveMetropolis
+                (see use_blocked_step_methods()).
+            gibbs : bool
+                Update conjugate group and var nodes with Gibbs
+                steps (see use_gibbs_step_methods()).
+            slice : bool
+                Update group, var and subj nodes with slice
+                sampling (see use_slice_step_methods()). Combined
+                with blocked=True, blocks are slice sampled.
+            approximation : kabuki.laplace.Laplace
+                Initialize the proposals of blocked step methods
+                with the covariance of the approximation (e.g.
+                returned by fit_laplace()). Requires blocked=True
+                and cannot be combined with slice=True.
+
         :Note:
-            Forwards arguments to pymc.MCMC().
+            Forwards arguments to pymc.MCMC(). To store traces in
+            chunked, memory-mappable files pass db=kabuki.database
+            together with dbname (see kabuki.database).
 
         """
+        blocked = kwargs.pop('blocked', False)
+        gibbs = kwargs.pop('gibbs', False)
+        use_slice = kwargs.pop('slice', False)
+        approximation = kwargs.pop('approximation', None)
+
+        if approximation is not None and (use_slice or not blocked):
+            raise ValueError("approximation only initializes the proposals of blocked "
+                             "Metropolis steps: pass blocked=True and not slice=True.")
 
         if not self.nodes:
             self.create_nodes()
 
         self.mc = pm.MCMC(self.nodes, *args, **kwargs)
 
+        # Gibbs steps first, the other methods skip nodes that have one
+        if gibbs:
+            self.use_gibbs_step_methods()
+        if use_slice:
+            self.use_slice_step_methods(blocked=blocked)
+        elif blocked:
+            self.use_blocked_step_methods(approximation=approximation)
+
         return self.mc
 
+    def _get_blocks(self, subjs=True, group=True):
+        """Return lists of stochastics that are sampled jointly by
+        use_blocked_step_methods().
+        """
+        def sampled(node):
+            return isinstance(node, pm.Stochastic) and not node.observed and \
+                np.dtype(node.dtype).kind != 'b'
+
+        blocks = []
+        if group:
+            for param in self.params_include.itervalues():
+                if param.is_bottom_node:
+                    continue
+                for tag, group_node in param.group_nodes.iteritems():
+                    block = [node for node in (group_node, param.var_nodes.get(tag))
+                             if node is not None and sampled(node)]
+                    blocks.append(block)
+
+        if subjs and self.is_group_model:
+            subj_blocks = [[] for i in range(self._num_subjs)]
+            for param in self.params_include.itervalues():
+                if param.is_bottom_node:
+                    continue
+                for tag, nodes in param.subj_nodes.iteritems():
+                    # Non-centered subj nodes are sampled via their offsets
+                    nodes = param.offset_nodes.get(tag, nodes)
+                    for i, node in enumerate(nodes):
+                        if sampled(node):
+                            subj_blocks[i].append(node)
+            blocks += subj_blocks
+
+        # Single nodes keep the default step method
+        return [block for block in blocks if len(block) > 1]
+
+    def use_blocked_step_methods(self, subjs=True, group=True, **kwargs):
+        """Assign AdaptiveMetropolis step methods to blocks of
+        correlated parameters:
+            * all parameters (over all conditions) of a subject and
+            * the group and var node of each parameter and condition.
+
+        Stochastics not in a block and stochastics that already have
+        a step method (e.g. a Gibbs step, see
+        use_gibbs_step_methods()) are left out of the blocks and keep
+        their step method.
+
+        :Optional:
+            subjs : bool
+                Block the parameters of each subject.
+            group : bool
+                Block each group node with its var node.
+            approximation : kabuki.laplace.Laplace
+                Initialize the proposal covariances with the
+                covariance of the approximation.
+
+        :Note:
+            Forwards additional keyword arguments (e.g. delay,
+            interval) to pymc.AdaptiveMetropolis().
+
+        """
+        approximation = kwargs.pop('approximation', None)
+
+        if self.mc is None:
+            self.mcmc()
+
+        for block in self._get_blocks(subjs=subjs, group=group):
+            block = [node for node in block if not self.mc.step_method_dict[node]]
+            if len(block) < 2:
+                continue
+            if approximation is None:
+                self.mc.use_step_method(pm.AdaptiveMetropolis, block, **kwargs)
+                continue
+            # Placeholder, the order of the stochastics is only known
+            # after construction.
+            dim = sum([np.size(node.value) for node in block])
+            self.mc.use_step_method(pm.AdaptiveMetropolis, block, cov=np.eye(dim), **kwargs)
+            approximation.set_proposal_covariance(self.mc.step_method_dict[block[0]][-1])
+
+        return self.mc
+
+    def _get_node_bounds(self):
+        """Return dict mapping the group, var and subj nodes to the
+        bounds given by their Parameter.
+        """
+        bounds = {}
+        for param in self.params_include.itervalues():
+            if param.is_bottom_node:
+                continue
+            for node in param.group_nodes.itervalues():
+                bounds[node] = (param.lower, param.upper)
+            for node in param.var_nodes.itervalues():
+                bounds[node] = (param.var_lower, param.var_upper)
+            for tag, nodes in param.subj_nodes.iteritems():
+                if tag in param.offset_nodes:
+                    # Offsets are unbounded
+                    continue
+                for node in nodes:
+                    bounds[node] = (param.lower, param.upper)
+        bounds.pop(None, None)
+        return bounds
+
+    def use_slice_step_methods(self, blocked=False, **kwargs):
+        """Update all group, var and subj nodes that have no step
+        method assigned yet with slice sampling (see
+        kabuki.step_methods.Slice). The slices are restricted to the
+        support of the distribution of each node.
+
+        :Optional:
+            blocked : bool
+                Slice sample the blocks of use_blocked_step_methods()
+                jointly.
+
+        :Note:
+            Forwards additional keyword arguments (e.g. width) to
+            kabuki.step_methods.Slice().
+
+        """
+        from kabuki.step_methods import Slice
+
+        if self.mc is None:
+            self.mcmc()
+
+        def unassigned(nodes):
+            return [node for node in nodes if not self.mc.step_method_dict[node]]
+
+        if blocked:
+            for block in self._get_blocks():
+                block = unassigned(block)
+                if len(block) > 1:
+                    self.mc.use_step_method(Slice, block, **kwargs)
+
+        nodes = [node for node in self._get_node_bounds().keys() + self._get_offset_nodes()
+                 if isinstance(node, pm.Stochastic) and not node.observed]
+        for node in unassigned(nodes):
+            self.mc.use_step_method(Slice, [node], **kwargs)
+
+        return self.mc
+
+    def _get_offset_nodes(self):
+        """Return the offset nodes of all non-centered parameters."""
+        return [node for param in self.params_include.itervalues()
+                for nodes in param.offset_nodes.itervalues()
+                for node in nodes]
+
+    def use_gibbs_step_methods(self):
+        """Update group and var nodes with a (semi-)conjugate
+        configuration (e.g. Normal subj nodes with Uniform group and
+        var nodes) with Gibbs steps computed from the current values
+        of the subj nodes (see kabuki.step_methods).
+
+        Non-conjugate nodes keep the pymc default step method
+        (Metropolis).
+
+        :Returns:
+            Number of nodes with Gibbs steps.
+        """
+        from kabuki.step_methods import GroupMeanGibbs, GroupVarGibbs
+
+        if self.mc is None:
+            self.mcmc()
+
+        assigned = 0
+        for param in self.params_include.itervalues():
+            if param.is_bottom_node:
+                continue
+            for nodes, step_method in ((param.group_nodes, GroupMeanGibbs),
+                                       (param.var_nodes, GroupVarGibbs)):
+                for node in nodes.itervalues():
+                    if node is None or not step_method.applicable(node):
+                        continue
+                    self.mc.use_step_method(step_method, node)
+                    assigned += 1
+
+        return assigned
+
     def sample(self, *args, **kwargs):
         """Sample from posterior.
 
+        :Optional:
+            checkpoint : str
+                File to periodically write the complete sampler
+                state to. An interrupted run can be continued
+                with resume() (see kabuki.checkpoint).
+            checkpoint_interval : int
+                Write a checkpoint every checkpoint_interval
+                iterations (default 1000).
+            tune_proposals : bool
+                Tune the proposals of all Metropolis step methods
+                towards their optimal acceptance rate during burn-in
+                and keep them fixed afterwards (see kabuki.tuning).
+                The final scales are stored in self.proposal_scales.
+            target_acceptance : float
+                Acceptance rate tune_proposals aims for (default:
+                optimal rate for the dimension of each step method).
+            proposal_scales : dict
+                Initial proposal scales, e.g. proposal_scales of an
+                earlier fit of the same model.
+
         :Note:
             Forwards arguments to pymc.MCMC.sample().
 
         """
+        checkpoint = kwargs.pop('checkpoint', None)
+        checkpoint_interval = kwargs.pop('checkpoint_interval', 1000)
+        tune_proposals = kwargs.pop('tune_proposals', False)
+        target_acceptance = kwargs.pop('target_acceptance', None)
+        proposal_scales = kwargs.pop('proposal_scales', None)
 
         # init mc if needed
         if self.mc == None:
@@ -510,32 +790,176 @@ class Hierarchical(object):
            isinstance(self.mc.db, pm.database.hdf5.Database):
             warnings.simplefilter('ignore', pm.database.hdf5.tables.NaturalNameWarning)
 
+        scheduler = None
+        if tune_proposals or proposal_scales is not None:
+            scheduler = kabuki.tuning.TuningScheduler(self.mc, target=target_acceptance)
+            if proposal_scales is not None:
+                scheduler.set_scales(proposal_scales)
+        if tune_proposals:
+            scheduler.attach()
+            kwargs.setdefault('tune_interval', 100)
+            kwargs['tune_throughout'] = False
+
+        # After the scheduler, so that checkpoints are written after tuning
+        if checkpoint is not None:
+            kabuki.checkpoint.attach(self.mc, checkpoint)
+            kwargs['save_interval'] = checkpoint_interval
+
         print self.mc.db
         # sample
         self.mc.sample(*args, **kwargs)
 
+        if scheduler is not None:
+            self.proposal_scales = scheduler.get_scales()
+
+        return self.mc
+
+    def resume(self, checkpoint, *args, **kwargs):
+        """Continue sampling from a checkpoint written by
+        sample(checkpoint=...).
+
+        :Arguments:
+            checkpoint : str
+                Checkpoint file.
+
+        :Note:
+            Forwards additional arguments to mcmc() (a new sampler is
+            created if arguments are given or the model has none).
+            When sampling into a kabuki.database, pass the same db
+            and dbname to append to the existing traces.
+
+        """
+        if self.mc is None or args or kwargs:
+            self.mcmc(*args, **kwargs)
+
+        kabuki.checkpoint.resume(self.mc, checkpoint)
+
+        scheduler = getattr(self.mc, '_tuning_scheduler', None)
+        if scheduler is not None:
+            self.proposal_scales = scheduler.get_scales()
+
         return self.mc
 
+    def _sample_approximation(self, approximation, samples):
+        """Store samples of approximation in the traces of a separate
+        sampler self.approx_mc. self.mc, its step methods and its
+        traces are left untouched.
+        """
+        self.approx_mc = pm.MCMC(self.nodes)
+        self.approx_mc.use_step_method(kabuki.variational.ApproximateDraw, approximation)
+        self.approx_mc.sample(samples, progress_bar=False)
+
+        # Connecting the sampler replaced the traces of the nodes
+        if self.mc is not None and hasattr(self.mc, 'db'):
+            for node in self.mc._variables_to_tally:
+                if node.__name__ in self.mc.db._traces:
+                    node.trace = self.mc.db._traces[node.__name__]
+
+        # Start later sampling at the center of the approximation
+        approximation.set_values(approximation.to_constrained(approximation.mean))
+
+    def fit_vi(self, samples=1000, map_init=True, iter=2000, **kwargs):
+        """Fit a mean-field variational approximation of the posterior
+        and store samples of it as traces of the sampler
+        self.approx_mc (see kabuki.variational). Summarize them with
+        summary(mc=self.approx_mc), stats(mc=...) or
+        print_stats(mc=...). Afterwards the nodes are set to the mean
+        of the approximation. self.mc is not changed, sample() still
+        runs MCMC.
+
+        :Optional:
+            samples : int
+                Number of draws from the approximation to store.
+            map_init : bool
+                Start at the MAP (see map(method='gradient')).
+            iter : int
+                Maximum number of iterations of the optimization.
+
+        :Returns:
+            kabuki.variational.MeanFieldVI object of model.
+
+        :Note:
+            Forwards additional keyword arguments to MeanFieldVI.fit().
+
+        """
+        if not self.nodes:
+            self.create_nodes()
+
+        vi = kabuki.variational.MeanFieldVI(self.nodes, bounds=self._get_node_bounds())
+        if map_init:
+            vi.fit_map()
+        vi.fit(iter=iter, **kwargs)
+
+        self._sample_approximation(vi, samples)
+        self.vi = vi
+
+        return vi
+
+    def fit_laplace(self, samples=1000, **kwargs):
+        """Fit a Laplace approximation around the posterior mode and
+        store samples of it as traces of self.approx_mc (see fit_vi()
+        and kabuki.laplace), e.g. for summary(mc=self.approx_mc).
+        Afterwards the nodes are set to the mode. self.mc is not
+        changed.
+
+        :Optional:
+            samples : int
+                Number of draws from the approximation to store.
+
+        :Returns:
+            kabuki.laplace.Laplace object of model. Pass it as
+            approximation to mcmc() to initialize the proposals of
+            blocked step methods with its covariance.
+
+        :Note:
+            Forwards additional keyword arguments to Laplace.fit().
+
+        """
+        if not self.nodes:
+            self.create_nodes()
+
+        laplace = kabuki.laplace.Laplace(self.nodes, bounds=self._get_node_bounds())
+        laplace.fit(**kwargs)
+
+        self._sample_approximation(laplace, samples)
+        self.laplace = laplace
+
+        return laplace
+
 
-    def print_group_stats(self, fname=None):
-        stats_str = kabuki.analyze.gen_group_stats(self.stats())
+    def summary(self, **kwargs):
+        """Return pandas.DataFrame with posterior statistics of all
+        group, var and subj nodes (see kabuki.analyze.summary()).
+        """
+        return kabuki.analyze.summary(self, **kwargs)
+
+    def _stats_for_printing(self, mc=None):
+        """summary() or, without pandas, the output of stats()."""
+        try:
+            import pandas
+        except ImportError:
+            return self.stats(mc=mc)
+        return self.summary(mc=mc)
+
+    def print_group_stats(self, fname=None, mc=None):
+        stats_str = kabuki.analyze.gen_group_stats(self._stats_for_printing(mc))
         if fname is None:
             print stats_str
         else:
-            with open(fname) as fd:
+            with open(fname, 'w') as fd:
                 fd.write(stats_str)
 
 
-    def print_stats(self, fname=None):
-        stats_str = kabuki.analyze.gen_stats(self.stats())
+    def print_stats(self, fname=None, mc=None):
+        stats_str = kabuki.analyze.gen_stats(self._stats_for_printing(mc))
         if fname is None:
             print stats_str
         else:
-            with open(fname) as fd:
+            with open(fname, 'w') as fd:
                 fd.write(stats_str)
 
 
-    def _set_dependent_param(self, param):
+    def _set_dependent_param(self, param, group_only=False):
         """Set parameter that depends on data.
 
         :Arguments:
@@ -543,6 +967,10 @@ class Hierarchical(object):
                 Name of parameter that depends on data for
                 which to set distributions.
 
+        :Optional:
+            group_only : bool
+                Do not create subj nodes.
+
         """
 
         # Get column names for provided param_name
@@ -574,17 +1002,21 @@ class Hierarchical(object):
 
             if self.is_group_model and param.create_subj_nodes:
                 # Create appropriate subj parameter
-                self._set_subj_nodes(param, tag, data_dep_select)
+                self._set_subj_nodes(param, tag, data_dep_select, group_only=group_only)
 
         return self
 
-    def _set_independet_param(self, param):
+    def _set_independet_param(self, param, group_only=False):
         """Set parameter that does _not_ depend on data.
 
         :Arguments:
             param_name : string
                 Name of parameter.
 
+        :Optional:
+            group_only : bool
+                Do not create subj nodes.
+
         """
 
         # Parameter does not depend on data
@@ -597,11 +1029,11 @@ class Hierarchical(object):
         param.reset()
 
         if self.is_group_model and param.create_subj_nodes:
-            self._set_subj_nodes(param, '', self.data)
+            self._set_subj_nodes(param, '', self.data, group_only=group_only)
 
         return self
 
-    def _set_subj_nodes(self, param, tag, data):
+    def _set_subj_nodes(self, param, tag, data, group_only=False):
         """Set nodes with a parent.
 
         :Arguments:
@@ -613,6 +1045,10 @@ class Hierarchical(object):
                 Part of the data the parameter
                 depends on.
 
+        :Optional:
+            group_only : bool
+                Only create the var node.
+
         """
         # Generate subj variability parameter var
         param.tag = 'var'+tag
@@ -623,8 +1059,15 @@ class Hierarchical(object):
             param.var_nodes[''] = None
         param.reset()
 
+        if group_only:
+            return self
+
+        non_centered = param.non_centered and param.create_group_node
+
         # Init
         param.subj_nodes[tag] = np.empty(self._num_subjs, dtype=object)
+        if non_centered:
+            param.offset_nodes[tag] = np.empty(self._num_subjs, dtype=object)
         # Create subj parameter distribution for each subject
         for subj_idx, subj in enumerate(self._subjs):
             data_subj = data[data['subj_idx']==subj]
@@ -632,9 +1075,16 @@ class Hierarchical(object):
             param.group = param.group_nodes[tag]
             if param.create_group_node:
                 param.var = param.var_nodes[tag]
-            param.tag = tag
             param.idx = subj_idx
-            param.subj_nodes[tag][subj_idx] = self.get_subj_node(param)
+            if non_centered:
+                param.tag = 'offset'+tag
+                offset = self.get_subj_offset_node(param)
+                param.offset_nodes[tag][subj_idx] = offset
+                param.tag = tag
+                param.subj_nodes[tag][subj_idx] = self.get_non_centered_subj_node(param, offset)
+            else:
+                param.tag = tag
+                param.subj_nodes[tag][subj_idx] = self.get_subj_node(param)
             param.reset()
 
         return self
@@ -730,7 +1180,7 @@ class Hierarchical(object):
                     print "Warning! Bottom node %s is not linked to data. Replacing with None." % param.full_name
                     param.bottom_nodes[dep_name][i] = None
                 else:
-                    param.bottom_nodes[dep_name][i] = bottom_node
+                    param.bottom_nodes[dep_name][i] = self._prepare_bottom_node(bottom_node)
                 param.reset()
         else: # Do not use subj params, but group ones
             # Since group nodes are not created in this function we
@@ -752,13 +1202,25 @@ class Hierarchical(object):
                     print "Warning! Bottom node %s is not linked to data. Replacing with None." % param.full_name
                     param.bottom_nodes[dep_name] = None
                 else:
-                    param.bottom_nodes[dep_name] = bottom_node
+                    param.bottom_nodes[dep_name] = self._prepare_bottom_node(bottom_node)
 
             param.reset()
 
         return self
 
 
+    def _prepare_bottom_node(self, bottom_node):
+        """Switch the likelihood of bottom_node to sufficient
+        statistics or unique values if requested.
+        """
+        if bottom_node is None:
+            return bottom_node
+        if self.sufficient_stats and kabuki.likelihoods.use_sufficient_stats(bottom_node):
+            return bottom_node
+        if self.compress:
+            kabuki.likelihoods.use_weighted_logp(bottom_node)
+        return bottom_node
+
     def get_node(self, node_name, params):
         """Returns the node object with node_name from params if node
         is included in model, otherwise returns default value.
@@ -774,7 +1236,14 @@ class Hierarchical(object):
     def stats(self, *args, **kwargs):
         """
         smart call of MCMC.stats() for the model
+
+        Pass mc (e.g. self.approx_mc after fit_vi()) to compute the
+        statistics of the traces of another sampler.
         """
+        mc = kwargs.pop('mc', None)
+        if mc is not None and mc is not self.mc:
+            return mc.stats(*args, **kwargs)
+
         try:
             nchains = self.mc.db.chains
         except AttributeError:
@@ -798,16 +1267,39 @@ class Hierarchical(object):
 
 
 
-    def load_db(self, dbname, verbose=0, db_loader=None):
+    def load_db(self, dbname, verbose=0, db_loader=None, lazy=False,
+                cache_size=2**28, group_only=False):
         """Load samples from a database created by an earlier model
         run (e.g. by calling .mcmc(dbname='test'))
+
+        :Optional:
+            lazy : bool
+                Attach proxies (kabuki.database.LazyTrace) to the
+                nodes that only read their trace from the database
+                when it is accessed. By default all traces are
+                attached right away.
+            cache_size : int
+                Maximum number of bytes of trace data kept in
+                memory by the lazy proxies.
+            group_only : bool
+                Only create group and var nodes (see create_nodes()).
+                Much faster if only group parameters are of
+                interest. The model can not be sampled afterwards.
+
+        :Note:
+            If db_loader is not provided, databases written by
+            kabuki.database are detected automatically, otherwise
+            pymc.database.sqlite.load is used.
         """
         if db_loader is None:
-            db_loader = pm.database.sqlite.load
+            if os.path.exists(os.path.join(dbname, 'meta.json')):
+                db_loader = kabuki.database.load
+            else:
+                db_loader = pm.database.sqlite.load
 
         # Set up model
         if not self.nodes:
-            self.create_nodes()
+            self.create_nodes(group_only=group_only)
 
         # Ignore annoying sqlite warnings
         warnings.simplefilter('ignore', UserWarning)
@@ -823,8 +1315,13 @@ class Hierarchical(object):
 
         # Take the traces from the database and feed them into our
         # distribution variables (needed for _gen_stats())
-        for node in self.mc.stochastics:
-            node.trace = self.mc.trace(node.__name__)
+        if lazy:
+            self.trace_cache = kabuki.database.TraceCache(cache_size)
+            for node in self.mc.stochastics:
+                node.trace = kabuki.database.LazyTrace(db, node.__name__, self.trace_cache)
+        else:
+            for node in self.mc.stochastics:
+                node.trace = self.mc.trace(node.__name__)
 
         return self
 
@@ -875,41 +1372,223 @@ class Hierarchical(object):
                                   trace=self.trace_subjs,
                                   value=param.init)
 
-    def init_from_existing_model(self, pre_model, step_method, **kwargs):
+    def get_subj_offset_node(self, param):
+        """Create and return a standard normal distribution for the
+        offset of subject param.idx from the group mean (in units of
+        the group variability).
+
+        This is used for parameters with non_centered=True.
+
+        """
+        return pm.Normal(param.full_name,
+                         mu=0,
+                         tau=1,
+                         value=0,
+                         plot=False,
+                         trace=self.trace_subjs)
+
+    def get_non_centered_subj_node(self, param, offset):
+        """Create and return the deterministic subj node
+        param.group + param.var * offset.
+
+        This is used instead of get_subj_node() for parameters with
+        non_centered=True.
+
+        """
+        if param.var_type == 'std':
+            scale = param.var
+        elif param.var_type == 'precision':
+            scale = param.var**-.5
+        else:
+            raise ValueError("non_centered is not supported for var_type %s." % param.var_type)
+
+        return pm.Lambda(param.full_name,
+                         lambda group=param.group, scale=scale, offset=offset: group + scale * offset,
+                         plot=self.plot_subjs,
+                         trace=self.trace_subjs)
+
+    def init_from_existing_model(self, pre_model, step_method=True, **kwargs):
         """
         initialize the value and step methods of the model using an existing model
+
+        Nodes are matched by name. Group, var and subj nodes are
+        also mapped between models with different depends_on or
+        subjects:
+            * Nodes of conditions that do not exist in pre_model
+              are seeded from the node without condition (or the
+              average over all conditions) of pre_model.
+            * Subj and offset nodes are matched by subj_idx instead
+              of position.
+            * Subjects not present in pre_model start at the value
+              of their group node (offset 0 for non-centered
+              parameters).
+
+        :Arguments:
+            pre_model : kabuki.Hierarchical
+                Model to initialize from (e.g. after sample()).
+            step_method : bool
+                Also copy the complete state of the step methods
+                (e.g. Metropolis proposal_sd, adaptive scale factor
+                and acceptance counts, AdaptiveMetropolis covariance).
+
+        :Note:
+            Forwards additional keyword arguments to mcmc().
         """
-        if not self.nodes:
+        if self.mc is None:
             self.mcmc(**kwargs)
-        all_nodes = list(self.mc.stochastics)
-        all_pre_nodes = list(pre_model.mc.stochastics)
+
+        pre_nodes = dict((node.__name__, node) for node in pre_model.mc.stochastics)
+        sources, new_subj_nodes = self._warm_start_sources(pre_model, pre_nodes)
+
+        # Assign values
         assigned_values = 0
-        assigned_steps = 0
-
-        #loop over all nodes
-        for i_node in range(len(all_nodes)):
-            #get name of current node
-            t_name = all_nodes[i_node].__name__
-            #get the matched node from the pre_model
-            pre_node = [x for x in all_pre_nodes if x.__name__ == t_name]
-            if len(pre_node)==0:
-                continue
-            pre_node = pre_node[0]
+        for node, pre_node_list in sources.iteritems():
+            if len(pre_node_list) == 1:
+                node.value = copy(pre_node_list[0].value)
+            else:
+                node.value = np.mean([pre_node.value for pre_node in pre_node_list], axis=0)
             assigned_values += 1
 
-            all_nodes[i_node].value= pre_node.value
-            if step_method:
-                step_pre_node = pre_model.mc.step_method_dict[pre_node][0]
-                pre_sd = step_pre_node.proposal_sd * step_pre_node.adaptive_scale_factor
-                if type(step_pre_node) == pm.Metropolis:
-                    self.mc.use_step_method(pm.Metropolis(all_nodes[i_node],
-                                                          proposal_sd = pre_sd))
-                    assigned_steps += 1
+        for node, group_node in new_subj_nodes:
+            if group_node is None:
+                # An offset of 0 puts the subject at its group node
+                node.value = np.zeros_like(node.value)
+            else:
+                node.value = copy(group_node.value)
 
+        all_nodes = self.mc.stochastics
         print "assigned values to %d nodes (out of %d)." % (assigned_values, len(all_nodes))
+
         if step_method:
+            assigned_steps = self._warm_start_step_methods(pre_model, sources)
             print "assigned step methods to %d (out of %d)." % (assigned_steps, len(all_nodes))
 
+    def _warm_start_sources(self, pre_model, pre_nodes):
+        """Map nodes to the nodes of pre_model they are initialized
+        from (see init_from_existing_model()).
+
+        :Returns:
+            sources : dict
+                Maps node to list of pre_model nodes (averaged if
+                more than one).
+            new_subj_nodes : list
+                Tuples of subj and offset nodes of subjects not in
+                pre_model and their group node (None for offset
+                nodes).
+        """
+        sources = {}
+        for node in self.mc.stochastics:
+            if node.__name__ in pre_nodes:
+                sources[node] = [pre_nodes[node.__name__]]
+
+        def candidates(pre_dict, tag):
+            if pre_dict.get(tag) is not None:
+                return [pre_dict[tag]]
+            # New condition: use all nodes of the parameter in pre_model
+            return [pre_node for pre_node in pre_dict.itervalues() if pre_node is not None]
+
+        if pre_model.is_group_model:
+            pre_subj_idx = dict((subj, i) for i, subj in enumerate(pre_model._subjs))
+        else:
+            pre_subj_idx = {}
+
+        new_subj_nodes = []
+        for name, param in self.params_include.iteritems():
+            pre_param = pre_model.params_dict.get(name)
+            if param.is_bottom_node or pre_param is None:
+                continue
+
+            for nodes, pre_nodes_dict in ((param.group_nodes, pre_param.group_nodes),
+                                          (param.var_nodes, pre_param.var_nodes)):
+                for tag, node in nodes.iteritems():
+                    if node is None or node in sources:
+                        continue
+                    node_candidates = candidates(pre_nodes_dict, tag)
+                    if node_candidates:
+                        sources[node] = node_candidates
+
+            for tag, nodes in param.subj_nodes.iteritems():
+                subj_candidates = candidates(pre_param.subj_nodes, tag)
+                for i, node in enumerate(nodes):
+                    if not isinstance(node, pm.Stochastic):
+                        # Non-centered, see offset nodes below
+                        continue
+                    # Names refer to positions which differ when the
+                    # subjects differ, so always match by subj_idx.
+                    sources.pop(node, None)
+                    pre_i = pre_subj_idx.get(self._subjs[i])
+                    if pre_i is not None and subj_candidates:
+                        sources[node] = [pre_subj_nodes[pre_i] for pre_subj_nodes in subj_candidates]
+                    elif param.group_nodes.get(tag) is not None:
+                        new_subj_nodes.append((node, param.group_nodes[tag]))
+
+            for tag, nodes in param.offset_nodes.iteritems():
+                offset_candidates = candidates(pre_param.offset_nodes, tag)
+                for i, node in enumerate(nodes):
+                    sources.pop(node, None)
+                    pre_i = pre_subj_idx.get(self._subjs[i])
+                    if pre_i is not None and offset_candidates:
+                        sources[node] = [pre_offset_nodes[pre_i] for pre_offset_nodes in offset_candidates]
+                    else:
+                        new_subj_nodes.append((node, None))
+
+        return sources, new_subj_nodes
+
+    def _warm_start_step_methods(self, pre_model, sources):
+        """Copy the step methods of pre_model to the nodes of the
+        model they were mapped to (see _warm_start_sources()).
+
+        :Returns:
+            Number of nodes that were assigned a step method.
+        """
+        from kabuki.checkpoint import get_step_method_state, set_step_method_state
+
+        # pymc orders the stochastics of a block step method by hash,
+        # so blocks are matched via names.
+        nodes_by_name = dict((node.__name__, node) for node in self.mc.stochastics)
+        assigned = set()
+        transferred = set()
+
+        for node, pre_node_list in sources.iteritems():
+            if len(pre_node_list) != 1:
+                continue
+            for pre_sm in pre_model.mc.step_method_dict.get(pre_node_list[0], []):
+                if len(pre_sm.stochastics) == 1:
+                    stochastics = [node]
+                elif pre_sm in transferred:
+                    continue
+                else:
+                    # Blocks are only transferred if all nodes exist
+                    stochastics = [nodes_by_name.get(s.__name__) for s in pre_sm.stochastics]
+                    if None in stochastics:
+                        continue
+
+                sm = self._get_or_create_step_method(type(pre_sm), stochastics)
+                if sm is None:
+                    continue
+                if set_step_method_state(sm, get_step_method_state(pre_sm)):
+                    transferred.add(pre_sm)
+                    assigned.update(stochastics)
+
+        return len(assigned)
+
+    def _get_or_create_step_method(self, sm_class, stochastics):
+        """Return step method of class sm_class handling exactly
+        stochastics. Creates a new one if none is assigned.
+        """
+        for sm in self.mc.step_method_dict[stochastics[0]]:
+            if type(sm) is sm_class and sm.stochastics == set(stochastics):
+                return sm
+
+        if issubclass(sm_class, (pm.AdaptiveMetropolis, kabuki.step_methods.Slice)):
+            self.mc.use_step_method(sm_class, stochastics)
+        elif len(stochastics) == 1:
+            self.mc.use_step_method(sm_class, stochastics[0])
+        else:
+            return None
+
+        return self.mc.step_method_dict[stochastics[0]][-1]
+
     def plot_posteriors(self, *args, **kwargs):
         pm.Matplot.plot(self.mc, *args, **kwargs)
 
@@ -936,25 +1615,30 @@ class Hierarchical(object):
         del empty_s_model._num_subjs, empty_s_model._subjs, empty_s_model.data
 
         self.create_nodes()
+        # MAP values of the subj nodes (deterministic for non_centered
+        # parameters, so they are set via their offset below)
+        values = dict((name, [None] * n_subjs) for name in self.subj_nodes)
 
         # loop over subjects
         for i_subj in range(n_subjs):
             # create and fit single subject
             if verbose > 1: print "*!*!* fitting subject %d *!*!*" % subjs[i_subj]
             t_data = self.data[self.data['subj_idx'] == subjs[i_subj]]
-            t_data = rec_drop_fields(t_data, ['data_idx'])
+            t_data = rec.drop_fields(t_data, ['data_idx'], usemask=False)
             s_model = deepcopy(empty_s_model)
             s_model.data = t_data
             s_model.map(method='fmin_powell', runs=runs, **map_kwargs)
 
             # copy to original model
             for (name, node) in s_model.group_nodes.iteritems():
-                self.subj_nodes[name][i_subj].value = node.value
+                values[name][i_subj] = node.value
+                if isinstance(self.subj_nodes[name][i_subj], pm.Stochastic):
+                    self.subj_nodes[name][i_subj].value = node.value
 
         #set group and var nodes
         for (param_name, d) in self.params_dict.iteritems():
             for (tag, nodes) in d.subj_nodes.iteritems():
-                subj_values = [x.value for x in nodes]
+                subj_values = values[param_name+tag]
                 #set group node
                 if d.group_nodes:
                     d.group_nodes[tag].value = np.mean(subj_values)
@@ -970,4 +1654,9 @@ class Hierarchical(object):
                         d.var_nodes[tag].value = (m * (1 - m)) / v - 1
                     else:
                         raise ValueError, "unknown var_type"
+                #set offset nodes
+                if tag in d.offset_nodes:
+                    scale = nodes[0].parents.value['scale']
+                    for offset, value in zip(d.offset_nodes[tag], subj_values):
+                        offset.value = (value - d.group_nodes[tag].value) / scale
 
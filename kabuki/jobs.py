@@ -0,0 +1,464 @@
+"""
+Fit grids of model variants as independent jobs.
+
+A job is described by a spec, a JSON-serializable dict:
+    model : str or class
+        Hierarchical subclass (class or 'module.Class').
+    data : str
+        Path of the data (.csv read with kabuki.utils.load_csv(),
+        .npy with numpy.load()).
+    name : str (optional)
+        Name of the job (default: class name and hash of the spec).
+    depends_on, include : (optional)
+        Arguments of the model.
+    model_kwargs : dict (optional)
+        Further arguments of the model.
+    seed : int (optional)
+        Seed of numpy.random before the model is created.
+    map : dict (optional)
+        Arguments of map() to run before sampling.
+    mcmc : dict (optional)
+        Arguments of mcmc() (e.g. blocked=True).
+    sample : dict (optional)
+        Arguments of sample() (e.g. iter, burn, thin).
+
+Each job gets its own directory out_dir/<name> with:
+    spec.json : the spec.
+    lock : created by the process that runs the job (host and pid).
+    progress.json : status ('building', 'map', 'sampling',
+        'summarizing', 'done' or 'failed'), timestamps and the
+        current iteration while sampling.
+    log.txt : everything the job printed (and the traceback if it
+        failed).
+    traces/ : samples (kabuki.database, see Hierarchical.load_db()).
+    result.json : posterior statistics (see kabuki.analyze.summary()),
+        DIC and timings. Written last, jobs with a result.json are
+        skipped.
+
+run() fits the jobs on a local process pool:
+
+    >>> specs = [{'model': 'mymodels.MyModel', 'data': 'data.csv', 'depends_on': depends_on,
+    ...           'seed': seed, 'sample': {'iter': 10000, 'burn': 5000}}
+    ...          for depends_on in ({}, {'v': 'condition'}) for seed in range(3)]
+    >>> results = run(specs, 'fits', processes=4)
+
+To share the jobs between several machines, submit() them to a
+directory on a shared filesystem and start workers on each machine
+that claim and run jobs until none are left:
+
+    python -m kabuki.jobs submit specs.json fits
+    python -m kabuki.jobs work fits --processes 8
+    python -m kabuki.jobs status fits
+
+:Note:
+    Jobs are claimed by atomically creating their lock file. The lock
+    of a job whose worker died stays in place; status() reports such
+    jobs as 'stale' if the worker ran on the same host. Delete the
+    lock to run the job again. Failed jobs keep their lock as well
+    (see log.txt).
+
+    A job directory belongs to one spec: submitting or running a
+    different spec under the name of an existing job raises a
+    ValueError.
+
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import errno
+import socket
+import hashlib
+import traceback
+import multiprocessing
+
+import numpy as np
+
+import kabuki
+
+__all__ = ['job_name', 'submit', 'run_job', 'work', 'run', 'status', 'load_result']
+
+_SPEC = 'spec.json'
+_LOCK = 'lock'
+_PROGRESS = 'progress.json'
+_LOG = 'log.txt'
+_TRACES = 'traces'
+_RESULT = 'result.json'
+
+
+def _class_path(model):
+    if isinstance(model, basestring):
+        return model
+    return '%s.%s' % (model.__module__, model.__name__)
+
+def _import_class(path):
+    module, name = path.rsplit('.', 1)
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+def _normalize(spec):
+    """Return copy of spec with the model as 'module.Class' and a name."""
+    spec = dict(spec)
+    spec['model'] = _class_path(spec['model'])
+    if not spec.get('name'):
+        spec['name'] = job_name(spec)
+    return spec
+
+def job_name(spec):
+    """Return the default name of the job of spec: the name of the
+    model class and a hash of the spec.
+    """
+    spec = dict(spec, model=_class_path(spec['model']))
+    spec.pop('name', None)
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()
+    return '%s-%s' % (spec['model'].rsplit('.', 1)[-1], digest[:10])
+
+def _write_json(obj, fname):
+    """Write obj to fname atomically."""
+    tmp_fname = '%s.%s.%i.tmp' % (fname, socket.gethostname(), os.getpid())
+    with open(tmp_fname, 'w') as fd:
+        json.dump(obj, fd, indent=1, sort_keys=True)
+    os.rename(tmp_fname, fname)
+
+def _str(obj):
+    """Convert the unicode strings of JSON to str (e.g. Hierarchical
+    only accepts columns of depends_on as str).
+    """
+    if isinstance(obj, unicode):
+        return str(obj)
+    if isinstance(obj, list):
+        return [_str(value) for value in obj]
+    if isinstance(obj, dict):
+        return dict((_str(key), _str(value)) for key, value in obj.iteritems())
+    return obj
+
+def _read_json(fname):
+    with open(fname) as fd:
+        return _str(json.load(fd))
+
+def _job_dir(spec, out_dir):
+    """Create the directory of the job of the normalized spec with its
+    spec.json and return it. Raises ValueError if the directory
+    exists with a different spec.
+    """
+    job_dir = os.path.join(out_dir, spec['name'])
+    fname = os.path.join(job_dir, _SPEC)
+    try:
+        os.makedirs(job_dir)
+    except OSError:
+        if not os.path.isdir(job_dir):
+            raise
+    if not os.path.exists(fname):
+        _write_json(spec, fname)
+    elif _read_json(fname) != _str(json.loads(json.dumps(spec))):
+        raise ValueError("Job %s exists in %s with a different spec." % (spec['name'], out_dir))
+    return job_dir
+
+def _claim(job_dir):
+    """Create the lock of the job, return False if it exists."""
+    try:
+        fd = os.open(os.path.join(job_dir, _LOCK), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, '%s %i\n' % (socket.gethostname(), os.getpid()))
+    os.close(fd)
+    return True
+
+def _stale_lock(job_dir):
+    """Return whether the lock of the job was created by a process on
+    this host that no longer exists.
+    """
+    try:
+        with open(os.path.join(job_dir, _LOCK)) as fd:
+            host, pid = fd.read().split()
+        pid = int(pid)
+    except (IOError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+class _Progress(object):
+    """Writes progress.json of a job."""
+    def __init__(self, job_dir):
+        self.fname = os.path.join(job_dir, _PROGRESS)
+        self.state = {'host': socket.gethostname(), 'pid': os.getpid(),
+                      'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    def update(self, **kwargs):
+        self.state.update(kwargs)
+        self.state['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        _write_json(self.state, self.fname)
+
+    def attach(self, mc):
+        """Record the iteration of mc whenever it saves its state
+        (every save_interval iterations, see pymc.MCMC.sample()).
+        """
+        save_state = mc.save_state
+        def record():
+            save_state()
+            self.update(iteration=mc._current_iter, iterations=mc._iter)
+        mc.save_state = record
+
+def _load_data(fname):
+    if fname.endswith('.npy'):
+        return np.load(fname)
+    return kabuki.utils.load_csv(fname)
+
+def _fit(spec, job_dir, progress):
+    """Fit the model of spec and return its result."""
+    result = {'name': spec['name'], 'host': socket.gethostname()}
+    times = {}
+
+    progress.update(status='building')
+    start = time.time()
+    if spec.get('seed') is not None:
+        np.random.seed(spec['seed'])
+    model_class = _import_class(spec['model'])
+    model_kwargs = dict(spec.get('model_kwargs', {}))
+    for key in ('depends_on', 'include'):
+        if spec.get(key) is not None:
+            model_kwargs[key] = spec[key]
+    model = model_class(_load_data(spec['data']), **model_kwargs)
+    model.create_nodes()
+    times['build'] = time.time() - start
+
+    if spec.get('map') is not None:
+        progress.update(status='map')
+        start = time.time()
+        model.map(**spec['map'])
+        times['map'] = time.time() - start
+
+    progress.update(status='sampling')
+    start = time.time()
+    dbname = os.path.join(job_dir, _TRACES)
+    if os.path.exists(dbname):
+        # Left over by an earlier attempt
+        shutil.rmtree(dbname)
+    model.mcmc(db=kabuki.database, dbname=dbname, **spec.get('mcmc', {}))
+    sample_kwargs = dict(spec.get('sample', {}))
+    sample_kwargs.setdefault('progress_bar', False)
+    sample_kwargs.setdefault('save_interval', max(sample_kwargs.get('iter', 0) // 100, 1))
+    progress.attach(model.mc)
+    model.sample(**sample_kwargs)
+    times['sample'] = time.time() - start
+
+    progress.update(status='summarizing')
+    result['stats'] = kabuki.analyze.summary(model).reset_index().to_dict('records')
+    result['dic'] = float(model.mc.dic)
+    model.mc.db.close()
+
+    result['times'] = times
+    return result
+
+def run_job(spec, out_dir):
+    """Run the job of spec in out_dir/<name> unless its result exists.
+
+    :Arguments:
+        spec : dict
+            Job spec (see module documentation).
+        out_dir : str
+            Directory of the job directories.
+
+    :Returns:
+        dict : result of the job (with status 'done', 'skipped' or
+        'failed'), or None if another process holds its lock.
+
+    :Note:
+        Raises ValueError if the job directory exists with a
+        different spec.
+    """
+    spec = _normalize(spec)
+    job_dir = _job_dir(spec, out_dir)
+
+    if os.path.exists(os.path.join(job_dir, _RESULT)):
+        return dict(load_result(job_dir), status='skipped')
+    if not _claim(job_dir):
+        return None
+    return _run_claimed(spec, job_dir)
+
+def _run_claimed(spec, job_dir):
+    progress = _Progress(job_dir)
+    stdout, stderr = sys.stdout, sys.stderr
+    log = open(os.path.join(job_dir, _LOG), 'a')
+    sys.stdout = sys.stderr = log
+    start = time.time()
+    try:
+        print "Job %s started on %s (pid %i)" % (spec['name'], socket.gethostname(), os.getpid())
+        try:
+            result = _fit(spec, job_dir, progress)
+        except Exception:
+            traceback.print_exc()
+            progress.update(status='failed', error=traceback.format_exc().splitlines()[-1])
+            return {'name': spec['name'], 'status': 'failed', 'error': progress.state['error']}
+
+        result['status'] = 'done'
+        result['time'] = time.time() - start
+        _write_json(result, os.path.join(job_dir, _RESULT))
+        progress.update(status='done')
+        print "Job %s finished in %.1fs" % (spec['name'], result['time'])
+        return result
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log.close()
+
+def submit(specs, queue_dir):
+    """Create the job directories of specs in queue_dir.
+
+    :Returns:
+        list of the names of the jobs.
+
+    :Note:
+        Jobs that were already submitted with the same spec are kept,
+        a different spec under the name of an existing job raises a
+        ValueError.
+    """
+    names = []
+    for spec in specs:
+        spec = _normalize(spec)
+        _job_dir(spec, queue_dir)
+        names.append(spec['name'])
+    return names
+
+def _work(queue_dir, max_jobs=None):
+    results = []
+    for name in sorted(os.listdir(queue_dir)):
+        if max_jobs is not None and len(results) >= max_jobs:
+            break
+        job_dir = os.path.join(queue_dir, name)
+        fname = os.path.join(job_dir, _SPEC)
+        if not os.path.exists(fname) or os.path.exists(os.path.join(job_dir, _RESULT)):
+            continue
+        if not _claim(job_dir):
+            continue
+        results.append(_run_claimed(_read_json(fname), job_dir))
+    return results
+
+def work(queue_dir, processes=1, max_jobs=None):
+    """Run jobs of queue_dir that are neither finished nor claimed by
+    another worker until none are left.
+
+    :Arguments:
+        queue_dir : str
+            Directory the jobs were submitted to (see submit()).
+
+    :Optional:
+        processes : int
+            Number of worker processes.
+        max_jobs : int
+            Maximum number of jobs each process runs.
+
+    :Returns:
+        list of results of the jobs run (see run_job()).
+    """
+    if processes == 1:
+        return _work(queue_dir, max_jobs)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_work_star, [(queue_dir, max_jobs)] * processes)
+    finally:
+        pool.terminate()
+    return [result for worker_results in results for result in worker_results]
+
+def _work_star(args):
+    return _work(*args)
+
+def _run_job_star(args):
+    return run_job(*args)
+
+def run(specs, out_dir, processes=None):
+    """Fit the jobs of specs on a local process pool.
+
+    :Arguments:
+        specs : list
+            Job specs (see module documentation).
+        out_dir : str
+            Directory of the job directories.
+
+    :Optional:
+        processes : int
+            Number of processes (default: number of CPUs). 1 runs
+            the jobs in this process.
+
+    :Returns:
+        list of results in the order of specs (see run_job()).
+    """
+    # Check the specs of existing jobs before starting any
+    submit(specs, out_dir)
+
+    args = [(spec, out_dir) for spec in specs]
+    if processes == 1:
+        return [_run_job_star(arg) for arg in args]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_run_job_star, args, chunksize=1)
+    finally:
+        pool.terminate()
+
+def load_result(job_dir):
+    """Return the result of the job in job_dir."""
+    return _read_json(os.path.join(job_dir, _RESULT))
+
+def status(queue_dir):
+    """Return dict mapping the name of each job in queue_dir to its
+    status ('queued', 'claimed', the status in progress.json or
+    'stale' if the job is unfinished and the process holding its lock
+    died on this host).
+    """
+    states = {}
+    for name in sorted(os.listdir(queue_dir)):
+        job_dir = os.path.join(queue_dir, name)
+        if not os.path.exists(os.path.join(job_dir, _SPEC)):
+            continue
+        if os.path.exists(os.path.join(job_dir, _PROGRESS)):
+            states[name] = _read_json(os.path.join(job_dir, _PROGRESS))['status']
+        elif os.path.exists(os.path.join(job_dir, _LOCK)):
+            states[name] = 'claimed'
+        else:
+            states[name] = 'queued'
+        if states[name] not in ('queued', 'done', 'failed') and _stale_lock(job_dir):
+            states[name] = 'stale'
+    return states
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='kabuki job runner')
+    subparsers = parser.add_subparsers(dest='command')
+
+    sub = subparsers.add_parser('submit', help='submit jobs to a queue directory')
+    sub.add_argument('specs', help='JSON file with a list of job specs')
+    sub.add_argument('queue_dir')
+
+    wrk = subparsers.add_parser('work', help='run submitted jobs')
+    wrk.add_argument('queue_dir')
+    wrk.add_argument('--processes', type=int, default=1)
+    wrk.add_argument('--max-jobs', type=int, default=None)
+
+    sta = subparsers.add_parser('status', help='print the status of all jobs')
+    sta.add_argument('queue_dir')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'submit':
+        for name in submit(_read_json(args.specs), args.queue_dir):
+            print name
+    elif args.command == 'work':
+        for result in work(args.queue_dir, processes=args.processes, max_jobs=args.max_jobs):
+            print "%s: %s" % (result['name'], result['status'])
+    elif args.command == 'status':
+        for name, state in sorted(status(args.queue_dir).iteritems()):
+            print "%s: %s" % (name, state)
+
+if __name__ == '__main__':
+    main()
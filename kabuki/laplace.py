@@ -0,0 +1,246 @@
+"""
+Laplace approximation of the posterior around its mode.
+
+Laplace approximates the posterior by a multivariate normal in the
+unconstrained space of kabuki.optimize.GradientMAP, centered at the
+mode with the inverse Hessian of the negative log posterior as
+covariance. Mode and Hessian include the log Jacobian of the
+transforms, so that draws respect all bounds and the approximation
+exists if the MAP of e.g. a var node lies at its bound.
+
+The Hessian is computed by finite differences of the gradient
+exploiting its sparsity: two stochastics that are not neighbours in
+the moral graph of the model (e.g. parameters of different subjects,
+which are conditionally independent given the group nodes) can be
+perturbed at once. A hierarchical model thus needs a handful of
+gradient evaluations instead of one per parameter.
+
+The precision (the Hessian) is kept sparse and factored with a
+fill-reducing ordering, so that draws and solves stay cheap for many
+subjects. Dense covariance blocks are only formed on request (see
+Laplace.covariance()).
+
+Hierarchical.fit_laplace() stores draws as traces of
+Hierarchical.approx_mc (see Hierarchical.fit_vi()), the covariance
+can initialize the proposals of blocked step methods:
+
+    >>> laplace = model.fit_laplace()
+    >>> print kabuki.analyze.gen_stats(model.approx_mc.stats())
+    >>> model.mcmc(blocked=True, approximation=laplace)
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from kabuki.optimize import GradientMAP
+
+__all__ = ['Laplace']
+
+
+def _sparse_ldl(A):
+    """Factor the sparse symmetric matrix A = P L D L' P' with a
+    fill-reducing permutation P and without pivoting.
+
+    :Returns:
+        scipy.sparse.linalg.SuperLU object (U = D L') or None if A is
+        not positive definite.
+    """
+    lu = spla.splu(sp.csc_matrix(A), permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0.,
+                   options=dict(SymmetricMode=True))
+    if np.any(lu.perm_r != lu.perm_c) or np.any(lu.U.diagonal() <= 0):
+        return None
+    return lu
+
+
+class Laplace(GradientMAP):
+    """Laplace approximation in unconstrained space.
+
+    :Arguments:
+        input : nodes
+            Anything pymc.Model accepts.
+
+    :Optional:
+        bounds : dict
+            Maps stochastics to (lower, upper) (see GradientMAP).
+        eps : float
+            Step size of finite difference gradients.
+        h : float
+            Step size of finite differences of the gradient.
+
+    """
+    def __init__(self, input=None, bounds=None, eps=1e-5, h=1e-4, verbose=-1):
+        GradientMAP.__init__(self, input, bounds=bounds, eps=eps, verbose=verbose)
+        self.h = h
+        self.n_gradients = 0
+
+    def func(self, y):
+        """Negative log density of the unconstrained y."""
+        return GradientMAP.func(self, y) - self.log_jacobian(y)
+
+    def gradfunc(self, y):
+        """Gradient of func() at unconstrained y."""
+        self.n_gradients += 1
+        return GradientMAP.gradfunc(self, y) - self.log_jacobian_grad(y)
+
+    def _neighbors(self):
+        """Return dict mapping stochastics to the stochastics their
+        gradient depends on (including themselves).
+        """
+        neighbors = {}
+        for stochastic in self.stochastic_list:
+            neighbors[stochastic] = (stochastic.moral_neighbors & self.stochastics) | set([stochastic])
+        return neighbors
+
+    def _colors(self, neighbors):
+        """Greedy coloring of the stochastics such that no two
+        neighbours share a color.
+        """
+        colors = {}
+        for stochastic in self.stochastic_list:
+            used = set([colors[n] for n in neighbors[stochastic] if n in colors])
+            color = 0
+            while color in used:
+                color += 1
+            colors[stochastic] = color
+        return colors
+
+    def _size(self, stochastic):
+        sl = self._slices[stochastic]
+        return sl.stop - sl.start
+
+    def _column(self, y, columns):
+        """Return the sum of the Hessian columns (central differences
+        of the gradient).
+        """
+        dy = np.zeros(self.len)
+        dy[columns] = self.h
+        return (self.gradfunc(y + dy) - self.gradfunc(y - dy)) / (2 * self.h)
+
+    def hessian(self, y):
+        """Return the Hessian of func() at y as scipy.sparse matrix."""
+        neighbors = self._neighbors()
+        colors = self._colors(neighbors)
+        H = sp.lil_matrix((self.len, self.len))
+
+        # Perturb coordinate i of all stochastics with the same color
+        # at once. Column (s, i) is recovered in the rows of stochastic
+        # r if s is the only perturbed neighbour of r.
+        known = set()
+        groups = {}
+        for stochastic in self.stochastic_list:
+            for i in range(self._size(stochastic)):
+                groups.setdefault((colors[stochastic], i), []).append(stochastic)
+        for (color, i), group in sorted(groups.iteritems()):
+            d = self._column(y, [self._slices[s].start + i for s in group])
+            group = set(group)
+            for row in self.stochastic_list:
+                perturbed = neighbors[row] & group
+                if len(perturbed) != 1:
+                    continue
+                s = perturbed.pop()
+                rows = self._slices[row]
+                H[rows, self._slices[s].start + i] = d[rows].reshape(-1, 1)
+                known.add((row, s, i))
+
+        # Fill the rest by symmetry or single column perturbations
+        missing = set()
+        for row in self.stochastic_list:
+            rows = self._slices[row]
+            for s in neighbors[row]:
+                for i in range(self._size(s)):
+                    if (row, s, i) in known:
+                        continue
+                    col = self._slices[s].start + i
+                    if all([(s, row, j) in known for j in range(self._size(row))]):
+                        H[rows, col] = H[col, rows].T
+                    else:
+                        missing.add(col)
+        for col in sorted(missing):
+            d = self._column(y, [col])
+            nonzero = np.flatnonzero(d)
+            H[nonzero, col] = d[nonzero].reshape(-1, 1)
+
+        H = H.tocsr()
+        return (H + H.T) / 2
+
+    def fit(self, iterlim=1000, tol=1e-5, verbose=0):
+        """Find the mode and factor the (sparse) Hessian there.
+
+        :Optional:
+            iterlim : int
+                Maximum number of iterations of the optimization.
+            tol : float
+                Stop when the projected gradient is below tol.
+        """
+        GradientMAP.fit(self, iterlim=iterlim, tol=tol, verbose=verbose)
+
+        self.mean = self.to_unconstrained(self.get_values())
+        self.precision = self.hessian(self.mean)
+
+        # Keep the precision sparse, its inverse is dense
+        self._lu = _sparse_ldl(self.precision)
+        if self._lu is None:
+            print "Warning! Hessian at the mode is not positive definite, adding a multiple of the identity."
+            identity = sp.identity(self.len, format='csr')
+            shift = 1e-6 * max(np.max(np.abs(self.precision.diagonal())), 1.)
+            while self._lu is None:
+                self._lu = _sparse_ldl(self.precision + shift * identity)
+                shift *= 10
+        # Draws are P U^-1 D^1/2 z (see _sparse_ldl())
+        self._sqrt_d = np.sqrt(self._lu.U.diagonal())
+        self._u_solver = spla.splu(sp.csc_matrix(self._lu.U), permc_spec='NATURAL')
+
+        self.set_values(self.to_constrained(self.mean))
+        self.fitted = True
+
+    def solve(self, b):
+        """Return the product of the covariance in unconstrained space
+        (the inverse of self.precision) and b.
+        """
+        return self._lu.solve(np.asarray(b, dtype=float))
+
+    def draw(self):
+        """Return a draw of the values of all stochastics."""
+        z = np.random.randn(self.len)
+        y = self.mean + self._u_solver.solve(self._sqrt_d * z)[self._lu.perm_c]
+        return self.to_constrained(y)
+
+    def covariance(self, stochastics=None):
+        """Return the covariance of the values of stochastics (delta
+        method at the mode).
+
+        :Optional:
+            stochastics : list
+                Stochastics in the order of the rows (default:
+                self.stochastic_list).
+
+        :Note:
+            Only the columns of the covariance of stochastics are
+            computed (one sparse solve each).
+        """
+        if stochastics is None:
+            stochastics = self.stochastic_list
+        idx = np.concatenate([np.arange(self.len)[self._slices[s]] for s in stochastics])
+        columns = np.zeros((self.len, len(idx)))
+        columns[idx, np.arange(len(idx))] = 1
+        dx_dy = self.jacobian(self.mean)[idx]
+        return self.solve(columns)[idx] * np.outer(dx_dy, dx_dy)
+
+    def set_proposal_covariance(self, sm):
+        """Initialize the proposal of the Metropolis or
+        AdaptiveMetropolis step method sm with the covariance,
+        scaled by 2.38**2/dim (Gelman, Roberts & Gilks, 1996).
+        """
+        if isinstance(sm, pm.AdaptiveMetropolis):
+            stochastics = sorted(sm._slices, key=lambda s: sm._slices[s].start)
+            sm.C = self.covariance(stochastics) * 2.38**2 / sm.dim
+            sm.updateproposal_sd()
+        elif isinstance(sm, pm.Metropolis):
+            sd = np.sqrt(np.diag(self.covariance([sm.stochastic])))
+            sm.proposal_sd = 2.38 * np.reshape(sd, np.shape(sm.stochastic.value))
+        else:
+            raise TypeError("Can only set the proposal of Metropolis step methods.")
@@ -0,0 +1,272 @@
+"""
+Faster likelihoods of observed bottom nodes.
+
+The value of an observed bottom node never changes, so everything the
+likelihood needs from the data can be computed once when the node is
+created. For exponential family likelihoods with scalar parents, the
+log likelihood only depends on a few sufficient statistics of the
+data, e.g. count, mean and sum of squared deviations for a normal:
+
+    log p(x | mu, tau) = n/2 log(tau / 2 pi) - tau/2 (ss + n (mean - mu)**2)
+
+use_sufficient_stats() replaces the logp of such a node by one that
+evaluates this in O(1) instead of O(trials). Supported are
+pymc.Normal, pymc.Bernoulli, pymc.Binomial and pymc.Poisson and the
+corresponding kabuki.utils.scipy_stochastic distributions (norm,
+bernoulli, binom, poisson).
+
+Data with discrete outcomes (e.g. choices or response codes) contains
+many identical observations. use_weighted_logp() evaluates the log
+density only at the unique values and weights it by their counts.
+Supported are all scipy_stochastic distributions and pymc.Normal,
+pymc.Bernoulli, pymc.Binomial and pymc.Poisson with scalar parents.
+
+In both cases the node keeps its class and data, so random(), pdf()
+and posterior predictive checks work as before. Used by
+Hierarchical(sufficient_stats=True) and Hierarchical(compress=True):
+
+    >>> model = MyModel(data, sufficient_stats=True)
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+from scipy.special import gammaln, xlogy, xlog1py
+
+import kabuki
+
+__all__ = ['SufficientLogp', 'use_sufficient_stats', 'WeightedLogp', 'use_weighted_logp']
+
+_LOG_2PI = np.log(2 * np.pi)
+
+
+def _normal_stats(x):
+    n = np.size(x)
+    mean = np.mean(x)
+    return {'n': n, 'mean': mean, 'ss': np.sum(np.square(x - mean))}
+
+def _normal_logp(stats, mu, tau):
+    if tau <= 0:
+        return -np.inf
+    n = stats['n']
+    return .5 * n * (np.log(tau) - _LOG_2PI) - .5 * tau * (stats['ss'] + n * (stats['mean'] - mu)**2)
+
+def _bernoulli_stats(x):
+    if not np.all((x == 0) | (x == 1)):
+        return None
+    return {'n': np.size(x), 'k': np.sum(x), 'const': 0.}
+
+def _binomial_stats(x, n):
+    if not np.all((x >= 0) & (x <= n) & (x == np.floor(x))):
+        return None
+    n = np.broadcast_to(n, np.shape(x))
+    return {'n': np.sum(n), 'k': np.sum(x),
+            'const': np.sum(gammaln(n + 1) - gammaln(x + 1) - gammaln(n - x + 1))}
+
+def _binomial_logp(stats, p):
+    if not 0 <= p <= 1:
+        return -np.inf
+    return stats['const'] + xlogy(stats['k'], p) + xlog1py(stats['n'] - stats['k'], -p)
+
+def _poisson_stats(x):
+    if not np.all((x >= 0) & (x == np.floor(x))):
+        return None
+    return {'n': np.size(x), 'k': np.sum(x), 'const': -np.sum(gammaln(x + 1))}
+
+def _poisson_logp(stats, mu):
+    if mu < 0:
+        return -np.inf
+    return stats['const'] + xlogy(stats['k'], mu) - stats['n'] * mu
+
+
+# Supported likelihoods: (pymc class or name of the scipy
+# distribution, scalar parents, constant parents, stats(x, *constant
+# parents), logp(stats, *scalar parents))
+_FAMILIES = [
+    (pm.Normal, ('mu', 'tau'), (), _normal_stats, _normal_logp),
+    (pm.Bernoulli, ('p',), (), _bernoulli_stats, _binomial_logp),
+    (pm.Binomial, ('p',), ('n',), _binomial_stats, _binomial_logp),
+    (pm.Poisson, ('mu',), (), _poisson_stats, _poisson_logp),
+    ('norm', ('loc', 'scale'), (), _normal_stats,
+     lambda stats, loc, scale: _normal_logp(stats, loc, scale**-2.) if scale > 0 else -np.inf),
+    ('bernoulli', ('p',), (), _bernoulli_stats, _binomial_logp),
+    ('binom', ('p',), ('n',), _binomial_stats, _binomial_logp),
+    ('poisson', ('mu',), (), _poisson_stats, _poisson_logp),
+]
+
+def _family(node):
+    """Return the _FAMILIES entry of node or None."""
+    rv = getattr(node, 'rv', None)
+    for family in _FAMILIES:
+        dist = family[0]
+        if isinstance(dist, str):
+            if rv is not None and rv.__class__.__name__ == dist + '_gen' and \
+               rv.__class__.__module__.startswith('scipy.stats'):
+                return family
+        elif isinstance(node, dist):
+            return family
+    return None
+
+
+class SufficientLogp(object):
+    """logp of an observed node computed from sufficient statistics
+    of its value.
+
+    :Arguments:
+        stats : dict
+            Sufficient statistics of the value.
+        scalar_parents : tuple
+            Names of the parents logp depends on.
+        logp : function
+            logp(stats, *parent values)
+
+    """
+    def __init__(self, stats, scalar_parents, logp):
+        self.stats = stats
+        self.scalar_parents = scalar_parents
+        self._logp = logp
+
+    def __call__(self, value, **kwds):
+        return self._logp(self.stats, *[kwds[name] for name in self.scalar_parents])
+
+def use_sufficient_stats(node):
+    """Compute the logp of the observed node from sufficient
+    statistics of its value if its distribution is supported.
+
+    :Arguments:
+        node : pymc.Stochastic
+            Observed node.
+
+    :Returns:
+        bool : whether node now uses sufficient statistics.
+
+    :Note:
+        Only nodes whose parents in the logp are scalar and whose
+        other parents (e.g. n of a Binomial, loc of a discrete
+        scipy_stochastic) are constants are supported, so the
+        support of the data, checked once by the statistics, cannot
+        change during sampling. The data (node.value) is kept, the statistics are
+        in node._logp_fun.stats.
+    """
+    if not node.observed:
+        return False
+    family = _family(node)
+    if family is None:
+        return False
+    dist, scalar_parents, constant_parents, stats_func, logp = family
+
+    parents = node.parents
+    if not all([np.ndim(parents.value[name]) == 0 for name in scalar_parents]):
+        return False
+    if any([isinstance(parents[name], pm.Node) for name in constant_parents]):
+        return False
+    # scipy_stochastic discrete distributions can be shifted
+    if 'loc' in parents and 'scale' not in parents:
+        if isinstance(parents['loc'], pm.Node) or np.any(parents['loc'] != 0):
+            return False
+
+    stats = stats_func(np.asarray(node.value), *[parents[name] for name in constant_parents])
+    if stats is None:
+        return False
+
+    node._logp_fun = SufficientLogp(stats, scalar_parents, logp)
+    node.gen_lazy_function()
+    return True
+
+
+# Elementwise log densities of pymc distributions: (pymc class, name
+# of the kabuki.utils._FAST_LOGP entry, shape parameters, function
+# mapping the parents to the scipy parameters)
+_PYMC_POINTS = [
+    (pm.Normal, 'norm', [], lambda mu, tau: {'loc': mu, 'scale': tau**-.5 if tau > 0 else -1.}),
+    (pm.Bernoulli, 'bernoulli', ['p'], lambda p: {'p': p, 'loc': 0}),
+    (pm.Binomial, 'binom', ['n', 'p'], lambda n, p: {'n': n, 'p': p, 'loc': 0}),
+    (pm.Poisson, 'poisson', ['mu'], lambda mu: {'mu': mu, 'loc': 0}),
+]
+
+def _points(node, values):
+    """Return function(values, **parents) returning the log density
+    of each of values given the parents of node (or -inf if a value
+    is outside of the support), or None.
+    """
+    rv = getattr(node, 'rv', None)
+    if rv is not None:
+        if isinstance(node._logp_fun, kabuki.utils._FastLogp):
+            return node._logp_fun.points
+        shape_parents = node.shape_parents
+        if hasattr(rv, 'logpdf'):
+            logpdf = rv.logpdf
+        else:
+            logpdf = rv.logpmf
+        def points(values, **kwds):
+            args = [kwds.pop(name) for name in shape_parents]
+            return logpdf(values, *args, **kwds)
+        return points
+
+    for dist, name, shape_args, parameters in _PYMC_POINTS:
+        if isinstance(node, dist):
+            fast = kabuki.utils._FastLogp(kabuki.utils._FAST_LOGP[name], shape_args, name == 'norm')
+            fast.skip_value_check(values, **parameters(**node.parents.value))
+            def points(values, **kwds):
+                return fast.points(values, **parameters(**kwds))
+            return points
+    return None
+
+
+class WeightedLogp(object):
+    """logp of an observed node as sum of the log densities of its
+    unique values weighted by their counts.
+
+    :Arguments:
+        values : array
+            Unique values.
+        counts : array
+            Number of occurrences of each value.
+        points : function
+            points(values, **parents) returns the log density of
+            each value.
+
+    """
+    def __init__(self, values, counts, points):
+        self.values = values
+        self.counts = np.asarray(counts, dtype=float)
+        self._points = points
+
+    def __call__(self, value, **kwds):
+        logp = self._points(self.values, **kwds)
+        if np.ndim(logp) == 0:
+            # Parents out of their support
+            return logp
+        return np.dot(self.counts, logp)
+
+def use_weighted_logp(node):
+    """Compute the logp of the observed node from the unique values
+    of its data weighted by their counts.
+
+    :Arguments:
+        node : pymc.Stochastic
+            Observed node.
+
+    :Returns:
+        bool : whether node now uses the weighted logp.
+
+    :Note:
+        Observations are only interchangeable if all parents are
+        scalar, nodes with array parents (e.g. trial-wise
+        probabilities) or without duplicate values are not changed.
+    """
+    if not node.observed or np.ndim(node.value) != 1:
+        return False
+    if not all([np.ndim(value) == 0 for value in node.parents.value.itervalues()]):
+        return False
+    values, counts = np.unique(node.value, return_counts=True)
+    if len(values) == len(node.value):
+        return False
+    points = _points(node, values)
+    if points is None:
+        return False
+
+    node._logp_fun = WeightedLogp(values, counts, points)
+    node.gen_lazy_function()
+    return True
@@ -0,0 +1,273 @@
+"""
+Gradient based maximum a posteriori (MAP) estimation.
+
+pymc.MAP with fmin_powell needs no gradients but its cost grows badly
+with the number of parameters. GradientMAP instead optimizes with
+L-BFGS:
+
+    * Bounded stochastics are mapped to an unconstrained space (logit
+      if both bounds are finite, log if only one is) so that the
+      optimizer never leaves the support. The bounds are taken from
+      the Parameter (see Hierarchical._get_node_bounds()) and from the
+      distribution (e.g. Uniform, TruncatedNormal).
+    * Gradients are analytical for the logp of every node that pymc
+      provides a gradient for (see pymc.Node.logp_gradient()). Only
+      the remaining children of a stochastic (e.g. custom likelihoods)
+      fall back to central finite differences. These are restricted
+      to the children without gradients and the perturbed values of
+      all dimensions of a stochastic are transformed in one batch, so
+      that one gradient costs O(#nodes) instead of O(#nodes^2) logp
+      evaluations.
+
+Used by Hierarchical.map(method='gradient').
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+from scipy.optimize import fmin_l_bfgs_b
+from scipy.special import expit
+
+from kabuki.step_methods import _bounds
+
+__all__ = ['GradientMAP']
+
+
+def _logp_descendants(deterministic):
+    """Return the stochastics and potentials whose logp depends on
+    deterministic.
+    """
+    nodes = set()
+    for child in deterministic.children:
+        if isinstance(child, pm.Deterministic):
+            nodes |= _logp_descendants(child)
+        else:
+            nodes.add(child)
+    return nodes
+
+
+class GradientMAP(pm.Model):
+    """Find the MAP of a model with L-BFGS in unconstrained space.
+
+    Has the same interface as pymc.MAP:
+
+        >>> M = GradientMAP(model.nodes, bounds=model._get_node_bounds())
+        >>> M.fit()
+        >>> M.logp
+
+    :Arguments:
+        input : nodes
+            Anything pymc.Model accepts.
+
+    :Optional:
+        bounds : dict
+            Maps stochastics to (lower, upper) (either can be None).
+            Intersected with the support of the distribution.
+        eps : float
+            Step size of finite differences (in unconstrained space).
+
+    """
+    def __init__(self, input=None, bounds=None, eps=1e-5, verbose=-1):
+        pm.Model.__init__(self, input, verbose=verbose)
+
+        if bounds is None:
+            bounds = {}
+        self.eps = eps
+        self.fitted = False
+
+        self.stochastic_list = sorted(self.stochastics, key=lambda s: s.__name__)
+        self._slices = {}
+        self.len = 0
+        for stochastic in self.stochastic_list:
+            size = np.size(stochastic.value)
+            self._slices[stochastic] = slice(self.len, self.len + size)
+            self.len += size
+
+        # Bounds of each dimension
+        self.lower = -np.inf * np.ones(self.len)
+        self.upper = np.inf * np.ones(self.len)
+        for stochastic in self.stochastic_list:
+            lower, upper = _bounds(stochastic)
+            param_lower, param_upper = bounds.get(stochastic, (None, None))
+            if param_lower is not None:
+                lower = max(lower, param_lower)
+            if param_upper is not None:
+                upper = min(upper, param_upper)
+            self.lower[self._slices[stochastic]] = lower
+            self.upper[self._slices[stochastic]] = upper
+
+        self._both = np.isfinite(self.lower) & np.isfinite(self.upper)
+        self._lower_only = np.isfinite(self.lower) & ~np.isfinite(self.upper)
+        self._upper_only = ~np.isfinite(self.lower) & np.isfinite(self.upper)
+
+        # Nodes whose logp gradient with respect to each stochastic is
+        # analytical and the nodes left for finite differences.
+        self._analytic = {}
+        self._blankets = {}
+        for stochastic in self.stochastic_list:
+            self._analytic[stochastic] = []
+            self._blankets[stochastic] = set()
+            for node in [stochastic] + list(stochastic.children):
+                try:
+                    node.logp_partial_gradient(stochastic)
+                except (NotImplementedError, AttributeError, TypeError):
+                    if isinstance(node, pm.Deterministic):
+                        self._blankets[stochastic] |= _logp_descendants(node)
+                    else:
+                        self._blankets[stochastic].add(node)
+                    continue
+                self._analytic[stochastic].append(node)
+
+    def to_unconstrained(self, x):
+        """Map values x of the stochastics to unconstrained space."""
+        y = np.array(x, dtype=float)
+        width = self.upper[self._both] - self.lower[self._both]
+        p = np.clip((x[self._both] - self.lower[self._both]) / width, 1e-12, 1 - 1e-12)
+        y[self._both] = np.log(p / (1 - p))
+        tiny = np.finfo(float).tiny
+        y[self._lower_only] = np.log(np.maximum(x[self._lower_only] - self.lower[self._lower_only], tiny))
+        y[self._upper_only] = np.log(np.maximum(self.upper[self._upper_only] - x[self._upper_only], tiny))
+        return y
+
+    def to_constrained(self, y, sl=slice(None)):
+        """Map unconstrained y to values of the stochastics.
+
+        :Optional:
+            sl : slice
+                Dimensions of y (e.g. of a single stochastic).
+        """
+        x = np.array(y, dtype=float)
+        lower, upper = self.lower[sl], self.upper[sl]
+        both, lower_only, upper_only = self._both[sl], self._lower_only[sl], self._upper_only[sl]
+        x[both] = lower[both] + (upper[both] - lower[both]) * expit(x[both])
+        x[lower_only] = lower[lower_only] + np.exp(x[lower_only])
+        x[upper_only] = upper[upper_only] - np.exp(x[upper_only])
+        return x
+
+    def jacobian(self, y):
+        """Return dx/dy (the transforms are elementwise).
+
+        y can also be a 2d array with one point per row.
+        """
+        dx_dy = np.ones(np.shape(y))
+        s = expit(y[..., self._both])
+        dx_dy[..., self._both] = (self.upper[self._both] - self.lower[self._both]) * s * (1 - s)
+        dx_dy[..., self._lower_only] = np.exp(y[..., self._lower_only])
+        dx_dy[..., self._upper_only] = -np.exp(y[..., self._upper_only])
+        return dx_dy
+
+    def log_jacobian(self, y):
+        """Return log |dx/dy| (summed over all dimensions, per row of
+        a 2d y).
+
+        Computed in closed form, log(upper - lower) - softplus(y) -
+        softplus(-y) for the logit transform, as dx/dy underflows to
+        0 for large |y|.
+        """
+        log_jac = np.zeros(np.shape(y))
+        y_both = y[..., self._both]
+        log_jac[..., self._both] = np.log(self.upper[self._both] - self.lower[self._both]) - \
+                                   np.logaddexp(0, y_both) - np.logaddexp(0, -y_both)
+        log_jac[..., self._lower_only] = y[..., self._lower_only]
+        log_jac[..., self._upper_only] = y[..., self._upper_only]
+        return np.sum(log_jac, axis=-1)
+
+    def log_jacobian_grad(self, y):
+        """Return the gradient of log_jacobian()."""
+        grad = np.zeros(np.shape(y))
+        grad[..., self._both] = 1 - 2 * expit(y[..., self._both])
+        grad[..., self._lower_only | self._upper_only] = 1
+        return grad
+
+    def get_values(self):
+        x = np.empty(self.len)
+        for stochastic in self.stochastic_list:
+            x[self._slices[stochastic]] = np.ravel(stochastic.value)
+        return x
+
+    def set_values(self, x):
+        for stochastic in self.stochastic_list:
+            self._set_value(stochastic, x[self._slices[stochastic]])
+
+    @staticmethod
+    def _set_value(stochastic, value):
+        if np.ndim(stochastic.value) == 0:
+            stochastic.value = value[0]
+        else:
+            stochastic.value = np.reshape(value, np.shape(stochastic.value))
+
+    def func(self, y):
+        """Negative log posterior at unconstrained y."""
+        self.set_values(self.to_constrained(y))
+        try:
+            return -self.logp
+        except pm.ZeroProbability:
+            return np.inf
+
+    def _blanket_logp(self, stochastic):
+        try:
+            return pm.utils.logp_of_set(self._blankets[stochastic])
+        except pm.ZeroProbability:
+            return -np.inf
+
+    def gradfunc(self, y):
+        """Gradient of func() at unconstrained y.
+
+        The logps of the nodes without analytical gradient (see
+        _blankets) are differentiated with central finite
+        differences, one dimension at a time.
+        """
+        x = self.to_constrained(y)
+        self.set_values(x)
+        dx_dy = self.jacobian(y)
+        grad = np.zeros(self.len)
+
+        for stochastic in self.stochastic_list:
+            sl = self._slices[stochastic]
+            analytic = [node.logp_partial_gradient(stochastic) for node in self._analytic[stochastic]]
+            if analytic:
+                grad[sl] = np.ravel(sum(analytic)) * dx_dy[sl]
+            if not self._blankets[stochastic]:
+                continue
+
+            # The transforms are elementwise, so the perturbed values of
+            # all dimensions are computed at once.
+            x_sl = x[sl]
+            x_plus = self.to_constrained(y[sl] + self.eps, sl)
+            x_minus = self.to_constrained(y[sl] - self.eps, sl)
+            for i in range(len(x_sl)):
+                logps = []
+                for x_i in (x_plus[i], x_minus[i]):
+                    value = x_sl.copy()
+                    value[i] = x_i
+                    self._set_value(stochastic, value)
+                    logps.append(self._blanket_logp(stochastic))
+                if np.all(np.isfinite(logps)):
+                    grad[sl.start + i] += (logps[0] - logps[1]) / (2 * self.eps)
+            self._set_value(stochastic, x_sl)
+
+        return -grad
+
+    def fit(self, method='fmin_l_bfgs_b', iterlim=1000, tol=1e-5, verbose=0):
+        """Optimize and set the stochastics to the MAP.
+
+        :Optional:
+            iterlim : int
+                Maximum number of iterations.
+            tol : float
+                Stop when the projected gradient is below tol.
+        """
+        if method != 'fmin_l_bfgs_b':
+            raise ValueError("GradientMAP only supports fmin_l_bfgs_b.")
+
+        y0 = self.to_unconstrained(self.get_values())
+        y, f, self.info = fmin_l_bfgs_b(self.func, y0, fprime=self.gradfunc,
+                                        maxiter=iterlim, pgtol=tol, iprint=verbose - 1)
+
+        self.set_values(self.to_constrained(y))
+        try:
+            self.logp_at_max = self.logp
+        except pm.ZeroProbability:
+            raise RuntimeError('Posterior probability optimization converged to value with zero probability.')
+        self.fitted = True
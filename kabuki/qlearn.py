@@ -5,11 +5,12 @@ import numpy as np
 import numpy.lib.recfunctions as rec
 import pymc as pm
 from copy import copy
+from math import exp, log
+from scipy.special import expit
 try:
-    from IPython.Debugger import Tracer; debug_here = Tracer()
-except:
-    def debug_here(): pass
-
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
 
 import kabuki
 from kabuki.hierarchical import Parameter
@@ -42,37 +43,310 @@ def q_learn(q_mat, lrate, stim, action, reward):
 
 def softmax(q_mat, inv_temp, stim, action):
     #sm = pm.exp(pm.exp(inv_temp)*q_mat[stim,action]) / (pm.sum(pm.exp(pm.exp(inv_temp)*q_mat[stim,:])))
-    sm = np.exp(inv_temp*q_mat[stim,action]) / (np.sum(np.exp(inv_temp*q_mat[stim,:])))
+    # Subtract the maximum to avoid overflow
+    x = inv_temp*q_mat[stim,:]
+    x = x - np.max(x)
+    sm = np.exp(x[action]) / np.sum(np.exp(x))
     return sm
 
+def _chosen_log_probs(stim, action, reward, inv_temp, lrate, q_mat):
+    """Run Q-learning over trials and yield the log softmax
+    probability of each chosen action.
+
+    Works in place on the preallocated q_mat (list of lists, reset to
+    .5), so that no arrays are allocated per trial.
+    """
+    num_actions = len(q_mat[0])
+    for row in q_mat:
+        for j in range(num_actions):
+            row[j] = .5
+
+    for t in range(len(stim)):
+        q_row = q_mat[stim[t]]
+        a = action[t]
+        # Numerically stable softmax
+        q_max = max(q_row)
+        denom = 0.
+        for q in q_row:
+            denom += exp(inv_temp*(q - q_max))
+        q_val = q_row[a]
+        yield inv_temp*(q_val - q_max) - log(denom)
+        # Update Q-value of chosen action
+        q_row[a] = q_val + lrate*(reward[t] - q_val)
+
+def _choice_probs(stim, action, reward, inv_temp, lrate, q_mat, out):
+    """Write the softmax probability of each chosen action into out
+    (see _chosen_log_probs()).
+    """
+    for t, logp in enumerate(_chosen_log_probs(stim, action, reward, inv_temp, lrate, q_mat)):
+        out[t] = exp(logp)
+    return out
+
+class ChoiceProbs(object):
+    """Choice probabilities of a Q-learning model for fixed data.
+
+    Callable replacement of create_choice_probs() for
+    pymc.Deterministic: the stim, action and reward columns are
+    converted once and results are memoized by (lrate, inv_temp), so
+    that repeated evaluations (e.g. rejected proposals) are not
+    recomputed.
+
+    :Arguments:
+        data : numpy.recarray
+            Trials with columns 'stim', 'action' and 'reward'.
+
+    :Optional:
+        num_stims, num_actions : int
+            Shape of the Q matrix (default 2x2).
+        cache_size : int
+            Number of results to memoize (0 disables the cache).
+
+    """
+    def __init__(self, data, num_stims=2, num_actions=2, cache_size=128):
+        self.stim = data['stim'].astype(int).tolist()
+        self.action = data['action'].astype(int).tolist()
+        self.reward = data['reward'].astype(float).tolist()
+        self.q_mat = [[.5]*num_actions for i in range(num_stims)]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+
+    def __call__(self, inv_temp=None, lrate=None):
+        key = (float(lrate), float(inv_temp))
+        if key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+
+        out = _choice_probs(self.stim, self.action, self.reward,
+                            key[1], key[0], self.q_mat, np.empty(len(self.stim)))
+
+        if self.cache_size > 0:
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+            self.cache[key] = out
+
+        return out
+
 def create_choice_probs(data=None, inv_temp=None, lrate=None):
-    # Run model
+    """Return the softmax probability of each chosen action in data
+    under Q-learning with learning rate lrate and inverse temperature
+    inv_temp.
+    """
     size = len(data)
-    choice_probs = np.empty(size)
-    q_vals = []
-
-    for t in range(size):
-        if t==0:
-            q_val = .5*np.ones((2,2))
+    return _choice_probs(data['stim'].astype(int).tolist(),
+                         data['action'].astype(int).tolist(),
+                         data['reward'].astype(float).tolist(),
+                         float(inv_temp), float(lrate),
+                         [[.5, .5], [.5, .5]], np.empty(size))
+
+def _choice_logp(stim, action, reward, inv_temp, lrate, q_mat):
+    """Return the summed log softmax probability of the chosen
+    actions (see _chosen_log_probs()).
+    """
+    return sum(_chosen_log_probs(stim, action, reward, inv_temp, lrate, q_mat))
+
+def batched_choice_logp(stim, action, reward, mask, lrate, inv_temp, num_stims=2, num_actions=2):
+    """Return the log-likelihood of the chosen actions of each subject.
+
+    All subjects are advanced with array operations in one loop over
+    the trial index.
+
+    :Arguments:
+        stim, action, reward : array
+            Trials in (subjects x trials) layout, padded to the
+            largest number of trials.
+        mask : array
+            True for trials that are not padding.
+        lrate, inv_temp : array
+            Parameters of each subject.
+
+    :Returns:
+        Array of the log-likelihood of each subject.
+    """
+    num_subjs, num_trials = stim.shape
+    subjs = np.arange(num_subjs)
+    lrate = np.asarray(lrate, dtype=float)
+    inv_temp = np.asarray(inv_temp, dtype=float)[:,np.newaxis]
+
+    q_mat = .5*np.ones((num_subjs, num_stims, num_actions))
+    logp = np.zeros(num_subjs)
+    x = np.empty((num_subjs, num_actions))
+
+    for t in range(num_trials):
+        s, a = stim[:,t], action[:,t]
+        # Numerically stable log softmax
+        np.multiply(inv_temp, q_mat[subjs, s], out=x)
+        x -= x.max(axis=1)[:,np.newaxis]
+        logp += mask[:,t] * (x[subjs, a] - np.log(np.exp(x).sum(axis=1)))
+        # Update Q-values of chosen actions (not for padding)
+        q_val = q_mat[subjs, s, a]
+        q_mat[subjs, s, a] = q_val + mask[:,t] * lrate * (reward[:,t] - q_val)
+
+    return logp
+
+class BatchedChoiceLogp(object):
+    """Log-likelihood of the chosen actions of a group of subjects,
+    shared by the bottom nodes of the subjects.
+
+    Each subject's bottom node only depends on the subject's own
+    parameters (so subject-wise step methods only evaluate it) and
+    asks subj_logp() for its entry. On a cache miss, if many subjects'
+    parameter nodes changed since their last evaluation (e.g. when
+    the logp of the whole model is evaluated after all values were
+    set), all of them are recomputed at once with
+    batched_choice_logp(). Otherwise (e.g. after a subject-wise
+    proposal) only the subject itself is.
+
+    :Arguments:
+        data_list : list of numpy.recarray
+            Trials of each subject.
+
+    :Optional:
+        num_stims, num_actions : int
+            Shape of the Q matrix.
+
+    """
+    # Smallest number of changed subjects to recompute batched
+    min_batch = 20
+    # Results cached per subject
+    cache_depth = 2
+
+    def __init__(self, data_list, num_stims=2, num_actions=2):
+        self.num_stims = num_stims
+        self.num_actions = num_actions
+        num_subjs = len(data_list)
+        num_trials = max([len(data) for data in data_list])
+
+        self.stim = np.zeros((num_subjs, num_trials), dtype=int)
+        self.action = np.zeros((num_subjs, num_trials), dtype=int)
+        self.reward = np.zeros((num_subjs, num_trials))
+        self.mask = np.zeros((num_subjs, num_trials))
+        self._trials = []
+        for i, data in enumerate(data_list):
+            n = len(data)
+            self.stim[i,:n] = data['stim']
+            self.action[i,:n] = data['action']
+            self.reward[i,:n] = data['reward']
+            self.mask[i,:n] = 1
+            self._trials.append((self.stim[i,:n].tolist(), self.action[i,:n].tolist(),
+                                 self.reward[i,:n].tolist()))
+
+        self._q_mat = [[.5]*num_actions for i in range(num_stims)]
+        self.logp = np.zeros((self.cache_depth, num_subjs))
+        self.lrate = np.nan * np.ones((self.cache_depth, num_subjs))
+        self.inv_temp = np.nan * np.ones((self.cache_depth, num_subjs))
+        self.lrate_nodes = None
+        self.inv_temp_nodes = None
+
+    def set_nodes(self, lrate_nodes, inv_temp_nodes):
+        """Set the parameter nodes (or values) of the subjects, whose
+        current values are prefetched on a cache miss.
+        """
+        self.lrate_nodes = lrate_nodes
+        self.inv_temp_nodes = inv_temp_nodes
+
+    def compute(self, lrate, inv_temp, subjs=None):
+        """Compute and cache the log-likelihood of subjs (default: all)
+        for parameter arrays lrate and inv_temp.
+        """
+        if subjs is None:
+            subjs = np.arange(len(self.stim))
+        if len(subjs) >= self.min_batch:
+            logp = batched_choice_logp(self.stim[subjs], self.action[subjs],
+                                       self.reward[subjs], self.mask[subjs],
+                                       lrate, inv_temp,
+                                       self.num_stims, self.num_actions)
         else:
-            q_val = q_vals[-1]
-
-        choice_probs[t] = softmax(q_val, inv_temp, data['stim'][t], data['action'][t])
-        q_vals.append(q_learn(q_val, lrate, data['stim'][t], data['action'][t], data['reward'][t]))
-
-    return choice_probs
+            logp = np.empty(len(subjs))
+            for j, (i, l, it) in enumerate(zip(subjs, lrate, inv_temp)):
+                stim, action, reward = self._trials[i]
+                logp[j] = _choice_logp(stim, action, reward, it, l, self._q_mat)
+        for cache, new in ((self.logp, logp), (self.lrate, lrate), (self.inv_temp, inv_temp)):
+            cache[1:, subjs] = cache[:-1, subjs]
+            cache[0, subjs] = new
+        return logp
+
+    def _cached(self, lrate, inv_temp, subjs=slice(None)):
+        """Return the slot of the cached result of subjs (-1 if none)."""
+        slot = -np.ones(np.size(self.lrate[0, subjs]), dtype=int)
+        for i in reversed(range(self.cache_depth)):
+            slot[(self.lrate[i, subjs] == lrate) & (self.inv_temp[i, subjs] == inv_temp)] = i
+        return slot
+
+    def subj_logp(self, idx, lrate, inv_temp):
+        """Return the log-likelihood of subject idx."""
+        slot = self._cached(lrate, inv_temp, idx)[0]
+        if slot >= 0:
+            return self.logp[slot, idx]
+
+        # Only look for other changed subjects if the next one changed
+        # as well (which is cheaper to check).
+        if self.lrate_nodes is None:
+            return self.compute([lrate], [inv_temp], [idx])[0]
+        probe = (idx + 1) % len(self.stim)
+        if self._cached(_value(self.lrate_nodes[probe]), _value(self.inv_temp_nodes[probe]), probe)[0] >= 0:
+            return self.compute([lrate], [inv_temp], [idx])[0]
+
+        lrates = np.fromiter([_value(node) for node in self.lrate_nodes], float, len(self.stim))
+        inv_temps = np.fromiter([_value(node) for node in self.inv_temp_nodes], float, len(self.stim))
+        lrates[idx], inv_temps[idx] = lrate, inv_temp
+        changed = np.flatnonzero(self._cached(lrates, inv_temps) < 0)
+        if len(changed) < self.min_batch:
+            # Others are computed when (and if) they are needed
+            changed = [idx]
+        self.compute(lrates[changed], inv_temps[changed], changed)
+        return self.logp[0, idx]
+
+def _value(node):
+    return getattr(node, 'value', node)
+
+def _subj_logp(value, lrate, inv_temp, batch, idx):
+    return batch.subj_logp(idx, float(lrate), float(inv_temp))
 
 class QLearn(kabuki.Hierarchical):
-    def __init__(self, data, **kwargs):
+    """Hierarchical Q-learning model of two-armed bandit data.
+
+    :Arguments:
+        data : numpy.recarray
+            Trials with columns 'stim', 'action' and 'reward' (see
+            qlearn_generate()).
+
+    :Optional:
+        num_stims, num_actions : int
+            Shape of the Q matrix (default: largest index in data + 1).
+        batched : bool
+            Compute the likelihoods of all subjects of a condition
+            together (see BatchedChoiceLogp). Otherwise each subject
+            has its own ChoiceProbs deterministic. Speeds up
+            evaluations of the whole model (e.g. map(method='gradient'),
+            fit_vi()) with many subjects, but not subject-wise
+            Metropolis steps.
+
+    :Note:
+        Forwards additional keyword arguments to Hierarchical.
+        sufficient_stats and compress are not supported since the
+        likelihood of each trial depends on all previous trials.
+
+    """
+    def __init__(self, data, num_stims=None, num_actions=None, batched=False, **kwargs):
+        if kwargs.get('sufficient_stats') or kwargs.get('compress'):
+            raise ValueError("QLearn does not support sufficient_stats or compress: "
+                             "the likelihood of each trial depends on all previous trials.")
         super(QLearn, self).__init__(data, **kwargs)
 
-        self.num_stims = len(np.unique(data['stim']))
-        self.num_actions = len(np.unique(data['action']))
+        if num_stims is None:
+            num_stims = max(2, int(np.max(data['stim'])) + 1)
+        if num_actions is None:
+            num_actions = max(2, int(np.max(data['action'])) + 1)
+        self.num_stims = num_stims
+        self.num_actions = num_actions
+        self.batched = batched
 
-        self.params = [Parameter('lrate', lower=0, upper=1, init=.1),
-                       Parameter('inv_temp', lower=1, upper=15, init=5),
-                       Parameter('choice_probs', is_bottom_node=True),
-                       Parameter('like', is_bottom_node=True)]
+    def get_params(self):
+        return [Parameter('lrate', lower=0, upper=1, init=.1),
+                Parameter('inv_temp', lower=1, upper=15, init=5),
+                Parameter('choice_probs', is_bottom_node=True),
+                Parameter('like', is_bottom_node=True)]
 
     def get_var_node(self, param):
         if param.name == 'lrate':
@@ -83,80 +357,139 @@ class QLearn(kabuki.Hierarchical):
                               value=3., plot=self.plot_var)
 
     def get_bottom_node(self, param, params):
-        #q_vals = np.empty(len(param.data), dtype=object)
-        #softmax_probs = np.empty(len(param.data), dtype=object)
-        #choice_probs = np.empty(len(param.data), dtype=object)
-
         if param.name == 'choice_probs':
-            return pm.Deterministic(create_choice_probs,
+            return pm.Deterministic(ChoiceProbs(param.data, self.num_stims, self.num_actions),
                                     param.full_name,
                                     param.full_name,
-                                    {'data':param.data,
-                                     'inv_temp':params['inv_temp'],
+                                    {'inv_temp':params['inv_temp'],
                                      'lrate':params['lrate']})
 
         elif param.name == 'like':
-            # Create likelihood
+            # Created after the choice_probs node of the same subject
+            choice_probs = self.params_include['choice_probs'].bottom_nodes[param.tag]
+            if self.is_group_model:
+                choice_probs = choice_probs[param.idx]
+
+            # Create likelihood of the chosen actions
             return pm.Bernoulli(param.full_name,
-                                p=params['choice_probs'],
-                                value=np.ones_like(np.ones_like(params['choice_probs'].value)),
+                                p=choice_probs,
+                                value=np.ones(len(param.data)),
                                 observed=True)
 
         else:
             print "Not found."
 
+    def _create_bottom_node(self, param, data, params, dep_name, idx):
+        """Create the bottom nodes of all subjects of a condition
+        sharing one BatchedChoiceLogp. The choice_probs nodes are
+        still created (and traced), but are not parents of the
+        likelihood.
+        """
+        if not (self.batched and self.is_group_model) or param.name != 'like':
+            return super(QLearn, self)._create_bottom_node(param, data, params, dep_name, idx)
+
+        subjs = []
+        data_list = []
+        for i, subj in enumerate(self._subjs):
+            data_subj = data[data['subj_idx'] == subj]
+            if len(data_subj) == 0:
+                param.bottom_nodes[dep_name][i] = None
+                continue
+            subjs.append(i)
+            data_list.append(data_subj)
+
+        def subj_nodes(name):
+            if self.params_include[name].create_subj_nodes:
+                return [params[name][i] for i in subjs]
+            return [params[name]] * len(subjs)
+
+        lrates, inv_temps = subj_nodes('lrate'), subj_nodes('inv_temp')
+        batch = BatchedChoiceLogp(data_list, self.num_stims, self.num_actions)
+        batch.set_nodes(lrates, inv_temps)
+
+        param.tag = dep_name
+        for j, i in enumerate(subjs):
+            param.idx = i
+            param.bottom_nodes[dep_name][i] = pm.Stochastic(_subj_logp, param.full_name, param.full_name,
+                                                            {'lrate': lrates[j], 'inv_temp': inv_temps[j],
+                                                             'batch': batch, 'idx': j},
+                                                            value=np.ones(len(data_list[j])),
+                                                            dtype=float, observed=True)
+        param.reset()
+
+        return self
+
 #########
 # Generate
 
-import numpy as np
-import matplotlib.pyplot as plt
-
 def qlearn_generate(trials=50, lrate=.1, rew_prob=.7, inv_temp=5., plot=False, subjs=2):
-    Q = .5*np.ones((2,2))
+    """Simulate Q-learning subjects in a two-armed bandit task:
+    stimulus 0 and 1 alternate, the action equal to the stimulus is
+    rewarded with probability rew_prob, the other one with
+    1 - rew_prob.
+
+    All subjects are simulated in lockstep (one loop over trials) with
+    random numbers drawn beforehand. Q-values start at .5 for each
+    subject.
+
+    :Optional:
+        trials : int
+            Number of trials per subject.
+        lrate, inv_temp : float or array
+            Learning rate and inverse temperature (for all subjects or
+            one per subject).
+        rew_prob : float
+            Reward probability of the correct action.
+        plot : bool
+            Plot Q-values of both actions for stimulus 0.
+        subjs : int
+            Number of subjects.
+
+    :Returns:
+        numpy.recarray with fields subj_idx, stim, action and reward.
+    """
+    lrate = np.ones(subjs) * lrate
+    inv_temp = np.ones(subjs) * inv_temp
     out = np.empty(trials*subjs, dtype=[('subj_idx',np.int), ('stim', np.int), ('action', np.int), ('reward', np.float)])
-    Q1 = []
-    Q2 = []
-    for subj in range(subjs):
-        idx = slice(subj*trials, (subj+1)*trials)
-        out[idx]['subj_idx'] = subj
-        for t in range(trials):
-            # Present stimulus 0 or 1 (alternating)
-            state = t%2
-            # Chose action based on softmax over Q-values
-            action = softmax_gen(Q[state], inv_temp)
-
-            # Reward is probabilistic (70% for a1 to s1 and vice versa)
-            rnd = np.random.rand()
-            if action == state:
-                reward = 1 if rnd < rew_prob else 0
-            else:
-                reward = 0 if rnd < rew_prob else 1
-
-            # Update Q-value based on reward received
-            Q[state,action] = Q[state,action] + lrate * (reward - Q[state,action])
-
-            out[idx]['stim'][t] = state
-            out[idx]['action'][t] = action
-            out[idx]['reward'][t] = reward
-
-            Q1.append(Q[0,0])
-            Q2.append(Q[0,1])
+    out['subj_idx'] = np.repeat(np.arange(subjs), trials)
 
-    if plot:
-        plt.figure()
-        plt.plot(Q1)
-        plt.plot(Q2)
+    # (subjects x trials) views of the output
+    stim = out['stim'].reshape(subjs, trials)
+    action = out['action'].reshape(subjs, trials)
+    reward = out['reward'].reshape(subjs, trials)
 
-    return out
+    rand_action = np.random.rand(subjs, trials)
+    rand_reward = np.random.rand(subjs, trials)
 
+    # Present stimulus 0 or 1 (alternating)
+    stim[:] = np.arange(trials) % 2
 
-def softmax_gen(Q1, inv_temp):
-    p1 = np.exp(Q1[0]*inv_temp)
-    p1 = p1 / (p1 + np.exp(Q1[1]*inv_temp))
+    Q = .5*np.ones((subjs, 2, 2))
+    Q1 = np.empty((subjs, trials))
+    Q2 = np.empty((subjs, trials))
+    idx = np.arange(subjs)
+    for t in range(trials):
+        state = t%2
+        # Chose action based on softmax over Q-values
+        p0 = expit(inv_temp * (Q[:,state,0] - Q[:,state,1]))
+        action[:,t] = rand_action[:,t] >= p0
 
-    rand = np.random.rand()
+        # Reward is probabilistic (70% for a1 to s1 and vice versa)
+        correct = action[:,t] == state
+        reward[:,t] = np.where(correct, rand_reward[:,t] < rew_prob, rand_reward[:,t] >= rew_prob)
 
-    return 0 if rand < p1 else 1
+        # Update Q-value based on reward received
+        q_val = Q[idx,state,action[:,t]]
+        Q[idx,state,action[:,t]] = q_val + lrate * (reward[:,t] - q_val)
 
+        Q1[:,t] = Q[:,0,0]
+        Q2[:,t] = Q[:,0,1]
 
+    if plot:
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plt.plot(Q1.ravel())
+        plt.plot(Q2.ravel())
+
+    return out
 
@@ -0,0 +1,451 @@
+"""
+Step methods that exploit the structure of hierarchical models.
+
+Slice is a univariate and blocked slice sampler that respects the
+support of the distributions of the stochastics and adapts its width
+during burn-in. It
+is used by Hierarchical.use_slice_step_methods() (or
+mcmc(slice=True)).
+
+GroupMeanGibbs and GroupVarGibbs update the group node and var node
+of a parameter with a draw from their full conditional distribution
+given the current values of the subject nodes. They are used by
+Hierarchical.use_gibbs_step_methods() (or mcmc(gibbs=True)) for all
+group and var nodes with a (semi-)conjugate configuration:
+
+    * group node: Uniform or Normal prior, subj nodes are Normal or
+      TruncatedNormal with mu=group node.
+    * var node: Uniform prior on the standard deviation with subj
+      nodes having tau=var**-2, or Gamma prior on the precision with
+      subj nodes having tau=var.
+
+If the subj nodes are truncated the conditional is not available in
+closed form. The draw of the untruncated conditional is then used as
+an independence proposal and accepted with a Metropolis-Hastings step,
+which accepts almost every proposal as long as the truncation points
+are far from the group mean.
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+
+__all__ = ['GroupMeanGibbs', 'GroupVarGibbs', 'Slice']
+
+
+def _value(x):
+    if isinstance(x, pm.Variable):
+        return x.value
+    return x
+
+def _depends_on(x, node):
+    """Return True if x is node or one of its descendants."""
+    return x is node or (isinstance(x, pm.Variable) and node in x.extended_parents)
+
+def _normal_children(stochastic):
+    """Return the Normal and TruncatedNormal children of stochastic
+    (sorted by name) or None if it has other children.
+    """
+    children = sorted(stochastic.extended_children, key=lambda child: child.__name__)
+    for child in children:
+        if not isinstance(child, (pm.Normal, pm.TruncatedNormal)):
+            return None
+    return children
+
+
+class _GroupGibbs(pm.Gibbs):
+    """Base class of the group step methods.
+
+    Subclasses implement applicable(), draw() and logq().
+    """
+    def __init__(self, stochastic, verbose=-1):
+        pm.Gibbs.__init__(self, stochastic, verbose=verbose)
+
+        self.subj_nodes = _normal_children(stochastic)
+        if not self.subj_nodes or not self.applicable(stochastic):
+            raise ValueError("%s is not conjugate to its children." % stochastic.__name__)
+
+        # Truncated subj nodes require a Metropolis-Hastings correction
+        self.conjugate = not any([isinstance(node, pm.TruncatedNormal) for node in self.subj_nodes])
+
+        self._id = self.__class__.__name__ + '_' + stochastic.__name__
+
+    def _subj_values(self):
+        """Return values, mus and taus of the subj nodes as flat arrays."""
+        values = np.concatenate([np.ravel(node.value) for node in self.subj_nodes])
+        mus = np.concatenate([np.ravel(node.value) * 0 + _value(node.parents['mu'])
+                              for node in self.subj_nodes])
+        taus = np.concatenate([np.ravel(node.value) * 0 + _value(node.parents['tau'])
+                               for node in self.subj_nodes])
+        return values, mus, taus
+
+    def step(self):
+        if self.conjugate:
+            self.stochastic.value, params = self.draw()
+            self.accepted += 1
+            return
+
+        logp = self.logp_plus_loglike
+        old_value = self.stochastic.value
+
+        new_value, params = self.draw()
+        self.stochastic.value = new_value
+        try:
+            logp_p = self.logp_plus_loglike
+        except pm.ZeroProbability:
+            self.reject()
+            self.rejected += 1
+            return
+
+        # Independence proposal
+        log_ratio = logp_p - logp - self.logq(new_value, params) + self.logq(old_value, params)
+        if np.log(np.random.random()) > log_ratio:
+            self.reject()
+            self.rejected += 1
+        else:
+            self.accepted += 1
+
+
+class GroupMeanGibbs(_GroupGibbs):
+    """Gibbs step method for the group mean of normally distributed
+    subject nodes.
+
+    :Arguments:
+        stochastic : pymc.Uniform or pymc.Normal
+            Group node with constant parents. All its children have to
+            be Normal or TruncatedNormal with mu=stochastic.
+
+    """
+    @staticmethod
+    def applicable(stochastic):
+        """Return True if stochastic can be updated by GroupMeanGibbs."""
+        if isinstance(stochastic, pm.Uniform):
+            prior_parents = ['lower', 'upper']
+        elif isinstance(stochastic, pm.Normal):
+            prior_parents = ['mu', 'tau']
+        else:
+            return False
+        if any([isinstance(stochastic.parents[name], pm.Variable) for name in prior_parents]) or \
+           np.size(stochastic.value) != 1:
+            return False
+
+        children = _normal_children(stochastic)
+        if not children:
+            return False
+        for child in children:
+            if child.parents['mu'] is not stochastic:
+                return False
+            for name, parent in child.parents.iteritems():
+                if name != 'mu' and _depends_on(parent, stochastic):
+                    return False
+        return True
+
+    def draw(self):
+        values, mus, taus = self._subj_values()
+        tau_post = np.sum(taus)
+        mu_post = np.sum(taus * values)
+
+        parents = self.stochastic.parents
+        if isinstance(self.stochastic, pm.Normal):
+            tau_post += parents['tau']
+            mu_post += parents['tau'] * parents['mu']
+            mu_post /= tau_post
+            value = np.random.normal(mu_post, tau_post**-.5)
+        else:
+            mu_post /= tau_post
+            value = pm.rtruncated_normal(mu_post, tau_post, parents['lower'], parents['upper'])[0]
+
+        return value, (mu_post, tau_post)
+
+    def logq(self, value, params):
+        mu_post, tau_post = params
+        return -.5 * tau_post * (value - mu_post)**2
+
+
+class GroupVarGibbs(_GroupGibbs):
+    """Gibbs step method for the variability of normally distributed
+    subject nodes.
+
+    :Arguments:
+        stochastic : pymc.Uniform or pymc.Gamma
+            Var node with constant parents. Uniform var nodes are the
+            standard deviation of their children (tau=var**-2), Gamma
+            var nodes the precision (tau=var).
+
+    """
+    @staticmethod
+    def _parametrization(stochastic):
+        """Return 'sd', 'precision' or None if stochastic is not conjugate."""
+        if isinstance(stochastic, pm.Uniform):
+            prior_parents = ['lower', 'upper']
+            kind = 'sd'
+            if _value(stochastic.parents['lower']) < 0:
+                return None
+        elif isinstance(stochastic, pm.Gamma):
+            prior_parents = ['alpha', 'beta']
+            kind = 'precision'
+        else:
+            return None
+        if any([isinstance(stochastic.parents[name], pm.Variable) for name in prior_parents]) or \
+           np.size(stochastic.value) != 1:
+            return None
+
+        children = _normal_children(stochastic)
+        if not children:
+            return None
+        for child in children:
+            for name, parent in child.parents.iteritems():
+                if name != 'tau' and _depends_on(parent, stochastic):
+                    return None
+
+            tau = child.parents['tau']
+            if tau is stochastic:
+                if kind != 'precision':
+                    return None
+            elif kind == 'sd' and isinstance(tau, pm.Deterministic):
+                # tau has to be var**-2, which is checked by evaluating
+                # at a few points.
+                if [parent for parent in tau.extended_parents if isinstance(parent, pm.Stochastic)] != [stochastic]:
+                    return None
+                arg_names = [name for name, parent in tau.parents.iteritems() if parent is stochastic]
+                if len(arg_names) != 1:
+                    return None
+                for test_value in (.5, 2.):
+                    args = dict(tau.parents.value)
+                    args[arg_names[0]] = test_value
+                    if not np.allclose(tau._eval_fun(**args), test_value**-2):
+                        return None
+            else:
+                return None
+
+        if kind == 'sd' and sum([np.size(child.value) for child in children]) < 2:
+            return None
+
+        return kind
+
+    @staticmethod
+    def applicable(stochastic):
+        """Return True if stochastic can be updated by GroupVarGibbs."""
+        return GroupVarGibbs._parametrization(stochastic) is not None
+
+    def __init__(self, stochastic, verbose=-1):
+        _GroupGibbs.__init__(self, stochastic, verbose=verbose)
+        self.kind = self._parametrization(stochastic)
+
+    def draw(self):
+        values, mus, taus = self._subj_values()
+        ss = np.sum((values - mus)**2)
+
+        parents = self.stochastic.parents
+        if self.kind == 'sd':
+            # Conditional of the precision var**-2
+            shape = (len(values) - 1) / 2
+            # ss is 0 if all subj nodes are at the group mean (e.g. at
+            # initialization), the conditional then is at var_lower.
+            rate = max(ss / 2, np.finfo(float).tiny)
+            tau_lower = parents['upper']**-2
+            tau_upper = parents['lower']**-2 if parents['lower'] > 0 else np.inf
+        else:
+            shape = parents['alpha'] + len(values) / 2
+            rate = parents['beta'] + ss / 2
+            tau_lower = 0
+            tau_upper = np.inf
+
+        from scipy import stats
+
+        # Inverse CDF sampling of the (truncated) Gamma distribution
+        dist = stats.gamma(shape, scale=1 / rate)
+        cdf_lower = dist.cdf(tau_lower)
+        cdf_upper = dist.cdf(tau_upper)
+        if cdf_upper <= cdf_lower:
+            # All mass outside of the prior support (numerically)
+            tau = tau_lower if rate * tau_lower > shape else tau_upper
+        else:
+            tau = dist.ppf(np.random.uniform(cdf_lower, cdf_upper))
+
+        if self.kind == 'sd':
+            return tau**-.5, (shape, rate)
+        return tau, (shape, rate)
+
+    def logq(self, value, params):
+        shape, rate = params
+        if self.kind == 'sd':
+            tau = value**-2
+            # Jacobian of tau -> sd
+            return (shape - 1) * np.log(tau) - rate * tau - 3 * np.log(value)
+        return (shape - 1) * np.log(value) - rate * value
+
+
+def _bounds(stochastic):
+    """Return the support of stochastic as given by its distribution
+    (evaluated at the current values of its parents).
+    """
+    parents = stochastic.parents.value
+    if isinstance(stochastic, pm.Uniform):
+        return parents['lower'], parents['upper']
+    if isinstance(stochastic, pm.TruncatedNormal):
+        return parents['a'], parents['b']
+    if isinstance(stochastic, pm.Beta):
+        return 0, 1
+    if isinstance(stochastic, (pm.Exponential, pm.Gamma, pm.HalfNormal, pm.InverseGamma,
+                               pm.Lognormal, pm.Weibull, pm.Chi2)):
+        return 0, np.inf
+    return -np.inf, np.inf
+
+
+class Slice(pm.StepMethod):
+    """Slice sampler (Neal 2003) for continuous, bounded stochastics.
+
+    A single scalar stochastic is updated by stepping out and
+    shrinkage, blocks of stochastics by shrinking a hyperrectangle
+    around the current point. Intervals are clipped to the support of
+    the distribution of each stochastic (e.g. the bounds of a Uniform
+    or TruncatedNormal, or 0 for positive distributions), so no
+    evaluations are wasted outside of it. Stochastics with other
+    distributions are unbounded.
+
+    The width of each dimension is adapted while the sampler is tuning
+    to three times the standard deviation of the samples since the
+    last tuning. Unlike the step size, the spread of the samples also
+    grows when the width is too small, so the width of blocks (which
+    can only shrink within a step) does not collapse.
+
+    :Arguments:
+        stochastic : pymc.Stochastic or list of pymc.Stochastic
+            Stochastic(s) to update jointly.
+
+    :Optional:
+        width : float or array
+            Initial width of the slice in each dimension.
+        max_steps : int
+            Maximum number of steps out in each direction.
+
+    """
+    def __init__(self, stochastic, width=1., max_steps=10, verbose=-1, tally=False):
+        pm.StepMethod.__init__(self, stochastic, verbose=verbose, tally=tally)
+
+        # Fixed ordering independent of the hash based set of stochastics
+        self._stochastics = sorted(self.stochastics, key=lambda s: s.__name__)
+        self._id = 'Slice_' + '_'.join([s.__name__ for s in self._stochastics])
+        self._sizes = [np.size(s.value) for s in self._stochastics]
+        self.dim = sum(self._sizes)
+
+        self.width = np.ones(self.dim) * width
+        self.max_steps = max_steps
+
+        # Sums of the samples (shifted by the first one for numerical
+        # stability) since the last tuning
+        self._tune_shift = None
+        self._tune_sum = np.zeros(self.dim)
+        self._tune_sum_sq = np.zeros(self.dim)
+        self._tune_count = 0
+        self.n_evals = 0
+
+        self._state = ['width', '_tune_shift', '_tune_sum', '_tune_sum_sq',
+                       '_tune_count', 'n_evals']
+        self._tuning_info = ['width']
+
+    @staticmethod
+    def competence(stochastic):
+        return 0
+
+    def get_value(self):
+        return np.concatenate([np.ravel(s.value) for s in self._stochastics]).astype(float)
+
+    def set_value(self, x):
+        start = 0
+        for s, size in zip(self._stochastics, self._sizes):
+            if np.ndim(s.value) == 0:
+                s.value = x[start]
+            else:
+                s.value = np.reshape(x[start:start+size], np.shape(s.value))
+            start += size
+
+    def get_bounds(self):
+        bounds = [_bounds(s) for s in self._stochastics]
+        lower = np.concatenate([np.repeat(b[0], size) for b, size in zip(bounds, self._sizes)])
+        upper = np.concatenate([np.repeat(b[1], size) for b, size in zip(bounds, self._sizes)])
+        return lower.astype(float), upper.astype(float)
+
+    def logp(self, x):
+        """Log posterior (up to a constant) at x."""
+        self.n_evals += 1
+        self.set_value(x)
+        try:
+            return self.logp_plus_loglike
+        except pm.ZeroProbability:
+            return -np.inf
+
+    def step(self):
+        x0 = self.get_value()
+        logy = self.logp_plus_loglike - np.random.exponential()
+        lower, upper = self.get_bounds()
+
+        # Randomly position the interval around x0
+        left = x0 - self.width * np.random.random(self.dim)
+        right = left + self.width
+
+        if self.dim == 1:
+            # Stepping out
+            steps_left = np.random.randint(self.max_steps)
+            steps_right = self.max_steps - 1 - steps_left
+            while steps_left > 0 and left[0] > lower[0] and self.logp(left) > logy:
+                left -= self.width
+                steps_left -= 1
+            while steps_right > 0 and right[0] < upper[0] and self.logp(right) > logy:
+                right += self.width
+                steps_right -= 1
+
+        left = np.maximum(left, lower)
+        right = np.minimum(right, upper)
+
+        # Shrinkage
+        while True:
+            x1 = left + (right - left) * np.random.random(self.dim)
+            if self.logp(x1) > logy:
+                break
+            shrink_left = x1 < x0
+            left[shrink_left] = x1[shrink_left]
+            right[~shrink_left] = x1[~shrink_left]
+            if np.all(right - left < 1e-12):
+                # Numerically collapsed, stay at x0
+                x1 = x0
+                self.set_value(x0)
+                break
+
+        model = getattr(self, '_model', None)
+        if model is None or getattr(model, '_tuning', True):
+            if self._tune_shift is None:
+                self._tune_shift = x1
+            self._tune_sum += x1 - self._tune_shift
+            self._tune_sum_sq += (x1 - self._tune_shift)**2
+            self._tune_count += 1
+
+    def tune(self, verbose=-1, *args, **kwargs):
+        """Set width to three times the standard deviation of the
+        samples since the last call.
+
+        :Returns:
+            bool: True if the width changed by more than 20%.
+        """
+        if self._tune_count == 0:
+            return False
+
+        mean = self._tune_sum / self._tune_count
+        var = np.maximum(self._tune_sum_sq / self._tune_count - mean**2, 0)
+        new_width = 3 * np.sqrt(var)
+        # Keep width of dimensions that did not move
+        new_width[new_width == 0] = self.width[new_width == 0]
+        ratio = new_width / self.width
+        self.width = new_width
+
+        self._tune_shift = None
+        self._tune_sum[:] = 0
+        self._tune_sum_sq[:] = 0
+        self._tune_count = 0
+
+        if verbose > 1:
+            print "%s: width %s" % (self._id, self.width)
+
+        return bool(np.any((ratio < .8) | (ratio > 1.25)))
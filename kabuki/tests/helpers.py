@@ -0,0 +1,44 @@
+"""Models and data shared by the test modules."""
+
+import kabuki
+from kabuki.hierarchical import Parameter
+import numpy as np
+import pymc as pm
+
+class NormalModel(kabuki.Hierarchical):
+    non_centered = False
+
+    def get_params(self):
+        return [Parameter('mu', lower=-5, upper=5, init=0, non_centered=self.non_centered),
+                Parameter('like', is_bottom_node=True)]
+
+    def get_bottom_node(self, param, params):
+        return pm.Normal(param.full_name, mu=params['mu'], tau=1,
+                         value=param.data['score'], observed=True)
+
+def gen_data(subjs=3, pts_per_subj=20, conds=None, subj_offset=0):
+    """Generate normally distributed scores.
+
+    :Arguments:
+        subjs : int or list
+            Number of subjects or their subj_idx values.
+        pts_per_subj : int
+            Data points per subject, split evenly across conds.
+
+    :Optional:
+        conds : list
+            Values of an additional 'cond' column.
+        subj_offset : float
+            Each subject's mean score is subj_offset * subj_idx.
+    """
+    if np.isscalar(subjs):
+        subjs = np.arange(subjs)
+    dtype = [('subj_idx', np.int), ('score', np.float)]
+    if conds is not None:
+        dtype.insert(1, ('cond', 'S1'))
+    data = np.empty(len(subjs)*pts_per_subj, dtype=dtype)
+    data['subj_idx'] = np.repeat(subjs, pts_per_subj)
+    if conds is not None:
+        data['cond'] = np.tile(np.repeat(conds, pts_per_subj // len(conds)), len(subjs))
+    data['score'] = np.random.randn(len(data)) + subj_offset * data['subj_idx']
+    return data
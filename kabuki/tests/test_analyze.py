@@ -0,0 +1,82 @@
+import kabuki
+import numpy as np
+import unittest
+import pymc as pm
+
+from helpers import NormalModel, gen_data
+
+class TestSummary(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(31337)
+        cls.model = NormalModel(gen_data())
+        cls.model.mcmc()
+        cls.model.sample(550, burn=50, progress_bar=False)
+
+    def test_trace_stats(self):
+        traces = np.random.randn(1005, 4)
+        stats = kabuki.analyze.trace_stats(traces)
+        self.assertEqual(stats.keys(), ['mean', 'std', '2.5q', '25q', '50q', '75q', '97.5q', 'mc_err'])
+        for i in range(4):
+            self.assertAlmostEqual(stats['mean'][i], np.mean(traces[:, i]))
+            self.assertAlmostEqual(stats['25q'][i], np.percentile(traces[:, i], 25))
+            self.assertAlmostEqual(stats['mc_err'][i], pm.database.base.batchsd(traces[:, i], 100))
+
+    def test_trace_stats_short(self):
+        traces = np.random.randn(50, 3)
+        stats = kabuki.analyze.trace_stats(traces)
+        self.assertAlmostEqual(stats['mc_err'][0], pm.database.base.batchsd(traces[:, 0], 50))
+        stats = kabuki.analyze.trace_stats(traces[:1])
+        self.assertTrue(np.all(np.isnan(stats['mc_err'])))
+        self.assertEqual(stats['mean'][2], traces[0, 2])
+
+    def test_summary(self):
+        summary = self.model.summary()
+        self.assertEqual(summary.index.names, ['param', 'tag', 'subj'])
+        self.assertEqual(list(summary.index), [('mu', '', -1), ('mu_var', '', -1),
+                                               ('mu', '', 0), ('mu', '', 1), ('mu', '', 2)])
+
+        stats = self.model.mc.stats()
+        for node, mean, std, q50, mc_err in summary[['node', 'mean', 'std', '50q', 'mc_err']].values:
+            self.assertAlmostEqual(mean, stats[node]['mean'])
+            self.assertAlmostEqual(std, stats[node]['standard deviation'])
+            self.assertAlmostEqual(mc_err, stats[node]['mc error'])
+            self.assertAlmostEqual(q50, np.median(self.model.mc.trace(node)[:]))
+
+        self.assertEqual(len(self.model.summary(start=100)), 5)
+        self.assertAlmostEqual(self.model.summary(start=100)['mean'][0],
+                               np.mean(self.model.nodes['mu_group'].trace()[100:]))
+
+    def test_gen_stats(self):
+        summary = self.model.summary()
+        lines = kabuki.analyze.gen_stats(summary).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].startswith('mu'))
+        self.assertEqual(len(kabuki.analyze.gen_group_stats(summary).splitlines()), 3)
+
+        # Output of MCMC.stats() is still supported
+        stats = self.model.mc.stats()
+        self.assertEqual(len(kabuki.analyze.gen_stats(stats).splitlines()), 6)
+        self.assertEqual(len(kabuki.analyze.gen_group_stats(stats).splitlines()), 3)
+
+    def test_short_run(self):
+        model = NormalModel(gen_data())
+        model.sample(150, burn=100, progress_bar=False)
+        self.assertEqual(len(model.summary()), 5)
+        self.assertEqual(len(kabuki.analyze.gen_stats(model.summary()).splitlines()), 6)
+
+    def test_non_centered(self):
+        class NonCentered(NormalModel):
+            non_centered = True
+        model = NonCentered(gen_data())
+        model.sample(200, burn=100, progress_bar=False)
+        summary = model.summary()
+        self.assertEqual(list(summary.index), [('mu', '', -1), ('mu_var', '', -1),
+                                               ('mu', '', 0), ('mu', '', 1), ('mu', '', 2),
+                                               ('mu_offset', '', 0), ('mu_offset', '', 1), ('mu_offset', '', 2)])
+        # Subj nodes are deterministic
+        self.assertAlmostEqual(summary['mean']['mu', '', 1], np.mean(model.mc.trace('mu1')[:]))
+        self.assertEqual(len(kabuki.analyze.gen_stats(summary).splitlines()), 9)
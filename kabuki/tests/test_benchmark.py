@@ -0,0 +1,92 @@
+import kabuki
+from kabuki import benchmark
+import numpy as np
+import unittest
+import subprocess
+import sys
+
+class TestBenchmark(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_effective_sample_size(self):
+        self.assertAlmostEqual(benchmark.effective_sample_size(np.random.randn(10000)) / 10000, 1, 1)
+        # AR(1) process: ESS = n (1 - rho) / (1 + rho)
+        rho = .9
+        x = np.empty(50000)
+        x[0] = 0
+        noise = np.random.randn(len(x))
+        for i in range(1, len(x)):
+            x[i] = rho * x[i-1] + noise[i]
+        ess = benchmark.effective_sample_size(x)
+        self.assertAlmostEqual(ess / (len(x) * (1 - rho) / (1 + rho)), 1, 0)
+
+    def test_recovery(self):
+        results = benchmark.recovery(models=('normal', 'qlearn'), subjs=(4,), trials=(30,), conditions=(1, 2),
+                                     samples=200, burn=50, isolate=False, verbose=0)
+        # qlearn has no conditions
+        self.assertEqual(len(results), 3)
+        for result in results:
+            for key in ('build_time', 'map_time', 'sample_time', 'ess_per_sec', 'peak_memory'):
+                self.assertGreater(result[key], 0)
+        self.assertLess(results[1]['map_rmse_loc'], 1)
+        self.assertIn('sample_rmse_lrate', results[2])
+
+    def test_compare(self):
+        old = [{'model': 'normal', 'subjs': 5, 'map_time': 1., 'ess_per_sec': 10., 'map_rmse_loc': .1}]
+        new = [{'model': 'normal', 'subjs': 5, 'map_time': 2., 'ess_per_sec': 11., 'map_rmse_loc': .1},
+               {'model': 'normal', 'subjs': 10, 'map_time': 2.}]
+        regressions = benchmark.compare(old, new)
+        self.assertEqual(len(regressions), 1)
+        self.assertEqual(regressions[0][1:], ('map_time', 1., 2.))
+
+    def test_construction(self):
+        results = benchmark.construction(subjs=(3,), conditions=(1, 2), params=(2,), trials=(5,),
+                                         samples=20, isolate=False, verbose=0)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            for key in ('create_nodes_time', 'mcmc_time', 'sample_time', 'load_db_time',
+                        'load_db_lazy_time', 'peak_memory'):
+                self.assertGreater(result[key], 0)
+        # 2 params x (group, var, 3 subjs) per condition
+        self.assertEqual(results[0]['stochastics'], 10)
+        self.assertEqual(results[1]['stochastics'], 20)
+        self.assertEqual(results[1]['observed'], 6)
+
+    def test_isolated(self):
+        # Raise the peak memory of this process
+        ballast = np.ones(2**24)
+        results = benchmark.construction(subjs=(3,), conditions=(1,), params=(1,), trials=(5,),
+                                         samples=20, verbose=0)
+        self.assertEqual(results[0]['stochastics'], 5)
+        # Measured in a fresh interpreter, not inherited from this one
+        self.assertLess(results[0]['peak_memory'], benchmark._peak_memory())
+        del ballast
+
+    def test_no_map(self):
+        results = benchmark.main(['recovery', '--models', 'normal', '--subjs', '2', '--trials', '5',
+                                  '--conditions', '1', '--samples', '0', '--no-map'])
+        self.assertIsNone(results[0]['map_method'])
+        self.assertNotIn('map_time', results[0])
+
+    def test_compare_construction(self):
+        old = [{'subjs': 5, 'params': 1, 'create_nodes_time': 1., 'nodes': 10}]
+        new = [{'subjs': 5, 'params': 1, 'create_nodes_time': 1., 'nodes': 20}]
+        regressions = benchmark.compare(old, new, benchmark='construction')
+        self.assertEqual([r[1] for r in regressions], ['nodes'])
+
+    def test_startup(self):
+        results = benchmark.startup(repeat=1, verbose=0)
+        self.assertEqual(results[0]['module'], 'kabuki')
+        self.assertGreater(results[0]['import_time'], 0)
+        # Plotting, pandas and IPython are only imported when needed
+        self.assertEqual(results[0]['heavy_imports'], 0, results[0]['heavy_modules'])
+
+    def test_lazy_imports(self):
+        script = ('import sys, kabuki; print "kabuki.laplace" in sys.modules; '
+                  'kabuki.laplace.Laplace; print "kabuki.laplace" in sys.modules')
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.split(), ['False', 'True'])
@@ -0,0 +1,144 @@
+import kabuki
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+import cPickle as pickle
+
+from helpers import NormalModel, gen_data
+
+class Preempted(Exception):
+    pass
+
+def preempt_at(mc, iteration):
+    """Make the sampler crash at iteration."""
+    mc.assign_step_methods()
+    sm = list(mc.step_methods)[0]
+    step = sm.step
+    def crashing_step():
+        if mc._current_iter == iteration:
+            raise Preempted()
+        step()
+    sm.step = crashing_step
+
+class TestCheckpoint(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_data()
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, 'fit.ckpt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_preempted(self, **mcmc_kwargs):
+        model = NormalModel(self.data)
+        model.mcmc(**mcmc_kwargs)
+        preempt_at(model.mc, 250)
+        self.assertRaises(Preempted, model.sample, 400, burn=100, checkpoint=self.fname,
+                          checkpoint_interval=100, progress_bar=False)
+        return model
+
+    def test_checkpoint_state(self):
+        model = self.run_preempted()
+        state = kabuki.checkpoint.load(self.fname)
+        # Last checkpoint was written after iteration 200
+        self.assertEqual(state['sampler']['_current_iter'], 201)
+        self.assertEqual(state['trace_length'], 101)
+        self.assertEqual(len(state['traces']['mu']), 101)
+        for sm in model.mc.step_methods:
+            self.assertIn(kabuki.checkpoint.step_method_key(sm), state['step_methods'])
+
+    def test_resume_ram(self):
+        model = self.run_preempted()
+        traces = model.mc.trace('mu')[:101]
+
+        resumed = NormalModel(self.data)
+        resumed.resume(self.fname)
+        self.assertEqual(resumed.mc._current_iter, 400)
+        trace = resumed.mc.trace('mu')[:]
+        self.assertEqual(len(trace), 300)
+        np.testing.assert_array_equal(trace[:101], traces)
+        # Finished state gets checkpointed as well
+        self.assertEqual(kabuki.checkpoint.load(self.fname)['sampler']['_current_iter'], 400)
+
+    def test_resume_chunked(self):
+        dbname = os.path.join(self.tmpdir, 'traces')
+        model = self.run_preempted(db=kabuki.database, dbname=dbname, chunk_size=32)
+        traces = model.mc.trace('mu')[:101]
+
+        resumed = NormalModel(self.data)
+        resumed.resume(self.fname, db=kabuki.database, dbname=dbname)
+        self.assertEqual(resumed.mc.db.chains, 1)
+        trace = resumed.mc.trace('mu')[:]
+        self.assertEqual(len(trace), 300)
+        np.testing.assert_array_equal(trace[:101], traces)
+
+        loaded = NormalModel(self.data)
+        loaded.load_db(dbname)
+        np.testing.assert_array_equal(loaded.nodes['mu_group'].trace(), trace)
+
+    def test_trace_tails(self):
+        self.run_preempted()
+        # Each checkpoint appends only the samples tallied since the last one
+        lengths = []
+        with open(self.fname + '.traces', 'rb') as fd:
+            while True:
+                try:
+                    start, traces = pickle.load(fd)
+                except EOFError:
+                    break
+                lengths.append((start, len(traces['mu'])))
+        self.assertEqual(lengths, [(0, 1), (1, 100)])
+
+    def test_resume_other_sampler(self):
+        self.run_preempted()
+        resumed = NormalModel(self.data)
+        resumed.mcmc()
+        mc = resumed.mc
+        # Arguments create a new sampler
+        resumed.resume(self.fname, db='ram')
+        self.assertIsNot(resumed.mc, mc)
+        self.assertEqual(len(resumed.mc.trace('mu')[:]), 300)
+
+    def test_resume_tuning(self):
+        def sample(model, **kwargs):
+            model.sample(600, burn=400, tune_proposals=True, tune_interval=100, progress_bar=False,
+                         checkpoint=self.fname, checkpoint_interval=99, **kwargs)
+
+        model = NormalModel(self.data)
+        sample(model)
+        n_tuned = model.mc._tuning_scheduler.n_tuned
+
+        model = NormalModel(self.data)
+        model.mcmc()
+        preempt_at(model.mc, 150)
+        self.assertRaises(Preempted, sample, model)
+        state = kabuki.checkpoint.load(self.fname)
+        # Written after iteration 99 and the tuning of iteration 100
+        self.assertEqual(state['sampler']['_current_iter'], 100)
+        self.assertEqual(state['tuning_scheduler']['n_tuned'], 1)
+
+        resumed = NormalModel(self.data)
+        resumed.resume(self.fname)
+        scheduler = resumed.mc._tuning_scheduler
+        # Iteration 100 is not tuned twice
+        self.assertEqual(scheduler.n_tuned, n_tuned)
+        self.assertEqual(resumed.proposal_scales, scheduler.get_scales())
+        self.assertEqual(len(resumed.mc.trace('mu')[:]), 200)
+
+    def test_rng_restored(self):
+        model = self.run_preempted()
+        state = kabuki.checkpoint.load(self.fname)
+        np.random.seed(1)
+        resumed = NormalModel(self.data)
+        resumed.mcmc()
+        kabuki.checkpoint.restore(resumed.mc, self.fname)
+        np.random.set_state(state['rng'])
+        expected = np.random.rand()
+        kabuki.checkpoint.restore(resumed.mc, self.fname)
+        self.assertEqual(np.random.rand(), expected)
@@ -0,0 +1,117 @@
+import kabuki
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import os
+
+from helpers import NormalModel, gen_data
+
+class TestDatabase(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_data()
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmpdir, 'traces')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def sample_and_compare(self, **db_kwargs):
+        model = NormalModel(self.data)
+        model.mcmc(db=kabuki.database, dbname=self.dbname, **db_kwargs)
+        model.sample(250, burn=50, progress_bar=False)
+        model.mc.db.close()
+
+        traces = dict((node.__name__, model.mc.trace(node.__name__)[:]) for node in model.mc.stochastics)
+
+        # Load and compare traces
+        loaded = NormalModel(self.data)
+        loaded.load_db(self.dbname)
+        self.assertIsInstance(loaded.mc.db, kabuki.database.Database)
+        for node in loaded.mc.stochastics:
+            trace = loaded.mc.trace(node.__name__)
+            self.assertEqual(trace.length(), 200)
+            np.testing.assert_array_equal(trace[:], traces[node.__name__])
+            np.testing.assert_array_equal(trace[123], traces[node.__name__][123])
+            np.testing.assert_array_equal(node.trace()[10:20], traces[node.__name__][10:20])
+
+        return model, loaded
+
+    def test_per_node(self):
+        self.sample_and_compare(chunk_size=64)
+
+    def test_blocked(self):
+        model, loaded = self.sample_and_compare(chunk_size=64, block_size=2)
+        self.assertLess(len(loaded.mc.db._blocks), len(loaded.mc.db._columns))
+
+    def test_compressed(self):
+        self.sample_and_compare(chunk_size=64, compress=True, block_size=10)
+
+    def test_append_chain(self):
+        model, loaded = self.sample_and_compare(chunk_size=64)
+        loaded.sample(100, progress_bar=False)
+        self.assertEqual(loaded.mc.db.chains, 2)
+        self.assertEqual(loaded.mc.trace('mu')(chain=None).shape[0], 300)
+
+    def test_truncate(self):
+        for compress in (False, True):
+            dbname = os.path.join(self.tmpdir, 'truncated%i' % compress)
+            model = NormalModel(self.data)
+            model.mcmc(db=kabuki.database, dbname=dbname, chunk_size=64, compress=compress)
+            model.sample(250, burn=50, progress_bar=False)
+            db = model.mc.db
+            trace = model.mc.trace('mu')[:]
+            db.truncate(100)
+            db.close()
+            if compress:
+                # Chunks of 64 and 36 samples are left
+                self.assertEqual(db._chunks[0], [64, 36])
+                self.assertFalse(os.path.exists(db._block_fname(0, 0, 2)))
+            else:
+                self.assertEqual(os.path.getsize(db._block_fname(0, 0)), 100 * 8)
+
+            loaded = kabuki.database.load(dbname)
+            self.assertEqual(loaded.trace('mu').length(), 100)
+            np.testing.assert_array_equal(loaded.trace('mu')[:], trace[:100])
+
+    def test_memmap(self):
+        model, loaded = self.sample_and_compare()
+        self.assertIsInstance(loaded.mc.db._read_block(0, 0), np.memmap)
+
+    def test_lazy_traces(self):
+        self.sample_and_compare(chunk_size=64)
+        loaded = NormalModel(self.data)
+        loaded.load_db(self.dbname, lazy=True)
+        node = loaded.nodes['mu_group']
+        self.assertIsInstance(node.trace, kabuki.database.LazyTrace)
+        # Nothing is read before the trace is touched
+        self.assertEqual(len(loaded.trace_cache), 0)
+        np.testing.assert_array_equal(node.trace()[5:10], node.trace[5:10])
+        self.assertEqual(len(node.trace), 200)
+
+        # Opt-in only
+        loaded = NormalModel(self.data)
+        loaded.load_db(self.dbname)
+        self.assertNotIsInstance(loaded.nodes['mu_group'].trace, kabuki.database.LazyTrace)
+
+    def test_trace_cache_bounded(self):
+        cache = kabuki.database.TraceCache(max_bytes=2*8*100)
+        for i in range(5):
+            cache.get(i, lambda: np.zeros(100))
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        # Most recently used entries survive
+        self.assertEqual(cache._arrays.keys(), [3, 4])
+
+    def test_group_only(self):
+        model, loaded = self.sample_and_compare(chunk_size=64)
+        group = NormalModel(self.data)
+        group.load_db(self.dbname, group_only=True)
+        self.assertNotIn('mu', group.subj_nodes)
+        self.assertEqual(len(group.bottom_nodes), 0)
+        np.testing.assert_array_equal(group.nodes['mu_group'].trace(),
+                                      loaded.nodes['mu_group'].trace())
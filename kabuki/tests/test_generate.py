@@ -119,3 +119,44 @@ class TestGenerate(unittest.TestCase):
         data, params_subjs = gen_rand_data(normal_like, params, samples=samples, subjs=subjs, exclude_params=('scale',), column_name='test')
 
         self.assertIn('test', data.dtype.names)
+
+    def test_vectorized(self):
+        params = OrderedDict([('cond1', {'loc': 0, 'scale': 1e-6}), ('cond2', {'loc': 100, 'scale': 1e-6})])
+        subjs = 50
+        samples = 10
+
+        np.random.seed(31337)
+        data, subj_params = gen_rand_data(normal_like, params, samples=samples, subjs=subjs,
+                                          exclude_params=('scale',), vectorized=True, chunk_subjs=20)
+
+        np.testing.assert_array_equal(data['subj_idx'], np.repeat(np.arange(subjs), 2*samples))
+        np.testing.assert_array_equal(data['condition'], np.tile(np.repeat(['cond1', 'cond2'], samples), subjs))
+        self.assertEqual(len(subj_params['cond2']), subjs)
+        self.assertEqual(subj_params['cond2'][0]['scale'], 1e-6)
+
+        # Samples of each subject follow its parameters
+        for i in range(subjs):
+            for condition in params.iterkeys():
+                idx = (data['subj_idx'] == i) & (data['condition'] == condition)
+                np.testing.assert_array_almost_equal(data['data'][idx], subj_params[condition][i]['loc'], 4)
+
+        # Parameters vary between subjects
+        self.assertAlmostEqual(np.std([p['loc'] for p in subj_params['cond2']]), .1, 1)
+
+    def test_memmap(self):
+        import tempfile, os
+        params = {'loc': 0, 'scale': 1}
+        fd, fname = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            data, subj_params = gen_rand_data(normal_like, params, samples=20, subjs=30,
+                                              filename=fname, chunk_subjs=7)
+            self.assertIsInstance(data, np.memmap)
+            del data
+            loaded = np.load(fname, mmap_mode='r')
+            self.assertEqual(len(loaded), 600)
+            np.testing.assert_array_equal(loaded['subj_idx'], np.repeat(np.arange(30), 20))
+            self.assertEqual(len(subj_params), 30)
+            self.assertAlmostEqual(np.mean(loaded['data']), 0, 0)
+        finally:
+            os.remove(fname)
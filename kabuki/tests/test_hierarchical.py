@@ -4,6 +4,8 @@ import numpy as np
 import unittest
 import pymc as pm
 
+from helpers import NormalModel, gen_data
+
 def class_factory(num_params=1, create_group_node=True, create_subj_nodes=True):
     params_local = []
     for i_param in range(num_params):
@@ -164,3 +166,132 @@ class TestHierarchical(unittest.TestCase):
 
 #     def testEstimates(self):
 #         pass
+
+
+def gen_normal_data(subjs):
+    return gen_data(subjs, conds=['a', 'b'], subj_offset=1)
+
+class TestWarmStart(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_normal_data(subjs=[0, 1, 2])
+        self.pre_model = NormalModel(self.data)
+        self.pre_model.sample(200, burn=100, progress_bar=False)
+
+    def test_same_model(self):
+        model = NormalModel(self.data)
+        model.init_from_existing_model(self.pre_model, step_method=True)
+        pre_nodes = dict((node.__name__, node) for node in self.pre_model.mc.stochastics)
+        for node in model.mc.stochastics:
+            pre_node = pre_nodes[node.__name__]
+            np.testing.assert_array_equal(node.value, pre_node.value)
+            pre_sm = self.pre_model.mc.step_method_dict[pre_node][0]
+            sm = model.mc.step_method_dict[node][0]
+            self.assertIs(type(sm), type(pre_sm))
+            np.testing.assert_array_equal(sm.adaptive_scale_factor, pre_sm.adaptive_scale_factor)
+            np.testing.assert_array_equal(sm.proposal_sd, pre_sm.proposal_sd)
+            self.assertEqual(sm.accepted, pre_sm.accepted)
+
+    def test_subjs_matched_by_idx(self):
+        # Subject 0 is dropped, subject 5 is new
+        model = NormalModel(gen_normal_data(subjs=[1, 2, 5]))
+        model.init_from_existing_model(self.pre_model, step_method=False)
+        pre_subj_nodes = self.pre_model.subj_nodes['mu']
+        subj_nodes = model.subj_nodes['mu']
+        self.assertEqual(subj_nodes[0].value, pre_subj_nodes[1].value)
+        self.assertEqual(subj_nodes[1].value, pre_subj_nodes[2].value)
+        self.assertEqual(subj_nodes[2].value, model.group_nodes['mu'].value)
+
+    def test_new_conditions(self):
+        model = NormalModel(self.data, depends_on={'mu': ['cond']})
+        model.init_from_existing_model(self.pre_model, step_method=False)
+        for cond in ("('a',)", "('b',)"):
+            self.assertEqual(model.group_nodes['mu'+cond].value, self.pre_model.group_nodes['mu'].value)
+            self.assertEqual(model.var_nodes['mu'+cond].value, self.pre_model.var_nodes['mu'].value)
+            for i in range(3):
+                self.assertEqual(model.subj_nodes['mu'+cond][i].value,
+                                 self.pre_model.subj_nodes['mu'][i].value)
+
+class TestBlockedStepMethods(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_normal_data(subjs=[0, 1, 2])
+
+    def test_blocks(self):
+        model = NormalModel(self.data, depends_on={'mu': ['cond']})
+        model.mcmc(blocked=True)
+        model.mc.assign_step_methods()
+        blocked = [sm for sm in model.mc.step_methods if isinstance(sm, pm.AdaptiveMetropolis)]
+        # One block per subject and one per group/var pair
+        self.assertEqual(len(blocked), 3 + 2)
+        for i in range(3):
+            block = set(nodes[i] for nodes in model.subj_nodes.itervalues())
+            self.assertIn(block, [sm.stochastics for sm in blocked])
+        # Every stochastic is updated by exactly one step method
+        for node in model.mc.stochastics:
+            self.assertEqual(len(model.mc.step_method_dict[node]), 1)
+
+    def test_sample(self):
+        model = NormalModel(self.data, depends_on={'mu': ['cond']})
+        model.mcmc(blocked=True)
+        model.sample(200, burn=100, progress_bar=False)
+        self.assertEqual(len(model.mc.trace(model.subj_nodes.values()[0][0].__name__)[:]), 100)
+
+class NonCenteredModel(NormalModel):
+    non_centered = True
+
+class TestNonCentered(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_normal_data(subjs=[0, 1, 2])
+
+    def test_nodes(self):
+        model = NonCenteredModel(self.data)
+        model.create_nodes()
+        self.assertIn('mu_offset', model.nodes)
+        for i in range(3):
+            subj_node = model.subj_nodes['mu'][i]
+            offset = model.offset_nodes['mu'][i]
+            self.assertIsInstance(subj_node, pm.Deterministic)
+            self.assertEqual(offset.__name__, 'muoffset%i' % i)
+            offset.value = 1.5
+            self.assertAlmostEqual(subj_node.value, model.group_nodes['mu'].value + 1.5 * model.var_nodes['mu'].value)
+            self.assertIs(model.bottom_nodes['like'][i].parents['mu'], subj_node)
+
+    def test_sample(self):
+        model = NonCenteredModel(self.data)
+        model.mcmc(blocked=True)
+        model.sample(200, burn=100, progress_bar=False)
+        self.assertIn('mu0', model.stats())
+        self.assertEqual(len(model.mc.trace('mu0')[:]), 100)
+        blocked = [sm for sm in model.mc.step_methods if isinstance(sm, pm.AdaptiveMetropolis)]
+        self.assertEqual(len(blocked), 1)
+
+    def test_subj_by_subj_map_init(self):
+        model = NonCenteredModel(self.data)
+        model.subj_by_subj_map_init(runs=1)
+        for i, subj in enumerate([0, 1, 2]):
+            score = self.data['score'][self.data['subj_idx'] == subj]
+            self.assertAlmostEqual(model.subj_nodes['mu'][i].value, np.mean(score), 2)
+
+    def test_warm_start_offsets(self):
+        pre_model = NonCenteredModel(self.data)
+        pre_model.sample(200, burn=100, progress_bar=False)
+        # Subject 0 is dropped, subject 5 is new
+        model = NonCenteredModel(gen_normal_data(subjs=[1, 2, 5]))
+        model.init_from_existing_model(pre_model, step_method=False)
+        pre_offsets = pre_model.offset_nodes['mu']
+        offsets = model.offset_nodes['mu']
+        self.assertEqual(offsets[0].value, pre_offsets[1].value)
+        self.assertEqual(offsets[1].value, pre_offsets[2].value)
+        self.assertEqual(offsets[2].value, 0)
+        self.assertAlmostEqual(model.subj_nodes['mu'][2].value, model.group_nodes['mu'].value)
@@ -0,0 +1,114 @@
+import kabuki
+import numpy as np
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import socket
+import subprocess
+
+from helpers import NormalModel, gen_data
+
+class TestJobs(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.tmpdir = tempfile.mkdtemp()
+        data = gen_data(conds=['a', 'b'])
+        self.data_fname = os.path.join(self.tmpdir, 'data.csv')
+        kabuki.utils.save_csv(data, self.data_fname)
+        self.out_dir = os.path.join(self.tmpdir, 'fits')
+
+        self.specs = [{'model': NormalModel, 'data': self.data_fname, 'depends_on': depends_on,
+                       'seed': seed, 'sample': {'iter': 200, 'burn': 100}}
+                      for depends_on in ({}, {'mu': 'cond'}) for seed in (1, 2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_job_name(self):
+        names = [kabuki.jobs.job_name(spec) for spec in self.specs]
+        self.assertEqual(len(set(names)), 4)
+        self.assertTrue(names[0].startswith('NormalModel-'))
+        # Classes and their paths give the same name
+        spec = dict(self.specs[0], model=NormalModel.__module__ + '.NormalModel')
+        self.assertEqual(kabuki.jobs.job_name(spec), names[0])
+        self.assertEqual(kabuki.jobs.job_name(dict(spec, name='fit')), names[0])
+
+    def test_run(self):
+        results = kabuki.jobs.run(self.specs, self.out_dir, processes=2)
+        self.assertEqual([result['status'] for result in results], ['done'] * 4)
+
+        job_dir = os.path.join(self.out_dir, results[2]['name'])
+        self.assertEqual(sorted(os.listdir(job_dir)),
+                         ['lock', 'log.txt', 'progress.json', 'result.json', 'spec.json', 'traces'])
+        with open(os.path.join(job_dir, 'progress.json')) as fd:
+            progress = json.load(fd)
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual(progress['iteration'], 200)
+        self.assertEqual(set(stats['param'] for stats in results[2]['stats']), set(['mu', 'mu_var']))
+        self.assertEqual(set(stats['tag'] for stats in results[2]['stats']), set(["('a',)", "('b',)"]))
+
+        # Same seed, same samples
+        model = NormalModel(kabuki.utils.load_csv(self.data_fname))
+        model.load_db(os.path.join(self.out_dir, results[0]['name'], 'traces'))
+        self.assertAlmostEqual(model.summary()['mean'][0], results[0]['stats'][0]['mean'])
+
+        # Finished jobs are skipped
+        results = kabuki.jobs.run(self.specs[:2], self.out_dir, processes=1)
+        self.assertEqual([result['status'] for result in results], ['skipped'] * 2)
+
+    def test_queue(self):
+        names = kabuki.jobs.submit(self.specs, self.out_dir)
+        self.assertEqual(kabuki.jobs.status(self.out_dir), dict((name, 'queued') for name in names))
+
+        results = kabuki.jobs.work(self.out_dir, max_jobs=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(kabuki.jobs.status(self.out_dir)[results[0]['name']], 'done')
+
+        # Claimed jobs are left to their worker
+        queued = [name for name, state in kabuki.jobs.status(self.out_dir).iteritems() if state == 'queued']
+        os.close(os.open(os.path.join(self.out_dir, queued[0], 'lock'), os.O_CREAT))
+        results = kabuki.jobs.work(self.out_dir, processes=2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(kabuki.jobs.status(self.out_dir).values()), ['claimed', 'done', 'done', 'done'])
+
+    def test_spec_mismatch(self):
+        names = kabuki.jobs.submit(self.specs, self.out_dir)
+        # Same specs again
+        self.assertEqual(kabuki.jobs.submit(self.specs, self.out_dir), names)
+        spec = dict(self.specs[0], name=names[0], seed=5)
+        self.assertRaises(ValueError, kabuki.jobs.submit, [spec], self.out_dir)
+        self.assertRaises(ValueError, kabuki.jobs.run_job, spec, self.out_dir)
+        self.assertRaises(ValueError, kabuki.jobs.run, [spec], self.out_dir, processes=1)
+        with open(os.path.join(self.out_dir, names[0], 'spec.json')) as fd:
+            self.assertEqual(json.load(fd)['seed'], 1)
+
+    def test_stale_lock(self):
+        names = kabuki.jobs.submit(self.specs[:2], self.out_dir)
+        # Worker that died while sampling
+        worker = subprocess.Popen(['true'])
+        worker.wait()
+        for name, host in zip(names, [socket.gethostname(), 'otherhost']):
+            job_dir = os.path.join(self.out_dir, name)
+            with open(os.path.join(job_dir, 'lock'), 'w') as fd:
+                fd.write('%s %i\n' % (host, worker.pid))
+            with open(os.path.join(job_dir, 'progress.json'), 'w') as fd:
+                json.dump({'status': 'sampling'}, fd)
+        states = kabuki.jobs.status(self.out_dir)
+        self.assertEqual(states[names[0]], 'stale')
+        # Processes of other hosts can not be checked
+        self.assertEqual(states[names[1]], 'sampling')
+
+    def test_failed(self):
+        spec = dict(self.specs[0], data=os.path.join(self.tmpdir, 'missing.csv'))
+        result = kabuki.jobs.run_job(spec, self.out_dir)
+        self.assertEqual(result['status'], 'failed')
+        with open(os.path.join(self.out_dir, result['name'], 'log.txt')) as fd:
+            self.assertIn('Traceback', fd.read())
+        self.assertEqual(kabuki.jobs.status(self.out_dir)[result['name']], 'failed')
+        # Failed jobs stay locked
+        self.assertEqual(kabuki.jobs.run_job(spec, self.out_dir), None)
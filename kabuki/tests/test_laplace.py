@@ -0,0 +1,91 @@
+import kabuki
+from kabuki.laplace import Laplace
+import numpy as np
+import unittest
+import pymc as pm
+import scipy.sparse as sp
+
+from helpers import NormalModel, gen_data
+
+class TestLaplace(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_conjugate(self):
+        data = np.random.randn(50) + 1
+        mu = pm.Normal('mu', mu=0, tau=.01, value=0)
+        x = pm.Normal('x', mu=mu, tau=1, value=data, observed=True)
+        laplace = Laplace([mu, x])
+        laplace.fit()
+        post_tau = .01 + len(data)
+        self.assertAlmostEqual(laplace.mean[0], np.sum(data) / post_tau, 4)
+        self.assertAlmostEqual(laplace.covariance()[0, 0], 1 / post_tau, 4)
+
+    def test_sparse_hessian(self):
+        model = NormalModel(gen_data(10, subj_offset=.5))
+        model.create_nodes()
+        laplace = Laplace(model.nodes, bounds=model._get_node_bounds())
+        y = laplace.to_unconstrained(laplace.get_values()) + np.random.randn(laplace.len) * .3
+        H = laplace.hessian(y).toarray()
+        # Subjects are perturbed jointly
+        self.assertLess(laplace.n_gradients, 2 * laplace.len)
+        # Compare with dense finite differences
+        h = laplace.h
+        for i in range(laplace.len):
+            dy = np.zeros(laplace.len)
+            dy[i] = h
+            column = (laplace.gradfunc(y + dy) - laplace.gradfunc(y - dy)) / (2 * h)
+            np.testing.assert_array_almost_equal(H[:, i], column, 3)
+        # Parameters of different subjects are independent
+        subj_nodes = model.subj_nodes['mu']
+        self.assertEqual(H[laplace._slices[subj_nodes[0]], laplace._slices[subj_nodes[1]]], 0)
+
+    def test_fit_laplace(self):
+        model = NormalModel(gen_data(5, subj_offset=.5))
+        laplace = model.fit_laplace(samples=200)
+        self.assertIsNone(model.mc)
+        self.assertEqual(len(model.approx_mc.trace('mu')[:]), 200)
+        self.assertIn('mu', model.approx_mc.stats())
+        var_trace = model.approx_mc.trace(model.var_nodes['mu'].__name__)[:]
+        self.assertTrue(np.all((var_trace > 1e-3) & (var_trace < 10)))
+        summary = model.summary(mc=model.approx_mc)
+        self.assertEqual(len(summary), 7)
+        self.assertAlmostEqual(summary['mean']['mu_var', '', -1], np.mean(var_trace))
+        self.assertAlmostEqual(model.stats(mc=model.approx_mc)['mu']['mean'], summary['mean']['mu', '', -1])
+        # Nodes are set to the mode
+        np.testing.assert_array_almost_equal(laplace.get_values(),
+                                             laplace.to_constrained(laplace.mean))
+
+    def test_sparse_covariance(self):
+        model = NormalModel(gen_data(10, subj_offset=.5))
+        model.create_nodes()
+        laplace = Laplace(model.nodes, bounds=model._get_node_bounds())
+        laplace.fit()
+        self.assertTrue(sp.issparse(laplace.precision))
+        cov = np.linalg.inv(laplace.precision.toarray())
+        b = np.random.randn(laplace.len)
+        np.testing.assert_array_almost_equal(laplace.solve(b), np.dot(cov, b))
+
+        subj_nodes = list(model.subj_nodes['mu'][:2])
+        idx = np.concatenate([np.arange(laplace.len)[laplace._slices[s]] for s in subj_nodes])
+        dx_dy = laplace.jacobian(laplace.mean)[idx]
+        np.testing.assert_array_almost_equal(laplace.covariance(subj_nodes),
+                                             cov[np.ix_(idx, idx)] * np.outer(dx_dy, dx_dy))
+
+        # Draws follow the covariance
+        draws = np.array([laplace.to_unconstrained(laplace.draw()) for i in range(4000)])
+        np.testing.assert_array_almost_equal(np.cov(draws.T), cov, 1)
+
+    def test_proposals(self):
+        model = NormalModel(gen_data(5, subj_offset=.5))
+        laplace = model.fit_laplace(samples=10)
+        model.mcmc(blocked=True, approximation=laplace)
+        group = model.group_nodes['mu']
+        sm = model.mc.step_method_dict[group][0]
+        self.assertIsInstance(sm, pm.AdaptiveMetropolis)
+        cov = laplace.covariance(sorted(sm._slices, key=lambda s: sm._slices[s].start))
+        np.testing.assert_array_almost_equal(sm.C, cov * 2.38**2 / 2)
+        model.sample(200, burn=100, progress_bar=False)
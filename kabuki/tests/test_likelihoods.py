@@ -0,0 +1,184 @@
+import kabuki
+import numpy as np
+import pymc as pm
+import unittest
+import scipy.stats.distributions as sc_dst
+from kabuki.utils import scipy_stochastic
+from kabuki.likelihoods import use_sufficient_stats, use_weighted_logp
+
+class TestSufficientStats(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def assertSameLogp(self, create, parent, values):
+        """Compare logp of node with and without sufficient statistics
+        for parent values.
+        """
+        node, reference = create(), create()
+        self.assertTrue(use_sufficient_stats(node))
+        for value in values:
+            parent.value = value
+            try:
+                expected = reference.logp
+            except pm.ZeroProbability:
+                self.assertRaises(pm.ZeroProbability, lambda: node.logp)
+                continue
+            self.assertAlmostEqual(node.logp, expected, 6)
+
+    def test_pymc(self):
+        x = np.random.normal(1, 2, size=100)
+        mu = pm.Uniform('mu', -10, 10, value=0.)
+        tau = pm.Uniform('tau', 0, 10, value=1.)
+        self.assertSameLogp(lambda: pm.Normal('x', mu=mu, tau=tau, value=x, observed=True),
+                            mu, [-1., 0., 1.5])
+        self.assertSameLogp(lambda: pm.Normal('x', mu=mu, tau=tau, value=x, observed=True),
+                            tau, [.1, 2.])
+
+        p = pm.Uniform('p', 0, 1, value=.5)
+        choices = np.random.rand(100) < .3
+        self.assertSameLogp(lambda: pm.Bernoulli('x', p=p, value=choices, observed=True),
+                            p, [.1, .3, .9])
+
+        rate = pm.Uniform('rate', 0, 10, value=1.)
+        counts = np.random.poisson(3, size=50)
+        self.assertSameLogp(lambda: pm.Poisson('x', mu=rate, value=counts, observed=True),
+                            rate, [.5, 3., 7.])
+
+    def test_scipy_stochastic(self):
+        normal_like = scipy_stochastic(sc_dst.norm_gen, name='normal')
+        poisson_like = scipy_stochastic(sc_dst.poisson_gen, name='poisson')
+        binomial_like = scipy_stochastic(sc_dst.binom_gen, name='binomial')
+        loc = pm.Uniform('loc', -10, 10, value=0.)
+        scale = pm.Uniform('scale', -1, 10, value=1.)
+        x = np.random.normal(1, 2, size=100)
+        self.assertSameLogp(lambda: normal_like('x', loc=loc, scale=scale, value=x, observed=True),
+                            scale, [.5, 2., -.5])
+
+        rate = pm.Uniform('rate', 0, 10, value=1.)
+        counts = np.random.poisson(3, size=50)
+        self.assertSameLogp(lambda: poisson_like('x', mu=rate, value=counts, observed=True),
+                            rate, [.5, 3.])
+
+        p = pm.Uniform('p', 0, 1, value=.5)
+        n = np.random.randint(5, 15, size=50)
+        counts = np.random.binomial(n, .3)
+        self.assertSameLogp(lambda: binomial_like('x', n=n, p=p, value=counts, observed=True),
+                            p, [.1, .3, .9])
+
+    def test_unsupported(self):
+        mu = pm.Uniform('mu', -10, 10, value=np.zeros(10))
+        # Array parents
+        self.assertFalse(use_sufficient_stats(pm.Normal('x', mu=mu, tau=1, value=np.zeros(10), observed=True)))
+        # Unobserved nodes and other distributions
+        self.assertFalse(use_sufficient_stats(pm.Normal('x', mu=0, tau=1, value=0.)))
+        self.assertFalse(use_sufficient_stats(pm.Exponential('x', beta=1, value=np.ones(10), observed=True)))
+        # Parents that move the support of the data
+        poisson_like = scipy_stochastic(sc_dst.poisson_gen, name='poisson')
+        loc = pm.DiscreteUniform('loc', -5, 5, value=0)
+        self.assertFalse(use_sufficient_stats(poisson_like('x', mu=3., loc=loc, value=np.ones(10), observed=True)))
+        binomial_like = scipy_stochastic(sc_dst.binom_gen, name='binomial')
+        n = pm.DiscreteUniform('n', 1, 20, value=10)
+        self.assertFalse(use_sufficient_stats(binomial_like('x', n=n, p=.5, value=np.ones(10), observed=True)))
+
+    def test_hierarchical(self):
+        from kabuki.benchmark import NormalModel, normal_like
+        from kabuki.generate import gen_rand_data
+        data, params = gen_rand_data(normal_like, {'loc': 0, 'scale': 1}, samples=50, subjs=5)
+        models = [NormalModel(data), NormalModel(data, sufficient_stats=True)]
+        for model in models:
+            model.create_nodes()
+        for node in models[1].bottom_nodes.itervalues():
+            for subj_node in node:
+                self.assertIsInstance(subj_node._logp_fun, kabuki.likelihoods.SufficientLogp)
+        np.testing.assert_array_equal(models[1].bottom_nodes.values()[0][0].value,
+                                      models[0].bottom_nodes.values()[0][0].value)
+        self.assertAlmostEqual(pm.Model(models[0].nodes).logp, pm.Model(models[1].nodes).logp, 6)
+
+class TestWeightedLogp(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def assertSameLogp(self, create, parent, values):
+        node, reference = create(), create()
+        self.assertTrue(use_weighted_logp(node))
+        for value in values:
+            parent.value = value
+            try:
+                expected = reference.logp
+            except pm.ZeroProbability:
+                self.assertRaises(pm.ZeroProbability, lambda: node.logp)
+                continue
+            self.assertAlmostEqual(node.logp, expected, 6)
+
+    def test_pymc(self):
+        p = pm.Uniform('p', 0, 1, value=.5)
+        choices = np.random.rand(200) < .3
+        self.assertSameLogp(lambda: pm.Bernoulli('x', p=p, value=choices, observed=True),
+                            p, [.1, .3, .9])
+        rate = pm.Uniform('rate', 0, 10, value=1.)
+        counts = np.random.poisson(3, size=200)
+        self.assertSameLogp(lambda: pm.Poisson('x', mu=rate, value=counts, observed=True),
+                            rate, [.5, 3., 7.])
+        mu = pm.Uniform('mu', -10, 10, value=0.)
+        scores = np.round(np.random.normal(0, 2, size=200))
+        self.assertSameLogp(lambda: pm.Normal('x', mu=mu, tau=.5, value=scores, observed=True),
+                            mu, [-1., 2.])
+
+    def test_scipy_stochastic(self):
+        # Fast path and generic scipy path
+        for name in ('poisson', 'nbinom'):
+            dist = scipy_stochastic(getattr(sc_dst, name + '_gen'), name=name)
+            p = pm.Uniform('p', 0, 1, value=.5)
+            counts = np.random.poisson(3, size=200)
+            if name == 'poisson':
+                self.assertSameLogp(lambda: dist('x', mu=3., value=counts, observed=True), p, [.5])
+            else:
+                self.assertSameLogp(lambda: dist('x', n=3, p=p, value=counts, observed=True), p, [.2, .6])
+        hypergeom = scipy_stochastic(sc_dst.hypergeom_gen, name='hypergeom')
+        N = pm.DiscreteUniform('N', 5, 20, value=8)
+        counts = np.random.randint(0, 5, size=200)
+        self.assertSameLogp(lambda: hypergeom('x', M=20, n=N, N=5, value=counts, observed=True), N, [6, 10])
+
+    def test_support(self):
+        # Observed values are checked again when loc or scale move the support
+        expon_like = scipy_stochastic(sc_dst.expon_gen, name='expon')
+        uniform_like = scipy_stochastic(sc_dst.uniform_gen, name='uniform')
+        loc = pm.Uniform('loc', -10, 10, value=0.)
+        scale = pm.Uniform('scale', 0, 10, value=5.)
+        values = np.round(np.random.rand(100) * 4) + 1
+        self.assertSameLogp(lambda: expon_like('x', loc=loc, value=values, observed=True),
+                            loc, [3., .5, 6., 0.])
+        self.assertSameLogp(lambda: uniform_like('x', loc=0., scale=scale, value=values, observed=True),
+                            scale, [3., 6., 4.])
+        node = expon_like('x', loc=loc, value=values, observed=True)
+        use_weighted_logp(node)
+        loc.value = 3.
+        self.assertRaises(pm.ZeroProbability, lambda: node.logp)
+
+    def test_unsupported(self):
+        p = pm.Uniform('p', 0, 1, value=.5 * np.ones(10))
+        # Trial-wise parents and no duplicates
+        self.assertFalse(use_weighted_logp(pm.Bernoulli('x', p=p, value=np.ones(10), observed=True)))
+        self.assertFalse(use_weighted_logp(pm.Normal('x', mu=0, tau=1, value=np.arange(10.), observed=True)))
+
+    def test_hierarchical(self):
+        from kabuki.qlearn import QLearn
+        from kabuki.benchmark import NormalModel, normal_like
+        from kabuki.generate import gen_rand_data
+        data, params = gen_rand_data(normal_like, {'loc': 0, 'scale': 1}, samples=50, subjs=5)
+        data['data'] = np.round(data['data'])
+        models = [NormalModel(data), NormalModel(data, compress=True),
+                  NormalModel(data, compress=True, sufficient_stats=True)]
+        for model in models:
+            model.create_nodes()
+        bottom_node = lambda model: model.bottom_nodes.values()[0][0]
+        self.assertIsInstance(bottom_node(models[1])._logp_fun, kabuki.likelihoods.WeightedLogp)
+        self.assertIsInstance(bottom_node(models[2])._logp_fun, kabuki.likelihoods.SufficientLogp)
+        np.testing.assert_array_equal(bottom_node(models[1]).value, bottom_node(models[0]).value)
+        self.assertAlmostEqual(pm.Model(models[0].nodes).logp, pm.Model(models[1].nodes).logp, 6)
@@ -0,0 +1,78 @@
+import kabuki
+from kabuki.optimize import GradientMAP
+import numpy as np
+import unittest
+import pymc as pm
+
+from helpers import NormalModel, gen_data
+
+class CustomLikeModel(NormalModel):
+    def get_bottom_node(self, param, params):
+        # Likelihood without analytical gradient
+        return pm.Stochastic(logp=lambda value, mu: pm.normal_like(value, mu, 1), doc='',
+                             name=param.full_name, parents={'mu': params['mu']},
+                             value=param.data['score'], observed=True, dtype=float)
+
+class TestGradientMAP(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_data(5, subj_offset=.5)
+
+    def get_map(self):
+        model = NormalModel(self.data)
+        model.create_nodes()
+        return model, GradientMAP(model.nodes, bounds=model._get_node_bounds())
+
+    def test_transforms(self):
+        model, m = self.get_map()
+        self.assertEqual((m.lower[m._slices[model.var_nodes['mu']]][0],
+                          m.upper[m._slices[model.var_nodes['mu']]][0]), (1e-3, 10))
+        x = m.get_values()
+        np.testing.assert_array_almost_equal(m.to_constrained(m.to_unconstrained(x)), x)
+
+    def test_gradient(self):
+        model, m = self.get_map()
+        y = m.to_unconstrained(m.get_values()) + np.random.randn(m.len) * .3
+        grad = m.gradfunc(y)
+        # Compare with finite differences of the complete logp
+        eps = 1e-6
+        for i in range(m.len):
+            dy = np.zeros(m.len)
+            dy[i] = eps
+            numeric = (m.func(y + dy) - m.func(y - dy)) / (2 * eps)
+            self.assertAlmostEqual(grad[i], numeric, 3)
+
+    def test_gradient_fallback(self):
+        model = CustomLikeModel(self.data)
+        model.create_nodes()
+        m = GradientMAP(model.nodes, bounds=model._get_node_bounds())
+        subj_node = model.subj_nodes['mu'][0]
+        self.assertIn(model.bottom_nodes['like'][0], m._blankets[subj_node])
+        # The prior of the group node is still analytical
+        group_node = model.group_nodes['mu']
+        self.assertEqual(m._analytic[group_node], [group_node])
+
+        y = m.to_unconstrained(m.get_values()) + np.random.randn(m.len) * .3
+        grad = m.gradfunc(y)
+        eps = 1e-6
+        for i in range(m.len):
+            dy = np.zeros(m.len)
+            dy[i] = eps
+            numeric = (m.func(y + dy) - m.func(y - dy)) / (2 * eps)
+            self.assertAlmostEqual(grad[i], numeric, 3)
+
+    def test_map(self):
+        model = NormalModel(self.data)
+        gradient_map = model.map(method='gradient', runs=1)
+        logp = gradient_map.logp
+        self.assertTrue(gradient_map.fitted)
+
+        powell_map = NormalModel(self.data).map(runs=1)
+        self.assertGreater(logp, powell_map.logp - .1)
+
+        # Values are written back to the nodes of the model
+        for i, node in enumerate(model.subj_nodes['mu']):
+            self.assertEqual(node.value, gradient_map.get_node(node.__name__).value)
@@ -0,0 +1,165 @@
+import kabuki
+from kabuki import qlearn
+import numpy as np
+import unittest
+import pymc as pm
+
+def reference_choice_probs(data, inv_temp, lrate):
+    """Choice probabilities computed with q_learn() and softmax()."""
+    choice_probs = np.empty(len(data))
+    q_val = .5*np.ones((2,2))
+    for t in range(len(data)):
+        choice_probs[t] = qlearn.softmax(q_val, inv_temp, data['stim'][t], data['action'][t])
+        q_val = qlearn.q_learn(q_val, lrate, data['stim'][t], data['action'][t], data['reward'][t])
+    return choice_probs
+
+class TestChoiceProbs(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = qlearn.qlearn_generate(trials=100, subjs=1)
+
+    def test_create_choice_probs(self):
+        for inv_temp, lrate in [(5., .1), (1., .9), (15., .5)]:
+            np.testing.assert_array_almost_equal(qlearn.create_choice_probs(self.data, inv_temp, lrate),
+                                                 reference_choice_probs(self.data, inv_temp, lrate), 12)
+
+    def test_stable_softmax(self):
+        probs = qlearn.create_choice_probs(self.data, 1e4, .5)
+        self.assertTrue(np.all(np.isfinite(probs)))
+
+    def test_cache(self):
+        choice_probs = qlearn.ChoiceProbs(self.data, cache_size=2)
+        first = choice_probs(inv_temp=5., lrate=.1)
+        np.testing.assert_array_almost_equal(first, reference_choice_probs(self.data, 5., .1))
+        self.assertIs(choice_probs(inv_temp=5., lrate=.1), first)
+        self.assertEqual(choice_probs.hits, 1)
+        # Other values do not overwrite earlier results
+        second = choice_probs(inv_temp=3., lrate=.2)
+        np.testing.assert_array_almost_equal(first, reference_choice_probs(self.data, 5., .1))
+        choice_probs(inv_temp=3., lrate=.3)
+        self.assertEqual(len(choice_probs.cache), 2)
+        self.assertNotIn((.1, 5.), choice_probs.cache)
+
+    def test_model(self):
+        data = qlearn.qlearn_generate(trials=50, subjs=2)
+        model = qlearn.QLearn(data)
+        model.sample(100, progress_bar=False)
+        self.assertEqual(len(model.mc.trace('lrate')[:]), 100)
+
+        # Choice probabilities are traced bottom nodes and the parents
+        # of the likelihood
+        self.assertEqual(sorted(model.bottom_nodes.keys()), ['choice_probs', 'like'])
+        choice_probs = model.bottom_nodes['choice_probs'][1]
+        self.assertIs(model.bottom_nodes['like'][1].parents['p'], choice_probs)
+        trace = model.mc.trace(choice_probs.__name__)[:]
+        self.assertEqual(trace.shape, (100, 50))
+        lrate, inv_temp = model.subj_nodes['lrate'][1], model.subj_nodes['inv_temp'][1]
+        np.testing.assert_array_almost_equal(trace[-1], reference_choice_probs(data[data['subj_idx'] == 1],
+                                                                               inv_temp.trace()[-1],
+                                                                               lrate.trace()[-1]))
+
+class TestBatchedChoiceLogp(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        data = qlearn.qlearn_generate(trials=60, subjs=25)
+        # Subjects with different numbers of trials
+        self.data_list = [data[data['subj_idx'] == i][:30 + i] for i in range(25)]
+        self.lrate = np.random.rand(25)
+        self.inv_temp = np.random.rand(25) * 10 + 1
+
+    def reference(self, lrate, inv_temp):
+        return np.array([np.sum(np.log(reference_choice_probs(data, it, l)))
+                         for data, l, it in zip(self.data_list, lrate, inv_temp)])
+
+    def test_batched(self):
+        batch = qlearn.BatchedChoiceLogp(self.data_list)
+        np.testing.assert_array_almost_equal(batch.compute(self.lrate, self.inv_temp),
+                                             self.reference(self.lrate, self.inv_temp), 10)
+        # One by one
+        batch = qlearn.BatchedChoiceLogp(self.data_list)
+        batch.min_batch = 100
+        np.testing.assert_array_almost_equal(batch.compute(self.lrate, self.inv_temp),
+                                             self.reference(self.lrate, self.inv_temp), 10)
+
+    def test_stims_actions(self):
+        data = np.empty(40, dtype=[('stim', np.int), ('action', np.int), ('reward', np.float)])
+        data['stim'] = np.random.randint(3, size=40)
+        data['action'] = np.random.randint(4, size=40)
+        data['reward'] = np.random.rand(40) < .5
+        q_mat = .5*np.ones((3,4))
+        logp = 0
+        for t in range(len(data)):
+            logp += np.log(qlearn.softmax(q_mat, 2., data['stim'][t], data['action'][t]))
+            q_mat = qlearn.q_learn(q_mat, .3, data['stim'][t], data['action'][t], data['reward'][t])
+        stim, action, reward = data['stim'][np.newaxis], data['action'][np.newaxis], data['reward'][np.newaxis]
+        batched = qlearn.batched_choice_logp(stim, action, reward, np.ones((1, 40)),
+                                             [.3], [2.], num_stims=3, num_actions=4)
+        self.assertAlmostEqual(batched[0], logp, 10)
+
+    def test_subj_logp(self):
+        batch = qlearn.BatchedChoiceLogp(self.data_list)
+        batch.set_nodes(self.lrate.copy(), self.inv_temp.copy())
+        reference = self.reference(self.lrate, self.inv_temp)
+        # All subjects changed: computed at once
+        self.assertAlmostEqual(batch.subj_logp(0, self.lrate[0], self.inv_temp[0]), reference[0], 10)
+        self.assertFalse(np.any(np.isnan(batch.lrate[0])))
+        # Only the subject itself is recomputed
+        batch.lrate_nodes[3] = .5
+        logp = batch.subj_logp(3, .5, self.inv_temp[3])
+        self.assertAlmostEqual(logp, np.sum(np.log(reference_choice_probs(self.data_list[3], self.inv_temp[3], .5))), 10)
+        self.assertEqual(batch.lrate[0, 4], self.lrate[4])
+        self.assertEqual(batch.lrate[1, 3], self.lrate[3])
+
+    def test_model(self):
+        data = qlearn.qlearn_generate(trials=50, subjs=4)
+        batched = qlearn.QLearn(data, batched=True)
+        batched.create_nodes()
+        model = qlearn.QLearn(data)
+        model.create_nodes()
+        # Both start at the initial values of the parameters
+        self.assertAlmostEqual(pm.MCMC(batched.nodes).logp, pm.MCMC(model.nodes).logp, 8)
+        batched.sample(100, progress_bar=False)
+        # Same node layout
+        self.assertEqual(sorted(batched.bottom_nodes.keys()), ['choice_probs', 'like'])
+        self.assertEqual(batched.mc.trace(batched.bottom_nodes['choice_probs'][0].__name__)[:].shape, (100, 50))
+
+    def test_unsupported_flags(self):
+        data = qlearn.qlearn_generate(trials=50, subjs=2)
+        self.assertRaises(ValueError, qlearn.QLearn, data, batched=True, sufficient_stats=True)
+        self.assertRaises(ValueError, qlearn.QLearn, data, compress=True)
+
+class TestGenerate(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_output(self):
+        data = qlearn.qlearn_generate(trials=20, subjs=3)
+        self.assertEqual(len(data), 60)
+        np.testing.assert_array_equal(data['subj_idx'], np.repeat(np.arange(3), 20))
+        np.testing.assert_array_equal(data['stim'], np.tile(np.arange(20) % 2, 3))
+        self.assertTrue(np.all((data['action'] == 0) | (data['action'] == 1)))
+        self.assertTrue(np.all((data['reward'] == 0) | (data['reward'] == 1)))
+
+    def test_q_reset(self):
+        # Greedy subjects that learn in one trial: without resetting Q
+        # later subjects would repeat the first subject's first choice.
+        data = qlearn.qlearn_generate(trials=1, subjs=1000, lrate=1., rew_prob=1., inv_temp=50.)
+        self.assertAlmostEqual(np.mean(data['action']), .5, 1)
+
+    def test_subj_params(self):
+        lrate = np.array([0., .5])
+        data = qlearn.qlearn_generate(trials=1000, subjs=2, lrate=lrate, inv_temp=10.)
+        correct = [np.mean(data['action'][data['subj_idx'] == i] == data['stim'][data['subj_idx'] == i])
+                   for i in range(2)]
+        # Subject without learning chooses at random
+        self.assertAlmostEqual(correct[0], .5, 1)
+        self.assertGreater(correct[1], .6)
@@ -0,0 +1,209 @@
+import kabuki
+from kabuki.hierarchical import Parameter
+from kabuki.step_methods import GroupMeanGibbs, GroupVarGibbs, Slice
+import numpy as np
+import unittest
+import pymc as pm
+
+from helpers import NormalModel
+
+class NormalSubjModel(NormalModel):
+    def get_subj_node(self, param):
+        return pm.Normal(param.full_name, mu=param.group, tau=param.var**-2,
+                         value=param.init)
+
+class TruncatedSubjModel(NormalSubjModel):
+    get_subj_node = kabuki.Hierarchical.get_subj_node.im_func
+
+class MixedModel(NormalSubjModel):
+    """mu is conjugate, the subj nodes of tau are not Normal."""
+    def get_params(self):
+        return [Parameter('mu', lower=-5, upper=5, init=0),
+                Parameter('tau', lower=.1, upper=5, init=1),
+                Parameter('like', is_bottom_node=True)]
+
+    def get_subj_node(self, param):
+        if param.name == 'tau':
+            return pm.Gamma(param.full_name, alpha=param.group, beta=param.var, value=param.init)
+        return NormalSubjModel.get_subj_node(self, param)
+
+    def get_bottom_node(self, param, params):
+        return pm.Normal(param.full_name, mu=params['mu'], tau=params['tau'],
+                         value=param.data['score'], observed=True)
+
+def gen_data(num_subjs=8, pts_per_subj=20):
+    data = np.empty(num_subjs*pts_per_subj, dtype=[('subj_idx', np.int), ('score', np.float)])
+    data['subj_idx'] = np.repeat(np.arange(num_subjs), pts_per_subj)
+    data['score'] = np.random.randn(len(data)) + np.repeat(np.random.randn(num_subjs), pts_per_subj)
+    return data
+
+def posterior_grid(stochastic, grid):
+    """Return posterior mean of stochastic computed on grid."""
+    logps = []
+    for value in grid:
+        stochastic.value = value
+        logps.append(stochastic.logp + sum([child.logp for child in stochastic.extended_children]))
+    weights = np.exp(np.array(logps) - np.max(logps))
+    return np.sum(weights * grid) / np.sum(weights)
+
+class TestGibbs(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = np.random.randn(30) + 1
+
+    def sample(self, nodes, node, step_method, iter=3000):
+        mc = pm.MCMC(nodes)
+        mc.use_step_method(step_method, node)
+        mc.sample(iter, progress_bar=False)
+        return mc.trace(node.__name__)[:], mc.step_method_dict[node][0]
+
+    def test_group_mean(self):
+        mu = pm.Uniform('mu', lower=-10, upper=10, value=0)
+        x = pm.Normal('x', mu=mu, tau=4, value=self.data, observed=True)
+        self.assertTrue(GroupMeanGibbs.applicable(mu))
+        trace, sm = self.sample([mu, x], mu, GroupMeanGibbs)
+        self.assertTrue(sm.conjugate)
+        self.assertAlmostEqual(np.mean(trace), np.mean(self.data), 1)
+        self.assertAlmostEqual(np.std(trace), (4*len(self.data))**-.5, 2)
+
+    def test_group_var(self):
+        sd = pm.Uniform('sd', lower=.01, upper=10, value=1)
+        x = pm.Normal('x', mu=1, tau=sd**-2, value=self.data, observed=True)
+        self.assertTrue(GroupVarGibbs.applicable(sd))
+        trace, sm = self.sample([sd, x], sd, GroupVarGibbs)
+        self.assertTrue(sm.conjugate)
+        self.assertAlmostEqual(np.mean(trace), posterior_grid(sd, np.linspace(.3, 3, 1000)), 1)
+
+    def test_group_precision(self):
+        tau = pm.Gamma('tau', alpha=1, beta=1, value=1)
+        x = pm.Normal('x', mu=1, tau=tau, value=self.data, observed=True)
+        trace, sm = self.sample([tau, x], tau, GroupVarGibbs)
+        self.assertEqual(sm.kind, 'precision')
+        shape = 1 + len(self.data) / 2.
+        rate = 1 + np.sum((self.data - 1)**2) / 2.
+        self.assertAlmostEqual(np.mean(trace), shape / rate, 1)
+
+    def test_truncated(self):
+        sd = pm.Uniform('sd', lower=.01, upper=10, value=1)
+        x = pm.TruncatedNormal('x', mu=1, tau=sd**-2, a=-3, b=5, value=self.data, observed=True)
+        trace, sm = self.sample([sd, x], sd, GroupVarGibbs)
+        # Proposals get corrected by a Metropolis-Hastings step
+        self.assertFalse(sm.conjugate)
+        self.assertGreater(sm.accepted, 0)
+        self.assertAlmostEqual(np.mean(trace), posterior_grid(sd, np.linspace(.1, 10, 2000)), 1)
+
+    def test_not_applicable(self):
+        sd = pm.Uniform('sd', lower=.01, upper=10, value=1)
+        x = pm.Normal('x', mu=1, tau=sd, value=self.data, observed=True)
+        self.assertFalse(GroupVarGibbs.applicable(sd))
+        mu = pm.Exponential('mu', beta=1, value=1)
+        x = pm.Normal('x', mu=mu, tau=1, value=self.data, observed=True)
+        self.assertFalse(GroupMeanGibbs.applicable(mu))
+
+    def test_hierarchical(self):
+        model = NormalSubjModel(gen_data())
+        model.mcmc(gibbs=True)
+        self.assertIsInstance(model.mc.step_method_dict[model.group_nodes['mu']][0], GroupMeanGibbs)
+        self.assertIsInstance(model.mc.step_method_dict[model.var_nodes['mu']][0], GroupVarGibbs)
+        model.sample(300, burn=100, progress_bar=False)
+        self.assertEqual(model.mc.step_method_dict[model.var_nodes['mu']][0].rejected, 0)
+
+    def test_hierarchical_blocked(self):
+        model = MixedModel(gen_data())
+        model.mcmc(gibbs=True, blocked=True)
+        self.assertIsInstance(model.mc.step_method_dict[model.group_nodes['mu']][0], GroupMeanGibbs)
+        self.assertIsInstance(model.mc.step_method_dict[model.var_nodes['mu']][0], GroupVarGibbs)
+        # The non-conjugate group/var pair is still blocked
+        sm = model.mc.step_method_dict[model.group_nodes['tau']][0]
+        self.assertIsInstance(sm, pm.AdaptiveMetropolis)
+        self.assertEqual(sm.stochastics, set([model.group_nodes['tau'], model.var_nodes['tau']]))
+        for node in model.mc.stochastics:
+            self.assertEqual(len(model.mc.step_method_dict[node]), 1)
+
+    def test_incompatible_flags(self):
+        model = NormalSubjModel(gen_data())
+        approximation = object()
+        self.assertRaises(ValueError, model.mcmc, slice=True, blocked=True, approximation=approximation)
+        self.assertRaises(ValueError, model.mcmc, approximation=approximation)
+
+    def test_hierarchical_truncated(self):
+        model = TruncatedSubjModel(gen_data())
+        model.mcmc()
+        self.assertEqual(model.use_gibbs_step_methods(), 2)
+        model.sample(300, burn=100, progress_bar=False)
+        sm = model.mc.step_method_dict[model.group_nodes['mu']][0]
+        self.assertFalse(sm.conjugate)
+        self.assertGreater(sm.accepted, 0)
+
+class TestSlice(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_univariate(self):
+        data = np.random.randn(100) + 1
+        x = pm.Uniform('x', lower=-10, upper=10, value=0)
+        obs = pm.Normal('obs', mu=x, tau=1, value=data, observed=True)
+        mc = pm.MCMC([x, obs])
+        mc.use_step_method(Slice, x)
+        mc.sample(3000, burn=500, progress_bar=False)
+        trace = mc.trace('x')[:]
+        self.assertAlmostEqual(np.mean(trace), np.mean(data), 1)
+        self.assertAlmostEqual(np.std(trace), .1, 1)
+        # Width got adapted to the scale of the posterior
+        sm = mc.step_method_dict[x][0]
+        self.assertLess(sm.width[0], .5)
+
+    def test_bounds(self):
+        x = pm.TruncatedNormal('x', mu=0, tau=1, a=0, b=2, value=.5)
+        obs = pm.Normal('obs', mu=x, tau=1e-8, value=0, observed=True)
+        mc = pm.MCMC([x, obs])
+        mc.use_step_method(Slice, x)
+        mc.sample(2000, progress_bar=False)
+        trace = mc.trace('x')[:]
+        self.assertGreaterEqual(trace.min(), 0)
+        self.assertLessEqual(trace.max(), 2)
+        # Truncated to [0, 2]
+        self.assertAlmostEqual(np.mean(trace), .72, 1)
+
+    def test_blocked(self):
+        x = pm.Uniform('x', lower=-3, upper=3, value=0)
+        y = pm.Normal('y', mu=x, tau=1, value=0)
+        obs = pm.Normal('obs', mu=y, tau=1e-8, value=0, observed=True)
+        mc = pm.MCMC([x, y, obs])
+        mc.use_step_method(Slice, [x, y])
+        mc.sample(4000, burn=1000, progress_bar=False)
+        self.assertEqual(len(mc.step_methods), 1)
+        self.assertAlmostEqual(np.std(mc.trace('x')[:]), 6 / np.sqrt(12), 0)
+        self.assertAlmostEqual(np.std(mc.trace('y')[:]), 2, 0)
+        self.assertGreater(np.corrcoef(mc.trace('x')[:], mc.trace('y')[:])[0, 1], .5)
+
+    def test_hierarchical(self):
+        model = TruncatedSubjModel(gen_data())
+        model.mcmc(slice=True)
+        for node in model.mc.stochastics:
+            self.assertIsInstance(model.mc.step_method_dict[node][0], Slice)
+        sm = model.mc.step_method_dict[model.var_nodes['mu']][0]
+        np.testing.assert_array_equal(sm.get_bounds(), [[1e-3], [10]])
+        model.sample(300, burn=100, progress_bar=False)
+
+    def test_unbounded(self):
+        # Normal subj nodes are not clipped to the bounds of their Parameter
+        model = NormalSubjModel(gen_data())
+        model.mcmc(slice=True)
+        sm = model.mc.step_method_dict[model.subj_nodes['mu'][0]][0]
+        np.testing.assert_array_equal(sm.get_bounds(), [[-np.inf], [np.inf]])
+        sm = model.mc.step_method_dict[model.var_nodes['mu']][0]
+        np.testing.assert_array_equal(sm.get_bounds(), [[1e-3], [10]])
+
+    def test_hierarchical_blocked(self):
+        model = NormalSubjModel(gen_data())
+        model.mcmc(slice=True, blocked=True, gibbs=True)
+        self.assertIsInstance(model.mc.step_method_dict[model.group_nodes['mu']][0], GroupMeanGibbs)
+        self.assertIsInstance(model.mc.step_method_dict[model.subj_nodes['mu'][0]][0], Slice)
+        model.sample(300, burn=100, progress_bar=False)
@@ -0,0 +1,82 @@
+import kabuki
+from kabuki.checkpoint import step_method_key
+import numpy as np
+import unittest
+import pymc as pm
+
+from helpers import NormalModel, gen_data
+
+class TestTuning(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+        self.data = gen_data(5, conds=['a', 'b'], subj_offset=1)
+
+    def test_optimal_rates(self):
+        self.assertEqual(kabuki.tuning.optimal_acceptance_rate(1), .44)
+        self.assertEqual(kabuki.tuning.optimal_acceptance_rate(10), .234)
+
+    def test_tune_during_burn(self):
+        model = NormalModel(self.data)
+        model.mcmc()
+        model.mc.assign_step_methods()
+        # Start from proposals that are far too wide
+        for sm in model.mc.step_methods:
+            sm.adaptive_scale_factor = 50.
+        model.sample(2000, burn=1000, tune_proposals=True, progress_bar=False)
+
+        for sm in model.mc.step_methods:
+            # Tuned towards the target acceptance rate ...
+            self.assertLess(sm.adaptive_scale_factor, 50.)
+            rate = sm.accepted / (sm.accepted + sm.rejected)
+            self.assertGreater(rate, .2)
+            self.assertLess(rate, .7)
+            # ... and frozen after burn-in
+            self.assertEqual(model.proposal_scales[step_method_key(sm)], sm.adaptive_scale_factor)
+
+    def test_reuse_scales(self):
+        model = NormalModel(self.data)
+        model.sample(600, burn=500, tune_proposals=True, progress_bar=False)
+
+        model2 = NormalModel(self.data)
+        model2.mcmc()
+        scheduler = kabuki.tuning.TuningScheduler(model2.mc)
+        scheduler.set_scales(model.proposal_scales)
+        for sm in model2.mc.step_methods:
+            self.assertEqual(sm.adaptive_scale_factor, model.proposal_scales[step_method_key(sm)])
+
+    def test_blocked(self):
+        model = NormalModel(self.data, depends_on={'mu': ['cond']})
+        model.mcmc(blocked=True)
+        model.mc.assign_step_methods()
+        model.sample(1500, burn=1000, tune_proposals=True, progress_bar=False)
+        blocked = [sm for sm in model.mc.step_methods if isinstance(sm, pm.AdaptiveMetropolis)]
+        for sm in blocked:
+            self.assertNotEqual(sm.scale, 1.)
+            np.testing.assert_array_almost_equal(sm.proposal_sd, np.linalg.cholesky(sm.C) * sm.scale)
+            self.assertEqual(model.proposal_scales[step_method_key(sm)], sm.scale)
+
+    def test_counts_across_cov_updates(self):
+        model = NormalModel(self.data, depends_on={'mu': ['cond']})
+        model.mcmc(blocked=True)
+        model.mc.assign_step_methods()
+        scheduler = kabuki.tuning.TuningScheduler(model.mc)
+        blocked = [sm for sm in scheduler.step_methods if isinstance(sm, pm.AdaptiveMetropolis)]
+        for sm in blocked:
+            sm.delay = sm.interval = 50
+        model.mc.sample(300, progress_bar=False)
+        # AdaptiveMetropolis reset its counts, the scheduler saw every step
+        self.assertLess(blocked[0].accepted + blocked[0].rejected, 300)
+        scheduler._collect_counts()
+        np.testing.assert_array_equal(scheduler._accepted + scheduler._rejected, 300)
+
+    def test_burn_till_tuned(self):
+        model = NormalModel(self.data)
+        model.sample(200, burn=100, tune_proposals=True, tune_interval=50,
+                     burn_till_tuned=True, stop_tuning_after=2, progress_bar=False)
+        # pymc burns in until all acceptance rates were on target at two consecutive tunings
+        self.assertFalse(model.mc._tuning)
+        self.assertEqual(model.mc._tuned_count, 2)
+        self.assertEqual(len(model.mc.trace('mu')[:]), 100)
@@ -0,0 +1,107 @@
+import kabuki
+import numpy as np
+import pymc as pm
+import unittest
+import scipy.stats.distributions as sc_dst
+from kabuki.utils import scipy_stochastic
+
+class TestScipyStochastic(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_fast_logp(self):
+        continuous = [('norm', {}, np.random.randn(20)),
+                      ('expon', {}, np.random.rand(20)),
+                      ('laplace', {}, np.random.randn(20)),
+                      ('uniform', {}, np.random.rand(20)),
+                      ('gamma', {'a': 2.5}, np.random.rand(20) * 3),
+                      ('beta', {'a': .7, 'b': 2.}, np.random.rand(20)),
+                      ('lognorm', {'s': .6}, np.random.rand(20) * 3)]
+        discrete = [('bernoulli', {'p': .3}, np.random.randint(0, 2, 20)),
+                    ('binom', {'n': 10, 'p': .3}, np.random.randint(0, 11, 20)),
+                    ('poisson', {'mu': 3.}, np.random.randint(0, 9, 20)),
+                    ('geom', {'p': .3}, np.random.randint(1, 9, 20)),
+                    ('nbinom', {'n': 3, 'p': .4}, np.random.randint(0, 9, 20))]
+        # Shift and scale continuous values
+        continuous = [(name, dict(params, loc=.1, scale=1.3), value * 1.3 + .1)
+                      for name, params, value in continuous]
+        for name, params, value in continuous + discrete:
+            dist = getattr(sc_dst, name + '_gen')
+            fast = scipy_stochastic(dist, name=name)('fast', value=value, observed=True, **params)
+            slow = scipy_stochastic(dist, name=name, fast_logp=False)('slow', value=value, observed=True, **params)
+            self.assertTrue(isinstance(fast._logp_fun, kabuki.utils._FastLogp), name)
+            self.assertAlmostEqual(fast.logp, slow.logp, 8, name)
+
+    def test_fast_logp_support(self):
+        normal_like = scipy_stochastic(sc_dst.norm_gen, name='normal')
+        gamma_like = scipy_stochastic(sc_dst.gamma_gen, name='gamma')
+        scale = pm.Uniform('scale', -1, 10, value=1.)
+        normal = normal_like('normal', loc=0, scale=scale, value=np.random.randn(10), observed=True)
+        gamma = gamma_like('gamma', a=2., value=1.)
+
+        # Values on the real line are never checked
+        self.assertFalse(normal._logp_fun.check_values)
+        self.assertTrue(gamma._logp_fun.check_values)
+
+        # Invalid parents and values
+        scale.value = -.5
+        self.assertRaises(pm.ZeroProbability, lambda: normal.logp)
+        scale.value = 2.
+        self.assertAlmostEqual(normal.logp, np.sum(sc_dst.norm.logpdf(normal.value, 0, 2.)))
+        gamma.value = -1.
+        self.assertRaises(pm.ZeroProbability, lambda: gamma.logp)
+
+    def test_fast_logp_observed_support(self):
+        # The support of observed values moves with loc and scale
+        expon_like = scipy_stochastic(sc_dst.expon_gen, name='expon')
+        uniform_like = scipy_stochastic(sc_dst.uniform_gen, name='uniform')
+        loc = pm.Uniform('loc', -10, 10, value=0.)
+        scale = pm.Uniform('scale', 0, 10, value=3.)
+        expon = expon_like('expon', loc=loc, value=np.array([1., 2.]), observed=True)
+        uniform = uniform_like('uniform', loc=0., scale=scale, value=np.array([1., 2.]), observed=True)
+        self.assertAlmostEqual(expon.logp, -3.)
+
+        loc.value = 3.
+        self.assertRaises(pm.ZeroProbability, lambda: expon.logp)
+        loc.value = .5
+        self.assertAlmostEqual(expon.logp, np.sum(sc_dst.expon.logpdf(expon.value, .5)))
+        scale.value = 1.5
+        self.assertRaises(pm.ZeroProbability, lambda: uniform.logp)
+        scale.value = 2.
+        self.assertAlmostEqual(uniform.logp, -2 * np.log(2.))
+
+    def test_array_params(self):
+        normal_like = scipy_stochastic(sc_dst.norm_gen, name='normal')
+        loc = pm.Normal('loc', 0, 1, value=0.)
+        like = normal_like('like', loc=loc, scale=1., value=np.random.randn(5), observed=True)
+        locs = np.array([-1., 0., 2.])
+        scales = np.array([1., 2., 3.])
+        points = np.linspace(-1, 1, 7)
+
+        pdf = like.pdf(params={'loc': locs})
+        self.assertEqual(pdf.shape, (3, 5))
+        np.testing.assert_array_almost_equal(pdf[2], sc_dst.norm.pdf(like.value, 2.))
+
+        cdf = like.cdf(points, params={'loc': locs, 'scale': scales})
+        self.assertEqual(cdf.shape, (3, 7))
+        np.testing.assert_array_almost_equal(cdf[1], sc_dst.norm.cdf(points, 0., 2.))
+
+        # ppf with params does not set the value
+        value = like.value.copy()
+        np.testing.assert_array_almost_equal(like.ppf([.5], params={'loc': locs}), locs[:, np.newaxis])
+        np.testing.assert_array_equal(like.value, value)
+
+        self.assertEqual(like.random(params={'loc': locs}).shape, (3, 5))
+        self.assertEqual(like.random(size=(4, 2), params={'loc': locs}).shape, (3, 4, 2))
+        samples = like.random(size=10000, params={'loc': locs})
+        np.testing.assert_array_almost_equal(samples.mean(axis=1), locs, 1)
+        self.assertRaises(KeyError, like.pdf, params={'mu': locs})
+
+        # Discrete distributions use the pmf
+        poisson_like = scipy_stochastic(sc_dst.poisson_gen, name='poisson')
+        counts = poisson_like('counts', mu=3., value=[1, 2, 3], observed=True)
+        np.testing.assert_array_almost_equal(counts.pdf(params={'mu': [1., 2.]})[1],
+                                             sc_dst.poisson.pmf([1, 2, 3], 2.))
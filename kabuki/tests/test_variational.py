@@ -0,0 +1,107 @@
+from __future__ import division
+import kabuki
+from kabuki.variational import MeanFieldVI
+import numpy as np
+import unittest
+import pymc as pm
+
+from helpers import NormalModel, gen_data
+
+class TestMeanFieldVI(unittest.TestCase):
+    def runTest(self):
+        pass
+
+    def setUp(self):
+        np.random.seed(31337)
+
+    def test_conjugate(self):
+        data = np.random.randn(50) + 1
+        mu = pm.Normal('mu', mu=0, tau=.01, value=0)
+        x = pm.Normal('x', mu=mu, tau=1, value=data, observed=True)
+        vi = MeanFieldVI([mu, x])
+        vi.fit(iter=3000)
+        post_tau = .01 + len(data)
+        post_mu = np.sum(data) / post_tau
+        self.assertAlmostEqual(vi.mean[0], post_mu, 1)
+        self.assertAlmostEqual(vi.sd[0], post_tau**-.5, 1)
+        draws = np.array([vi.draw()[0] for i in range(2000)])
+        self.assertAlmostEqual(np.mean(draws), post_mu, 1)
+
+    def test_log_jacobian_grad(self):
+        sd = pm.Uniform('sd', lower=.1, upper=10, value=1)
+        rate = pm.Exponential('rate', beta=1, value=1)
+        x = pm.Normal('x', mu=rate, tau=sd**-2, value=np.random.randn(10), observed=True)
+        vi = MeanFieldVI([sd, rate, x])
+        y = np.random.randn(vi.len)
+        eps = 1e-6
+        for i in range(vi.len):
+            dy = np.zeros(vi.len)
+            dy[i] = eps
+            numeric = (vi.log_jacobian(y + dy) - vi.log_jacobian(y - dy)) / (2 * eps)
+            self.assertAlmostEqual(vi.log_jacobian_grad(y)[i], numeric, 4)
+
+    def test_zero_probability_draws(self):
+        x = pm.Normal('x', mu=0, tau=1, value=1)
+        positive = pm.Potential(logp=lambda x=x: 0 if x > 0 else -np.inf, name='positive',
+                                parents={'x': x}, doc='')
+        vi = MeanFieldVI([x, positive])
+        z = np.array([[1.], [-3.], [2.]])
+        elbo, grad_mean, grad_log_sd = vi._elbo_and_grad(np.zeros(1), np.zeros(1), z)
+        # Averaged over the two valid draws only
+        self.assertAlmostEqual(elbo, -(1 + 4) / 4 - np.log(2 * np.pi) / 2)
+        self.assertAlmostEqual(grad_mean[0], -1.5, 4)
+        self.assertAlmostEqual(grad_log_sd[0], -(1 + 4) / 2 + 1, 4)
+        self.assertIsNone(vi._elbo_and_grad(np.zeros(1), np.zeros(1), -np.abs(z)))
+
+    def test_fit_vi(self):
+        model = NormalModel(gen_data(5, subj_offset=.5))
+        vi = model.fit_vi(samples=200, iter=500)
+        self.assertTrue(vi.fitted)
+        self.assertIsNone(model.mc)
+        self.assertEqual(len(model.approx_mc.trace('mu')[:]), 200)
+        stats = model.approx_mc.stats()
+        self.assertIn('mu', stats)
+        # Draws respect the bounds of the var node
+        var_trace = model.approx_mc.trace(model.var_nodes['mu'].__name__)[:]
+        self.assertTrue(np.all(var_trace > 1e-3))
+        self.assertTrue(np.all(var_trace < 10))
+
+        # Summaries of the draws
+        summary = model.summary(mc=model.approx_mc)
+        self.assertEqual(list(summary.index[:2]), [('mu', '', -1), ('mu_var', '', -1)])
+        self.assertEqual(len(summary), 7)
+        self.assertAlmostEqual(summary['mean']['mu', '', -1], np.mean(model.approx_mc.trace('mu')[:]))
+        self.assertAlmostEqual(model.stats(mc=model.approx_mc)['mu']['mean'], summary['mean']['mu', '', -1])
+        self.assertEqual(len(kabuki.analyze.gen_stats(summary).splitlines()), 8)
+        self.assertRaises(ValueError, model.summary)
+
+    def test_fit_vi_extreme_logit(self):
+        # The logit coordinate of the bounded var node drifts far out,
+        # where dx/dy underflows to 0
+        np.random.seed(0)
+        model = NormalModel(gen_data(3))
+        vi = model.fit_vi(samples=50, iter=300)
+        self.assertTrue(vi.fitted)
+        y = np.zeros(vi.len)
+        y[vi._slices[model.var_nodes['mu']]] = 800.
+        self.assertTrue(np.isfinite(vi.log_jacobian(y)))
+        self.assertTrue(np.isfinite(vi.log_jacobian(-y)))
+
+    def test_sample_after_fit_vi(self):
+        model = NormalModel(gen_data(5, subj_offset=.5))
+        model.fit_vi(samples=50, iter=200)
+        model.sample(150, burn=50, progress_bar=False)
+        step_methods = [sm for sms in model.mc.step_method_dict.itervalues() for sm in sms]
+        self.assertTrue(step_methods)
+        self.assertFalse(any([isinstance(sm, kabuki.variational.ApproximateDraw) for sm in step_methods]))
+        self.assertEqual(len(model.mc.trace('mu')[:]), 100)
+        self.assertEqual(len(model.approx_mc.trace('mu')[:]), 50)
+        self.assertEqual(len(model.nodes['mu_group'].trace()), 100)
+
+        # The traces of an existing sampler are kept
+        model.fit_vi(samples=30, iter=200)
+        self.assertEqual(len(model.nodes['mu_group'].trace()), 100)
+        self.assertEqual(len(model.approx_mc.trace('mu')[:]), 30)
+        self.assertAlmostEqual(model.summary()['mean'][0], np.mean(model.nodes['mu_group'].trace()))
+        self.assertAlmostEqual(model.summary(mc=model.approx_mc)['mean'][0],
+                               np.mean(model.approx_mc.trace('mu')[:]))
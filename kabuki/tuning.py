@@ -0,0 +1,260 @@
+"""
+Acceptance rate driven tuning of Metropolis proposals during burn-in.
+
+pymc tunes each Metropolis step method on its own with a fixed table
+of scale changes and keeps tuning after burn-in by default. The
+TuningScheduler instead keeps the acceptance counts and proposal
+scales of all Metropolis and AdaptiveMetropolis step methods in
+arrays and moves all scales towards their target acceptance rate at
+once (a Robbins-Monro update of the log scale). The acceptance
+counts are collected at every covariance update of
+AdaptiveMetropolis (which resets its counts) and at every tuning, so
+no steps get lost. The scheduler chains to pymc.MCMC.tune(), which
+keeps its burn_till_tuned bookkeeping and tunes all other step
+methods. Tuning stops after burn-in, the final scales can be passed
+to later fits of the same model:
+
+    >>> model.sample(10000, burn=5000, tune_proposals=True)
+    >>> scales = model.proposal_scales
+    >>> model2 = MyModel(data)
+    >>> model2.sample(10000, burn=1000, proposal_scales=scales)
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+
+from kabuki.checkpoint import step_method_key
+
+__all__ = ['TuningScheduler', 'optimal_acceptance_rate']
+
+# Optimal acceptance rates of random walk Metropolis by dimension
+# (Roberts & Rosenthal, 2001); .234 for dimensions >= 5.
+_OPTIMAL_RATES = [.44, .35, .31, .28]
+
+def optimal_acceptance_rate(dim):
+    """Return the target acceptance rate of a random walk Metropolis
+    step method updating dim dimensions.
+    """
+    if dim <= len(_OPTIMAL_RATES):
+        return _OPTIMAL_RATES[dim - 1]
+    return .234
+
+def _is_tunable(sm):
+    if isinstance(sm, pm.AdaptiveMetropolis):
+        return True
+    return isinstance(sm, pm.Metropolis) and \
+        not isinstance(sm, (pm.Gibbs, pm.BinaryMetropolis))
+
+def _scale_adaptive_metropolis(sm):
+    """Make AdaptiveMetropolis sm multiply its proposal by sm.scale,
+    also after it updated its covariance.
+    """
+    sm.scale = 1.
+    def updateproposal_sd():
+        sm.proposal_sd = np.linalg.cholesky(sm.C) * sm.scale
+    sm.updateproposal_sd = updateproposal_sd
+
+
+class TuningScheduler(object):
+    """Tune the proposal scales of all Metropolis and
+    AdaptiveMetropolis step methods of a sampler towards a target
+    acceptance rate.
+
+    :Arguments:
+        mc : pymc.MCMC
+            Sampler. Step methods get assigned if necessary.
+
+    :Optional:
+        target : float
+            Target acceptance rate for all step methods (default:
+            optimal rate for the dimension of each step method, see
+            optimal_acceptance_rate()).
+        gain : float
+            Step size of the update of the log scales.
+        min_scale, max_scale : float
+            Bounds of the scales.
+        tolerance : float
+            A step method counts as tuned (see burn_till_tuned of
+            pymc.MCMC.sample()) if its acceptance rate since the last
+            tuning is within tolerance of its target.
+
+    """
+    def __init__(self, mc, target=None, gain=2., min_scale=1e-4, max_scale=1e4, tolerance=.1):
+        self.mc = mc
+        self.gain = gain
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.tolerance = tolerance
+
+        mc.assign_step_methods()
+        self.step_methods = sorted([sm for sm in mc.step_methods if _is_tunable(sm)],
+                                   key=step_method_key)
+
+        for i, sm in enumerate(self.step_methods):
+            if isinstance(sm, pm.AdaptiveMetropolis):
+                if not hasattr(sm, 'scale'):
+                    _scale_adaptive_metropolis(sm)
+                self._count_before_update_cov(i, sm)
+
+        dims = np.array([sum([np.size(s.value) for s in sm.stochastics]) for sm in self.step_methods])
+        if target is None:
+            self.targets = np.array([optimal_acceptance_rate(dim) for dim in dims])
+        else:
+            self.targets = np.ones(len(self.step_methods)) * target
+
+        self.scales = np.array([self._get_scale(sm) for sm in self.step_methods], dtype=float)
+        # Counts of the step methods at the last collection and the
+        # counts collected since the last tuning
+        self._last_accepted, self._last_rejected = self._get_counts()
+        self._accepted = np.zeros(len(self.step_methods))
+        self._rejected = np.zeros(len(self.step_methods))
+        self.acceptance_rates = np.empty(len(self.step_methods))
+        self.acceptance_rates[:] = np.nan
+        self._tuned = np.zeros(len(self.step_methods), dtype=bool)
+        self.n_tuned = 0
+
+    @staticmethod
+    def _get_scale(sm):
+        if isinstance(sm, pm.AdaptiveMetropolis):
+            return sm.scale
+        return sm.adaptive_scale_factor
+
+    def _get_counts(self):
+        accepted = np.array([sm.accepted for sm in self.step_methods], dtype=float)
+        rejected = np.array([sm.rejected for sm in self.step_methods], dtype=float)
+        return accepted, rejected
+
+    def _collect_counts(self, idx=slice(None)):
+        """Add the steps since the last collection to the counts
+        since the last tuning.
+        """
+        accepted, rejected = self._get_counts()
+        self._accepted[idx] += accepted[idx] - self._last_accepted[idx]
+        self._rejected[idx] += rejected[idx] - self._last_rejected[idx]
+        self._last_accepted[idx] = accepted[idx]
+        self._last_rejected[idx] = rejected[idx]
+
+    def _count_before_update_cov(self, i, sm):
+        """Collect the counts of AdaptiveMetropolis sm before it resets
+        them in update_cov().
+        """
+        if not hasattr(sm, '_update_cov'):
+            sm._update_cov = sm.update_cov
+        def update_cov():
+            self._collect_counts(i)
+            sm._update_cov()
+            self._last_accepted[i] = sm.accepted
+            self._last_rejected[i] = sm.rejected
+        sm.update_cov = update_cov
+
+    def _tune_step_method(self, i):
+        """Return the tune() of step method i called by
+        pymc.MCMC.tune(); the scales were already updated by tune().
+        """
+        def tune(verbose=0):
+            return int(not self._tuned[i])
+        return tune
+
+    def _set_scales(self):
+        for sm, scale in zip(self.step_methods, self.scales):
+            if isinstance(sm, pm.AdaptiveMetropolis):
+                sm.proposal_sd = sm.proposal_sd * (scale / sm.scale)
+                sm.scale = scale
+            else:
+                sm.adaptive_scale_factor = scale
+
+    def attach(self):
+        """Replace the tuning of mc by this scheduler.
+
+        pymc.MCMC calls tune() every tune_interval iterations while it
+        is tuning (see pymc.MCMC.sample()).
+        """
+        self._mc_tune = self.mc.tune
+        for i, sm in enumerate(self.step_methods):
+            sm.tune = self._tune_step_method(i)
+        self.mc.tune = self.tune
+        # Checkpoints store the state of the scheduler
+        self.mc._tuning_scheduler = self
+        return self
+
+    def tune(self):
+        """Rescale all proposals towards the target acceptance rates
+        based on the acceptance counts since the last call.
+        """
+        self._collect_counts()
+        total = self._accepted + self._rejected
+        stepped = total > 0
+        self.acceptance_rates[stepped] = self._accepted[stepped] / total[stepped]
+        self._accepted[:] = 0
+        self._rejected[:] = 0
+
+        off_target = self.acceptance_rates[stepped] - self.targets[stepped]
+        self._tuned[stepped] = np.abs(off_target) <= self.tolerance
+        log_scales = np.log(self.scales)
+        log_scales[stepped] += self.gain * off_target
+        self.scales = np.clip(np.exp(log_scales), self.min_scale, self.max_scale)
+        self._set_scales()
+        self.n_tuned += 1
+
+        if self.mc.verbose > 1:
+            for sm, rate, scale in zip(self.step_methods, self.acceptance_rates, self.scales):
+                print "%s: acceptance rate %.2f, scale %.3g" % (sm._id, rate, scale)
+
+        # Tunes all other step methods (e.g. slice samplers) and
+        # keeps the burn_till_tuned bookkeeping of the sampler
+        self._mc_tune()
+
+    def get_scales(self):
+        """Return dict mapping step methods (see
+        kabuki.checkpoint.step_method_key()) to their current scale.
+        """
+        return dict((step_method_key(sm), scale) for sm, scale in zip(self.step_methods, self.scales))
+
+    def set_scales(self, scales):
+        """Set the scales of the step methods from a dict returned by
+        get_scales() (e.g. of an earlier fit of the same model).
+        Step methods not in scales are left unchanged.
+        """
+        for i, sm in enumerate(self.step_methods):
+            self.scales[i] = scales.get(step_method_key(sm), self.scales[i])
+        self._set_scales()
+
+    def get_state(self):
+        """Return the state of the scheduler (see set_state())."""
+        return {'step_methods': [step_method_key(sm) for sm in self.step_methods],
+                'scales': self.scales.copy(), 'targets': self.targets.copy(),
+                'acceptance_rates': self.acceptance_rates.copy(),
+                'last_accepted': self._last_accepted.copy(), 'last_rejected': self._last_rejected.copy(),
+                'accepted': self._accepted.copy(), 'rejected': self._rejected.copy(),
+                'tuned': self._tuned.copy(), 'n_tuned': self.n_tuned, 'gain': self.gain,
+                'min_scale': self.min_scale, 'max_scale': self.max_scale, 'tolerance': self.tolerance}
+
+    def set_state(self, state):
+        """Restore the state returned by get_state() (e.g. stored in a
+        checkpoint) after the state of the step methods was restored.
+        """
+        index = dict((key, i) for i, key in enumerate(state['step_methods']))
+        for i, sm in enumerate(self.step_methods):
+            j = index.get(step_method_key(sm))
+            if j is None:
+                continue
+            self.scales[i] = state['scales'][j]
+            self.targets[i] = state['targets'][j]
+            self.acceptance_rates[i] = state['acceptance_rates'][j]
+            self._last_accepted[i] = state['last_accepted'][j]
+            self._last_rejected[i] = state['last_rejected'][j]
+            self._accepted[i] = state['accepted'][j]
+            self._rejected[i] = state['rejected'][j]
+            self._tuned[i] = state['tuned'][j]
+            # The restored proposal_sd already includes the scale
+            if isinstance(sm, pm.AdaptiveMetropolis):
+                sm.scale = self.scales[i]
+            else:
+                sm.adaptive_scale_factor = self.scales[i]
+        self.n_tuned = state['n_tuned']
+        self.gain = state['gain']
+        self.min_scale = state['min_scale']
+        self.max_scale = state['max_scale']
+        self.tolerance = state['tolerance']
@@ -1,10 +1,10 @@
 from __future__ import division
 import numpy as np
-import matplotlib.pyplot as plt
 import pymc as pm
 from copy import copy, deepcopy
 import sys
 import kabuki
+from scipy.special import gammaln, betaln, xlogy, xlog1py
 
 def interpolate_trace(x, trace, range=(-1,1), bins=100):
     """Interpolate distribution (from samples) at position x.
@@ -193,28 +193,186 @@ def parse_config_file(fname, mcmc=False, load=False, param_names=None):
 
     return m
 
+# Direct NumPy log densities of common scipy distributions used by
+# scipy_stochastic() instead of scipy's generic logpdf()/logpmf(). Each
+# entry maps the name of the scipy class (without _gen) to
+# (check_params(*shape_args), check_value(x, *shape_args),
+# logp(x, *shape_args)), where x is the standardized value, i.e.
+# (value - loc) / scale for continuous and value - loc for discrete
+# distributions, and logp() returns the log density of each value.
+_LOG_SQRT_2PI = .5 * np.log(2 * np.pi)
+
+def _no_params(*args):
+    return True
+
+def _all_values(x, *args):
+    return True
+
+def _positive_values(x, *args):
+    return np.all(x >= 0)
+
+def _unit_values(x, *args):
+    return np.all((x >= 0) & (x <= 1))
+
+def _counts(x, *args):
+    return np.all((x >= 0) & (x == np.floor(x)))
+
+def _unit_param(p):
+    return np.all((p >= 0) & (p <= 1))
+
+_FAST_LOGP = {
+    'norm': (_no_params, _all_values,
+             lambda x: -.5 * np.square(x) - _LOG_SQRT_2PI),
+    'expon': (_no_params, _positive_values,
+              lambda x: -x),
+    'laplace': (_no_params, _all_values,
+                lambda x: -np.abs(x) - np.log(2)),
+    'uniform': (_no_params, _unit_values,
+                lambda x: np.zeros(np.shape(x))),
+    'gamma': (lambda a: np.all(a > 0), _positive_values,
+              lambda x, a: xlogy(a - 1, x) - x - gammaln(a)),
+    'beta': (lambda a, b: np.all((a > 0) & (b > 0)), _unit_values,
+             lambda x, a, b: xlogy(a - 1, x) + xlog1py(b - 1, -x) - betaln(a, b)),
+    'lognorm': (lambda s: np.all(s > 0), lambda x, s: np.all(x > 0),
+                lambda x, s: -np.log(s * x) - _LOG_SQRT_2PI - np.square(np.log(x)) / (2 * np.square(s))),
+    'bernoulli': (_unit_param, lambda x, p: np.all((x == 0) | (x == 1)),
+                  lambda x, p: xlogy(x, p) + xlog1py(1 - x, -p)),
+    'binom': (lambda n, p: np.all((n >= 0) & (n == np.floor(n))) and _unit_param(p),
+              lambda x, n, p: _counts(x) and np.all(x <= n),
+              lambda x, n, p: gammaln(n + 1) - gammaln(x + 1) - gammaln(n - x + 1) +
+                              xlogy(x, p) + xlog1py(n - x, -p)),
+    'poisson': (lambda mu: np.all(mu >= 0), _counts,
+                lambda x, mu: xlogy(x, mu) - gammaln(x + 1) - mu),
+    'geom': (lambda p: np.all((p > 0) & (p <= 1)), lambda x, p: _counts(x - 1),
+             lambda x, p: xlog1py(x - 1, -p) + np.log(p)),
+    'nbinom': (lambda n, p: np.all(n > 0) and _unit_param(p), _counts,
+               lambda x, n, p: gammaln(n + x) - gammaln(x + 1) - gammaln(n) +
+                               xlogy(n, p) + xlog1py(x, -p)),
+}
+
+def _fast_logp(scipy_dist):
+    """Return the _FAST_LOGP entry of scipy_dist or None if it is not
+    (exactly) one of these scipy distributions.
+    """
+    cls = scipy_dist.__class__
+    if not cls.__module__.startswith('scipy.stats'):
+        return None
+    return _FAST_LOGP.get(cls.__name__.replace('_gen', ''))
+
+class _FastLogp(object):
+    """logp function of a scipy_stochastic node using _FAST_LOGP.
+
+    The parents are only validated if they changed since the last
+    successful validation (scalar parents only). The values of
+    observed nodes, which never change, are only checked against the
+    support again if one of the parents changed since the last
+    successful check, as the support depends on them (e.g. loc and
+    scale). Values of distributions whose support is the real line
+    are never checked.
+    """
+    def __init__(self, fast, shape_args, continuous):
+        self.check_params, self.check_value, self.logp = fast
+        self.shape_args = shape_args
+        self.continuous = continuous
+        self.check_values = self.check_value is not _all_values
+        self.observed = False
+        self._valid_params = None
+        self._valid_value_params = None
+
+    def skip_value_check(self, value, **kwds):
+        """Mark value as observed so that it is only checked again
+        if the parents change.
+        """
+        self.observed = True
+        x = self._standardize(value, kwds)
+        if self.check_value(x, *[kwds[name] for name in self.shape_args]):
+            self._valid_value_params = self._param_key(kwds)
+
+    def _standardize(self, value, kwds):
+        if self.continuous:
+            return (value - kwds['loc']) / kwds['scale']
+        return value - kwds['loc']
+
+    def _param_key(self, kwds):
+        """Return the parent values as tuple of floats or None if a
+        parent is an array.
+        """
+        args = [kwds[name] for name in self.shape_args]
+        scale = kwds['scale'] if self.continuous else 1.
+        try:
+            return tuple([float(arg) for arg in args]) + (float(kwds['loc']), float(scale))
+        except TypeError:
+            return None
+
+    def points(self, value, **kwds):
+        """Return the log density of each element of value (or -inf
+        if a parent or value is out of its support).
+        """
+        args = [kwds[name] for name in self.shape_args]
+        loc = kwds['loc']
+        scale = kwds['scale'] if self.continuous else 1.
+
+        # Array parents are always validated
+        params = self._param_key(kwds)
+        if params is None or params != self._valid_params:
+            if not (np.all(scale > 0) and self.check_params(*args)):
+                return -np.inf
+            self._valid_params = params
+
+        if self.continuous:
+            x = (value - loc) / scale
+        else:
+            x = value - loc
+        if self.check_values and (not self.observed or params is None or
+                                  params != self._valid_value_params):
+            if not self.check_value(x, *args):
+                return -np.inf
+            if self.observed:
+                self._valid_value_params = params
+
+        logp = self.logp(x, *args)
+        if self.continuous:
+            logp = logp - np.log(scale)
+        return logp
+
+    def __call__(self, value, **kwds):
+        return np.sum(self.points(value, **kwds))
+
 def scipy_stochastic(scipy_dist, **kwargs):
     """
     Return a Stochastic subclass made from a particular SciPy distribution.
+
+    :Note:
+        The log density of common distributions (norm, expon,
+        laplace, uniform, gamma, beta, lognorm, bernoulli, binom,
+        poisson, geom and nbinom) is computed directly with NumPy
+        instead of scipy's logpdf()/logpmf(). Pass fast_logp=False
+        to always use scipy.
     """
     import inspect
     import scipy.stats.distributions as sc_dst
     from pymc.ScipyDistributions import separate_shape_args
     from pymc.distributions import new_dist_class, bind_size
 
+    use_fast_logp = kwargs.pop('fast_logp', True)
+
     if scipy_dist.__class__.__name__.find('_gen'):
         scipy_dist = scipy_dist(**kwargs)
 
     name = scipy_dist.__class__.__name__.replace('_gen','').capitalize()
 
-    (args, varargs, varkw, defaults) = inspect.getargspec(scipy_dist._pdf)
+    if isinstance(scipy_dist, sc_dst.rv_discrete):
+        (args, varargs, varkw, defaults) = inspect.getargspec(scipy_dist._pmf)
+    else:
+        (args, varargs, varkw, defaults) = inspect.getargspec(scipy_dist._pdf)
 
     shape_args = args[2:]
+    fast = _fast_logp(scipy_dist) if use_fast_logp and not hasattr(scipy_dist, '_logp') else None
     if isinstance(scipy_dist, sc_dst.rv_continuous):
         dtype=float
 
         def logp(value, **kwds):
-            args, zkwds = separate_shape_args(kwds, shape_args)
+            args, kwds = separate_shape_args(kwds, shape_args)
             if hasattr(scipy_dist, '_logp'):
                 return scipy_dist._logp(value, *args)
             else:
@@ -240,7 +398,7 @@ def scipy_stochastic(scipy_dist, **kwargs):
 
     parents_default = dict(zip(parent_names, defaults))
 
-    def random(shape=None, **kwds):
+    def rv_random(shape=None, **kwds):
         args, kwds = separate_shape_args(kwds, shape_args)
 
         if shape is None:
@@ -258,6 +416,13 @@ Methods:
         - draws random value
           sets value to return value
 
+    random(size, params)
+        - draws size values for each row of the parent values in params
+          (e.g. posterior traces), shape (draws,) + size
+
+    pdf(value, params), cdf(value, params), sf(value, params)
+        - evaluated at value for each row of params, shape (draws, points)
+
     ppf(q)
         - percent point function (inverse of cdf --- percentiles)
           sets value to return value
@@ -290,17 +455,26 @@ computation using the rv objects in scipy.stats.distributions directly before
 reporting the bug.
     """
 
-    new_class = new_dist_class(dtype, name, parent_names, parents_default, docstr, logp, random, True, None)
+    new_class = new_dist_class(dtype, name, parent_names, parents_default, docstr, logp, rv_random, True, None)
     class newer_class(new_class):
         __doc__ = docstr
         rv = scipy_dist
-        rv.random = random
+        rv.random = rv_random
+        shape_parents = shape_args
 
         def __init__(self, *args, **kwds):
             new_class.__init__(self, *args, **kwds)
             self.args, self.kwds = separate_shape_args(self.parents, shape_args)
-            self.frozen_rv = self.rv(self.args, self.kwds)
+            # Frozen at the initial values of the parents
+            args, kwds = self._param_values()
+            self.frozen_rv = self.rv(*args, **kwds)
             self._random = bind_size(self._random, self.shape)
+            if fast is not None:
+                # Per node logp that remembers validated parents and values
+                self._logp_fun = _FastLogp(fast, shape_args, isinstance(scipy_dist, sc_dst.rv_continuous))
+                if self.observed:
+                    self._logp_fun.skip_value_check(self.value, **self._parents.value)
+                self.gen_lazy_function()
 
         def _pymc_dists_to_value(self, args):
             """Replace arguments that are a pymc.Node with their value."""
@@ -317,48 +491,104 @@ reporting the bug.
 
             return new_args
 
-        def pdf(self, value=None):
+        def _param_values(self, params=None, ndim=1):
+            """Return shape arguments and keywords (loc, scale) of rv
+            with the current values of the parents. Parents in params
+            (e.g. dict of traces) are replaced by columns of ndim
+            trailing axes so that results have shape (draws, points).
+            """
+            values = dict(self._parents.value)
+            if params is not None:
+                for param, value in params.iteritems():
+                    if param not in values:
+                        raise KeyError("%s is not a parent of %s." % (param, self.__name__))
+                    value = np.asarray(value)
+                    values[param] = value.reshape(value.shape + (1,) * ndim)
+            args, kwds = separate_shape_args(values, shape_args)
+            return args, kwds
+
+        def _evaluate(self, func, value, params):
+            if value is None:
+                value = self.value
+            args, kwds = self._param_values(params, ndim=np.ndim(value))
+            return func(value, *args, **kwds)
+
+        def pdf(self, value=None, params=None):
             """
             The probability distribution function of self conditional on parents
             evaluated at self's current value
+
+            :Optional:
+                value : array
+                    Points to evaluate.
+                params : dict
+                    Maps parent names to arrays of draws (e.g. traces
+                    of the parents). Returns an array of shape
+                    (draws, points).
             """
-            if value is None:
-                value = self.value
-            return self.rv.pdf(value, *self._pymc_dists_to_value(self.args), **self.kwds)
+            if isinstance(self.rv, sc_dst.rv_discrete):
+                return self._evaluate(self.rv.pmf, value, params)
+            return self._evaluate(self.rv.pdf, value, params)
 
-        def cdf(self, value=None):
+        def cdf(self, value=None, params=None):
             """
             The cumulative distribution function of self conditional on parents
-            evaluated at self's current value
+            evaluated at self's current value (see pdf() for params)
             """
-            if value is None:
-                value = self.value
-            return self.rv.cdf(value, *self._pymc_dists_to_value(self.args), **self.kwds)
+            return self._evaluate(self.rv.cdf, value, params)
 
-        def sf(self, value=None):
+        def sf(self, value=None, params=None):
             """
             The survival function of self conditional on parents
-            evaluated at self's current value
+            evaluated at self's current value (see pdf() for params)
             """
-            if value is None:
-                value = self.value
-            return self.rv.sf(self.value, *self._pymc_dists_to_value(self.args), **self.kwds)
+            return self._evaluate(self.rv.sf, value, params)
 
-        def ppf(self, q):
+        def ppf(self, q, params=None):
             """
             The percentile point function (inverse cdf) of self conditional on parents.
-            Self's value will be set to the return value.
+            Self's value will be set to the return value unless params
+            is given (see pdf()).
             """
-            self.value = self.rv.ppf(q, *self._pymc_dists_to_value(self.args), **self.kwds)
-            return self.value
+            value = self._evaluate(self.rv.ppf, q, params)
+            if params is None:
+                self.value = value
+            return value
 
-        def isf(self, q):
+        def isf(self, q, params=None):
             """
             The inverse survival function of self conditional on parents.
-            Self's value will be set to the return value.
+            Self's value will be set to the return value unless params
+            is given (see pdf()).
+            """
+            value = self._evaluate(self.rv.isf, q, params)
+            if params is None:
+                self.value = value
+            return value
+
+        def random(self, size=None, params=None):
             """
-            self.value = self.rv.isf(q, *self._pymc_dists_to_value(self.args), **self.kwds)
-            return self.value
+            Draw a new value from the distribution conditional on
+            parents and set self's value to it.
+
+            :Optional:
+                size : int or tuple
+                    Return size samples (for each draw of params)
+                    without setting the value.
+                params : dict
+                    Maps parent names to arrays of draws (see pdf()).
+                    Returns an array of shape (draws,) + size.
+            """
+            if size is None and params is None:
+                return new_class.random(self)
+            if size is None:
+                size = np.shape(self.value)
+            size = tuple(np.atleast_1d(size))
+            args, kwds = self._param_values(params, ndim=len(size))
+            if params is not None:
+                draws = np.broadcast(*[np.asarray(value) for value in params.itervalues()]).shape
+                size = draws + size
+            return self.rv.rvs(*args, size=size, **kwds)
 
         def stats(self, moments='mv'):
             """The first few moments of self's distribution conditional on parents"""
@@ -373,6 +603,12 @@ reporting the bug.
     return newer_class
 
 def set_proposal_sd(mc, tau=.1):
+    """Use Metropolis with proposal_sd tau for all var nodes.
+
+    :Note:
+        Hierarchical.sample(tune_proposals=True) tunes the proposals
+        of all nodes automatically during burn-in (see kabuki.tuning).
+    """
     for var in mc.variables:
         if var.__name__.endswith('var'):
             # Change proposal SD
@@ -0,0 +1,179 @@
+"""
+Mean-field variational approximation of the posterior.
+
+MeanFieldVI fits independent normal distributions to all stochastics
+in the unconstrained space of kabuki.optimize.GradientMAP (logit/log
+transforms of bounded nodes) by maximizing the evidence lower bound
+(ELBO) with stochastic gradients:
+
+    * Gradients of the ELBO are estimated with the reparametrization
+      y = mean + sd * eps from a batch of draws per iteration, using
+      the (analytical, or finite difference for nodes without one) gradients
+      of GradientMAP.
+    * Step sizes are adapted with Adam (Kingma & Ba, 2014).
+
+Hierarchical.fit_vi() then draws from the approximation through a
+separate pymc.MCMC sampler (Hierarchical.approx_mc) with the
+ApproximateDraw step method, so that its traces and stats() can be
+used as after sample(). sample() still runs MCMC.
+
+:Note:
+    A mean-field approximation ignores posterior correlations and
+    typically underestimates posterior variances. Use it to screen
+    models, not for final inference.
+
+"""
+from __future__ import division
+
+import numpy as np
+import pymc as pm
+
+from kabuki.optimize import GradientMAP
+
+__all__ = ['MeanFieldVI', 'ApproximateDraw']
+
+
+class MeanFieldVI(GradientMAP):
+    """Mean-field Gaussian approximation in unconstrained space.
+
+    :Arguments:
+        input : nodes
+            Anything pymc.Model accepts.
+
+    :Optional:
+        bounds : dict
+            Maps stochastics to (lower, upper) (see GradientMAP).
+        eps : float
+            Step size of finite difference gradients.
+
+    """
+    def __init__(self, input=None, bounds=None, eps=1e-5, verbose=-1):
+        GradientMAP.__init__(self, input, bounds=bounds, eps=eps, verbose=verbose)
+
+        self.mean = self.to_unconstrained(self.get_values())
+        self.log_sd = np.ones(self.len) * -2.
+        self.elbo_trace = []
+
+    def fit_map(self, **kwargs):
+        """Start the approximation at the MAP (see GradientMAP.fit())."""
+        GradientMAP.fit(self, **kwargs)
+        self.mean = self.to_unconstrained(self.get_values())
+
+    def _logp_and_grad(self, y):
+        """Return log density and its gradient in unconstrained space
+        at each row of y.
+
+        The model is evaluated at one point at a time; the
+        transforms are applied to all rows at once.
+        """
+        logp = np.empty(len(y))
+        grad = np.zeros(np.shape(y))
+        for i, y_i in enumerate(y):
+            logp[i] = -self.func(y_i)
+            if np.isfinite(logp[i]):
+                grad[i] = -self.gradfunc(y_i)
+        return logp + self.log_jacobian(y), grad + self.log_jacobian_grad(y)
+
+    def _elbo_and_grad(self, mean, log_sd, z):
+        """Return the ELBO estimate and its gradients with respect to
+        mean and log_sd from the draws mean + sd * z (one per row of
+        z), or None if all draws have zero probability.
+        """
+        sd = np.exp(log_sd)
+        logp, grad = self._logp_and_grad(mean + sd * z)
+        # Average over the draws with non-zero probability only
+        valid = np.isfinite(logp)
+        if not np.any(valid):
+            return None
+        # Entropy of the approximation (up to a constant)
+        elbo = np.mean(logp[valid]) + np.sum(log_sd)
+        grad_mean = np.mean(grad[valid], axis=0)
+        grad_log_sd = np.mean(grad[valid] * sd * z[valid], axis=0) + 1
+        return elbo, grad_mean, grad_log_sd
+
+    def fit(self, iter=2000, batch_size=4, learning_rate=.05, tol=1e-3, window=100, verbose=0):
+        """Maximize the ELBO.
+
+        :Optional:
+            iter : int
+                Maximum number of iterations.
+            batch_size : int
+                Draws per gradient estimate. Draws with zero
+                probability are left out of the estimate.
+            learning_rate : float
+                Step size of Adam.
+            tol : float
+                Stop if the mean ELBO of the last window iterations
+                changed by less than tol (relative to the window
+                before).
+            window : int
+                Number of iterations the ELBO is averaged over.
+
+        :Returns:
+            Final ELBO estimate.
+        """
+        beta1, beta2, epsilon = .9, .999, 1e-8
+        params = np.concatenate([self.mean, self.log_sd])
+        m = np.zeros_like(params)
+        v = np.zeros_like(params)
+
+        for t in range(1, iter + 1):
+            mean, log_sd = params[:self.len], params[self.len:]
+            estimate = self._elbo_and_grad(mean, log_sd, np.random.randn(batch_size, self.len))
+            if estimate is None:
+                continue
+            elbo, grad_mean, grad_log_sd = estimate
+            self.elbo_trace.append(elbo)
+
+            # Adam ascent step
+            grad = np.concatenate([grad_mean, grad_log_sd])
+            m = beta1 * m + (1 - beta1) * grad
+            v = beta2 * v + (1 - beta2) * grad**2
+            m_hat = m / (1 - beta1**t)
+            v_hat = v / (1 - beta2**t)
+            params = params + learning_rate * m_hat / (np.sqrt(v_hat) + epsilon)
+
+            if verbose > 0 and not t % window:
+                print "iteration %i: ELBO %f" % (t, np.mean(self.elbo_trace[-window:]))
+
+            if t >= 2 * window:
+                current = np.mean(self.elbo_trace[-window:])
+                previous = np.mean(self.elbo_trace[-2*window:-window])
+                if np.abs(current - previous) < tol * np.abs(previous):
+                    break
+
+        self.mean, self.log_sd = params[:self.len], params[self.len:]
+        self.set_values(self.to_constrained(self.mean))
+        self.fitted = True
+
+        return np.mean(self.elbo_trace[-window:])
+
+    @property
+    def sd(self):
+        return np.exp(self.log_sd)
+
+    def draw(self):
+        """Return a draw of the values of all stochastics."""
+        return self.to_constrained(self.mean + self.sd * np.random.randn(self.len))
+
+
+class ApproximateDraw(pm.StepMethod):
+    """Set all stochastics of an approximation (e.g. MeanFieldVI) to
+    an independent draw at each step, so that pymc.MCMC tallies draws
+    of the approximation.
+
+    :Arguments:
+        approximation : object
+            Has stochastic_list, draw() and set_values().
+
+    """
+    def __init__(self, approximation, verbose=-1):
+        pm.StepMethod.__init__(self, approximation.stochastic_list, verbose=verbose)
+        self.approximation = approximation
+
+    @staticmethod
+    def competence(stochastic):
+        return 0
+
+    def step(self):
+        self.approximation.set_values(self.approximation.draw())